@@ -41,7 +41,8 @@ def prepare_dict_features(df: pd.DataFrame):
 
 
 def load_model_from_mlflow():
-    logged_model = f"s3://{S3_BUCKET_NAME}/{EXP_ID}/{RUN_ID}/artifacts/model"    
+    # MODEL_LOCATION: a local or other model path instead of the S3 artifact
+    logged_model = os.getenv('MODEL_LOCATION') or f"s3://{S3_BUCKET_NAME}/{EXP_ID}/{RUN_ID}/artifacts/model"
     model = mlflow.pyfunc.load_model(logged_model)
     return model
 
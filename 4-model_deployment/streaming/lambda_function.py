@@ -1,11 +1,13 @@
 import os
-import mlflow
-import boto3
 import json
+import time
 import base64
-import pandas as pd
+import pickle
+import datetime
+import importlib
 
-kinesis_client = boto3.client('kinesis')
+# boto3 and mlflow are imported only when needed: importing them is most of
+# a cold start, and a model exported as model.pkl is served without MLflow
 
 PREDICTIONS_STREAM_NAME = os.getenv('PREDICTIONS_STREAM_NAME', 'sales_predictions')
 TEST_RUN = os.getenv('TEST_RUN', 'False') == 'True'
@@ -16,20 +18,67 @@ S3_BUCKET_NAME = os.getenv("S3_BUCKET_NAME","mlartifact-s3")
 EXP_ID = os.getenv('EXP_ID',"6")
 
 # if server is down, directly point to the location locally s3 etc.
-logged_model = f"s3://{S3_BUCKET_NAME}/{EXP_ID}/{RUN_ID}/artifacts/model"
+# MODEL_LOCATION=s3://.../artifacts/model.pkl loads the slim pickle instead
+logged_model = os.getenv('MODEL_LOCATION', f"s3://{S3_BUCKET_NAME}/{EXP_ID}/{RUN_ID}/artifacts/model")
 
-model = mlflow.pyfunc.load_model(logged_model)
+# wall time of every cold-start phase in ms, printed once to CloudWatch
+init_timings = {}
+
+def timed(phase, func, *args):
+    started = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        init_timings[phase] = init_timings.get(phase, 0.0) + (time.perf_counter() - started) * 1000
+
+def load_pickle(path):
+    with open(path, 'rb') as f_in:
+        return pickle.load(f_in)
+
+def download_s3_file(s3_uri):
+    boto3 = timed('imports', importlib.import_module, 'boto3')
+    bucket, key = s3_uri[len('s3://'):].split('/', 1)
+    local_path = os.path.join('/tmp', key.replace('/', '_'))
+    timed('download', boto3.client('s3').download_file, bucket, key, local_path)
+    return local_path
+
+def load_model(location):
+    if not location.endswith('.pkl'):
+        mlflow_pyfunc = timed('imports', importlib.import_module, 'mlflow.pyfunc')
+        local_path = timed('download', importlib.import_module('mlflow.artifacts').download_artifacts, location)
+        return timed('deserialize', mlflow_pyfunc.load_model, local_path)
+
+    # the fitted pipeline only, no MLflow needed
+    if location.startswith('s3://'):
+        location = download_s3_file(location)
+    return timed('deserialize', load_pickle, location)
+
+model = load_model(logged_model)
+
+kinesis_client = None
+if not TEST_RUN:
+    kinesis_client = timed('imports', importlib.import_module, 'boto3').client('kinesis')
+
+def parse_date(value):
+    # "2022-12-25" (or with a time part) without a parser import; dateutil for
+    # the other formats pd.to_datetime accepted, e.g. "2022-1-5" or "2022/12/25"
+    text = str(value)
+    try:
+        return datetime.date.fromisoformat(text[:10])
+    except ValueError:
+        return importlib.import_module('dateutil.parser').parse(text).date()
 
 def prepare_features(row):
-    date = pd.to_datetime(row['date'])
+    # weekday() is Monday=0 like pandas' dayofweek
+    date = parse_date(row['date'])
     features = {
         'store': row['store'],
         'promo': row['promo'],
         'holiday': row['holiday'],
         'year': date.year,
         'month': date.month,
-        'dayofweek': date.dayofweek,
-        'is_weekend': int(date.dayofweek >= 5)
+        'dayofweek': date.weekday(),
+        'is_weekend': int(date.weekday() >= 5)
     }
     return features
 
@@ -38,22 +87,49 @@ def predict(features):
     
     return preds[0]
 
+def predict_batch(features_batch):
+    # one model call for all the records of an invocation
+    preds = model.predict(features_batch)
+
+    return [float(pred) for pred in preds]
+
+# the first prediction is slower than the others, pay it during init
+timed('first_prediction', predict_batch,
+      [prepare_features({'date': '2022-12-25', 'store': 2, 'promo': 1, 'holiday': 0})])
+print(json.dumps({'init_timings_ms': init_timings}))
+
+def decode_record(record):
+    encoded_data = record['kinesis']['data']
+    decoded_data = base64.b64decode(encoded_data).decode('utf-8')
+    sales_event = json.loads(decoded_data)
+
+    return sales_event['sales_id'], prepare_features(sales_event['sales_input'])
+
 def lambda_handler(event, context):
     # print(json.dumps(event))
     
     predictions_events = []
-    
-    for record in event['Records']:
-        encoded_data = record['kinesis']['data']
-        decoded_data = base64.b64decode(encoded_data).decode('utf-8')
-        sales_event = json.loads(decoded_data)
+    errors = []
 
-        sales = sales_event['sales_input']
-        sales_id = sales_event['sales_id']
-    
-        features = prepare_features(sales)
-        prediction = predict(features)
-    
+    # decode everything first, a bad record is reported instead of failing the batch
+    sales_ids = []
+    features_batch = []
+    for index, record in enumerate(event['Records']):
+        try:
+            sales_id, features = decode_record(record)
+        except (KeyError, TypeError, ValueError) as e:
+            errors.append({
+                'index': index,
+                'sequence_number': record.get('kinesis', {}).get('sequenceNumber'),
+                'error': f'{type(e).__name__}: {e}'
+            })
+            continue
+        sales_ids.append(sales_id)
+        features_batch.append(features)
+
+    predictions = predict_batch(features_batch) if features_batch else []
+
+    for sales_id, prediction in zip(sales_ids, predictions):
         prediction_event = {
             'model': 'sales_prediction_model',
             'version': '123',
@@ -72,8 +148,9 @@ def lambda_handler(event, context):
         
         predictions_events.append(prediction_event)
 
-
-    return {
+    result = {
         'predictions': predictions_events
     }
-
+    if errors:
+        result['errors'] = errors
+    return result
@@ -1,8 +1,12 @@
 import os
+import sys
 from flask import Flask, request, jsonify
-import pandas as pd
 import mlflow
 
+# the request parsing is shared with the service in ../web-services
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'web-services'))
+from batch_input import DATE_ERROR, is_invalid_date, prepare_features, read_batch, prepare_features_batch
+
 
 
 # Load the RUN_ID and S3_BUCKET_NAME from mlfow
@@ -20,27 +24,34 @@ model = mlflow.pyfunc.load_model(logged_model)
 
 app = Flask("store-sales-prediction")
 
-def prepare_features(row):
-    date = pd.to_datetime(row['date'])
-    features = {
-        'store': row['store'],
-        'promo': row['promo'],
-        'holiday': row['holiday'],
-        'year': date.year,
-        'month': date.month,
-        'dayofweek': date.dayofweek,
-        'is_weekend': int(date.dayofweek >= 5)
-    }
-    return features
+MAX_BATCH_SIZE = int(os.getenv('MAX_BATCH_SIZE', '50000'))
 
 def predict(features):
     preds = model.predict(features)
     
     return preds[0]
 
+def predict_batch(features):
+    # the pipeline starts with a DictVectorizer, same input as the batch scoring job
+    preds = model.predict(features.to_dict(orient='records'))
+    return preds
+
+def warmup():
+    # one pass through both prediction paths so the first real request doesn't pay
+    # for lazy initialisation (date parsing, vectorizer lookups); under gunicorn's
+    # preload_app this runs once in the master, before the workers are forked
+    sample = {'date': '2022-12-25', 'store': 2, 'promo': 1, 'holiday': 0}
+    predict(prepare_features(sample))
+    df, errors = read_batch([sample])
+    predict_batch(prepare_features_batch(df, errors))
+
+warmup()
+
 @app.route('/predict', methods=['POST'])
 def predict_endpoint():
     input_data = request.get_json()
+    if is_invalid_date(input_data.get('date')):
+        return jsonify({'error': DATE_ERROR}), 400
     features = prepare_features(input_data)
     prediction = predict(features)
     
@@ -50,5 +61,29 @@ def predict_endpoint():
 
     return jsonify(result)
 
+@app.route('/predict_batch', methods=['POST'])
+def predict_batch_endpoint():
+    try:
+        df, errors = read_batch(request.get_json())
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    if len(df) > MAX_BATCH_SIZE:
+        return jsonify({'error': f'batch size {len(df)} exceeds {MAX_BATCH_SIZE}'}), 413
+
+    features = prepare_features_batch(df, errors)
+    predictions = [None] * len(df)
+    if len(features) > 0:
+        preds = predict_batch(features)
+        for i, pred in zip(features.index, preds):
+            predictions[i] = float(pred)
+
+    result = {
+        'predictions': predictions,
+        'errors': [{'index': int(i), 'error': errors[i]} for i in sorted(errors)]
+    }
+
+    return jsonify(result)
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=9696)
\ No newline at end of file
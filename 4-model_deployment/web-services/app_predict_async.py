@@ -0,0 +1,239 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+# reuses the request parsing and the model of the Flask app
+from batch_input import read_batch, prepare_features_batch
+from app_predict import predict_batch
+
+
+MAX_BATCH_SIZE = int(os.getenv('MICRO_BATCH_MAX_SIZE', '64'))
+MAX_WAIT_MS = float(os.getenv('MICRO_BATCH_MAX_WAIT_MS', '5'))
+# rows waiting for a batch; beyond that requests are turned away with a 503
+MAX_QUEUE_SIZE = int(os.getenv('MICRO_BATCH_MAX_QUEUE_SIZE', '4096'))
+MAX_BODY_BYTES = 1024 * 1024
+
+
+def predict_rows(rows):
+    # runs in the executor thread: one vectorized prediction for the whole micro-batch
+    df, errors = read_batch(rows)
+    features = prepare_features_batch(df, errors)
+    predictions = [None] * len(rows)
+    if len(features) > 0:
+        for i, pred in zip(features.index, predict_batch(features)):
+            predictions[i] = float(pred)
+    return predictions, errors
+
+
+class Overloaded(Exception):
+    """The queue of rows waiting for a batch is full."""
+
+
+class MicroBatcher:
+    """Collects concurrent single-row requests into micro-batches.
+
+    A batch is closed when it reaches `max_batch_size` rows or when
+    `max_wait_ms` has passed since its first row arrived, whichever comes first.
+    At most `max_queue_size` rows wait for a batch: `submit` raises
+    `Overloaded` beyond that instead of letting the backlog grow.
+    """
+
+    def __init__(self, predict_fn, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS,
+                 max_queue_size=MAX_QUEUE_SIZE):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = asyncio.Queue(maxsize=max_queue_size)
+        # a single thread keeps batches sequential while the next one is collected
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.task = None
+        self.batches = 0
+        self.rows = 0
+        self.rejected = 0
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.executor.shutdown(wait=True)
+
+    async def submit(self, row):
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((row, future))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise Overloaded(f'more than {self.queue.maxsize} rows are waiting') from None
+        return await future
+
+    async def _collect(self):
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            rows = [row for row, _ in batch]
+            try:
+                predictions, errors = await loop.run_in_executor(
+                    self.executor, self.predict_fn, rows
+                )
+            except Exception as e:  # the whole batch failed, fail every caller
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.rows += len(rows)
+            for i, (_, future) in enumerate(batch):
+                if future.done():  # caller went away
+                    continue
+                if i in errors:
+                    future.set_exception(ValueError(errors[i]))
+                else:
+                    future.set_result(predictions[i])
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'rows': self.rows,
+            'avg_batch_size': self.rows / self.batches if self.batches else 0.0,
+            'queued': self.queue.qsize(),
+            'rejected': self.rejected,
+        }
+
+
+# --- minimal HTTP/1.1 front end (keep-alive, JSON bodies only) ---
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error',
+           503: 'Service Unavailable'}
+
+
+async def write_response(writer, status, payload, keep_alive):
+    body = json.dumps(payload).encode('utf-8')
+    headers = (
+        f'HTTP/1.1 {status} {REASONS[status]}\r\n'
+        'Content-Type: application/json\r\n'
+        f'Content-Length: {len(body)}\r\n'
+        f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'
+    )
+    writer.write(headers.encode('latin-1') + body)
+    await writer.drain()
+
+
+async def read_request(reader):
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, path, version = request_line.decode('latin-1').split()
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0))
+    if length > MAX_BODY_BYTES:
+        raise ValueError(f'body larger than {MAX_BODY_BYTES} bytes')
+    body = await reader.readexactly(length) if length else b''
+    keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+    return method, path, body, keep_alive
+
+
+def make_handler(batcher):
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                except (ValueError, asyncio.IncompleteReadError):
+                    await write_response(writer, 400, {'error': 'invalid request'}, False)
+                    break
+                if request is None:
+                    break
+                method, path, body, keep_alive = request
+
+                if method == 'POST' and path == '/predict':
+                    try:
+                        prediction = await batcher.submit(json.loads(body))
+                        status, payload = 200, {'duration': prediction}
+                    except ValueError as e:  # also covers malformed JSON
+                        status, payload = 400, {'error': str(e)}
+                    except Overloaded as e:
+                        status, payload = 503, {'error': str(e)}
+                    except Exception:
+                        # e.g. the model failed: answer instead of dropping the connection
+                        logging.exception('prediction failed')
+                        status, payload = 500, {'error': 'internal error'}
+                elif method == 'GET' and path == '/health':
+                    status, payload = 200, {'status': 'ok'}
+                elif method == 'GET' and path == '/stats':
+                    status, payload = 200, batcher.stats()
+                else:
+                    status, payload = 404, {'error': f'no route for {method} {path}'}
+
+                await write_response(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    return handle
+
+
+async def serve(host, port, max_batch_size, max_wait_ms, max_queue_size=MAX_QUEUE_SIZE):
+    batcher = MicroBatcher(predict_rows, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms,
+                           max_queue_size=max_queue_size)
+    batcher.start()
+    server = await asyncio.start_server(make_handler(batcher), host, port, backlog=1024)
+    print(f'serving on {host}:{port} (max_batch_size={max_batch_size}, max_wait_ms={max_wait_ms})')
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await batcher.stop()
+
+
+def run():
+    parser = argparse.ArgumentParser(description='asyncio store-sales prediction service with micro-batching')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=9696)
+    parser.add_argument('--max-batch-size', type=int, default=MAX_BATCH_SIZE)
+    parser.add_argument('--max-wait-ms', type=float, default=MAX_WAIT_MS)
+    parser.add_argument('--max-queue-size', type=int, default=MAX_QUEUE_SIZE)
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args.host, args.port, args.max_batch_size, args.max_wait_ms, args.max_queue_size))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    run()
+
+# python app_predict_async.py --max-batch-size 64 --max-wait-ms 5
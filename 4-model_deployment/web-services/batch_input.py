@@ -0,0 +1,83 @@
+# Request parsing and feature preparation of the prediction web services.
+# Shared by app_predict.py here and ../web-services-mlflow/app_predict.py,
+# which only differ in how the model is loaded.
+import pandas as pd
+
+
+INPUT_FIELDS = ['date', 'store', 'promo', 'holiday']
+NUMERIC_FIELDS = ['store', 'promo', 'holiday']
+DATE_ERROR = "date must be a string, e.g. '2022-12-25'"
+
+def is_invalid_date(value):
+    # pd.to_datetime reads numbers as nanoseconds since 1970 instead of failing
+    return value is not None and not isinstance(value, str)
+
+def prepare_features(row):
+    date = pd.to_datetime(row['date'])
+    features = {
+        'store': row['store'],
+        'promo': row['promo'],
+        'holiday': row['holiday'],
+        'year': date.year,
+        'month': date.month,
+        'dayofweek': date.dayofweek,
+        'is_weekend': int(date.dayofweek >= 5)
+    }
+    return features
+
+def read_batch(payload):
+    # Accepts a list of row objects, {"rows": [...]} or a columnar body
+    # {"date": [...], "store": [...], "promo": [...], "holiday": [...]}
+    if isinstance(payload, dict) and 'rows' in payload:
+        payload = payload['rows']
+
+    if isinstance(payload, list):
+        errors = {}
+        rows = []
+        for i, row in enumerate(payload):
+            if not isinstance(row, dict):
+                errors[i] = 'row must be a JSON object'
+                row = {}
+            elif is_invalid_date(row.get('date')):
+                errors[i] = DATE_ERROR
+            rows.append({name: row.get(name) for name in INPUT_FIELDS})
+        return pd.DataFrame(rows, columns=INPUT_FIELDS), errors
+
+    if isinstance(payload, dict):
+        columns = {name: payload.get(name) for name in INPUT_FIELDS}
+        missing = [name for name, values in columns.items() if not isinstance(values, list)]
+        if missing:
+            raise ValueError(f'columnar body is missing list columns: {missing}')
+        if len({len(values) for values in columns.values()}) > 1:
+            raise ValueError('all columns must have the same length')
+        # row errors like in a list of rows: the other rows are still scored
+        errors = {i: DATE_ERROR for i, value in enumerate(columns['date']) if is_invalid_date(value)}
+        return pd.DataFrame(columns), errors
+
+    raise ValueError('expected a list of rows or a columnar object')
+
+
+def prepare_features_batch(df, errors):
+    # Same features as prepare_features, computed column-wise for the whole batch
+    date = pd.to_datetime(df['date'], errors='coerce', format='mixed')
+    numeric = df[NUMERIC_FIELDS].apply(pd.to_numeric, errors='coerce')
+
+    invalid = numeric.isna()
+    invalid['date'] = date.isna()
+    for i in invalid.index[invalid.any(axis=1)]:
+        if i not in errors:
+            bad_fields = list(invalid.columns[invalid.loc[i]])
+            errors[i] = f'missing or invalid fields: {bad_fields}'
+
+    valid = ~df.index.isin(list(errors))
+    date = date[valid]
+    features = pd.DataFrame({
+        'store': numeric['store'][valid],
+        'promo': numeric['promo'][valid],
+        'holiday': numeric['holiday'][valid],
+        'year': date.dt.year,
+        'month': date.dt.month,
+        'dayofweek': date.dt.dayofweek,
+        'is_weekend': (date.dt.dayofweek >= 5).astype(int)
+    })
+    return features
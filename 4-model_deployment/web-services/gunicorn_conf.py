@@ -0,0 +1,69 @@
+# Production gunicorn settings: the app (model + warm-up) is loaded once in the
+# master and the workers are forked from it, so they share the model pages
+# copy-on-write instead of each deserializing their own copy.
+#
+#   gunicorn -c gunicorn_conf.py app_predict:app
+
+import os
+import gc
+import time
+import multiprocessing
+
+STARTED_AT = time.perf_counter()
+
+bind = f"0.0.0.0:{os.getenv('PORT', '9696')}"
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+preload_app = True
+
+# recycle workers after a number of requests (jittered so they don't restart
+# together); a recycled worker finishes its in-flight requests first
+max_requests = int(os.getenv('MAX_REQUESTS', '10000'))
+max_requests_jitter = int(os.getenv('MAX_REQUESTS_JITTER', '1000'))
+graceful_timeout = int(os.getenv('GRACEFUL_TIMEOUT', '30'))
+timeout = int(os.getenv('WORKER_TIMEOUT', '60'))
+
+
+def read_memory_kb(pid):
+    # Rss counts shared pages in every process, Private_* is what the worker owns
+    memory = {}
+    try:
+        with open(f'/proc/{pid}/smaps_rollup', 'rt', encoding='utf-8') as f_in:
+            for line in f_in:
+                name, _, value = line.partition(':')
+                if name in ('Rss', 'Pss', 'Private_Clean', 'Private_Dirty'):
+                    memory[name] = int(value.split()[0])
+    except OSError:
+        return None
+    return {
+        'rss_kb': memory.get('Rss', 0),
+        'pss_kb': memory.get('Pss', 0),
+        'private_kb': memory.get('Private_Clean', 0) + memory.get('Private_Dirty', 0),
+    }
+
+
+def format_memory(pid):
+    memory = read_memory_kb(pid)
+    if memory is None:
+        return f'pid={pid} memory=n/a'
+    return (
+        f"pid={pid} rss={memory['rss_kb'] / 1024:.1f}MB "
+        f"pss={memory['pss_kb'] / 1024:.1f}MB private={memory['private_kb'] / 1024:.1f}MB"
+    )
+
+
+def when_ready(server):
+    # Move everything loaded so far into the permanent generation: the workers'
+    # garbage collector then no longer writes to those objects, which would
+    # otherwise copy the shared model pages one by one
+    gc.freeze()
+    server.log.info(
+        'app preloaded in %.2fs, master %s', time.perf_counter() - STARTED_AT, format_memory(os.getpid())
+    )
+
+
+def post_worker_init(worker):
+    worker.log.info('worker booted %.2fs after start, %s', time.perf_counter() - STARTED_AT, format_memory(worker.pid))
+
+
+def worker_exit(server, worker):
+    server.log.info('worker exiting (%s)', format_memory(worker.pid))
@@ -0,0 +1,114 @@
+import json
+import time
+import random
+import asyncio
+import argparse
+
+
+def make_row():
+    return {
+        "date": f"2022-{random.randint(1, 12)}-{random.randint(1, 28)}",
+        "store": random.randint(1, 10),
+        "promo": random.randint(0, 1),
+        "holiday": random.randint(0, 1)
+    }
+
+
+async def send(reader, writer, host, path, payload):
+    body = json.dumps(payload).encode('utf-8')
+    writer.write(
+        f'POST {path} HTTP/1.1\r\nHost: {host}\r\n'
+        f'Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n'.encode('latin-1')
+        + body
+    )
+    await writer.drain()
+
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    keep_alive = True
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        name = name.strip().lower()
+        if name == 'content-length':
+            length = int(value)
+        elif name == 'connection':
+            keep_alive = value.strip().lower() != 'close'
+    await reader.readexactly(length)
+    return status, keep_alive
+
+
+async def client(host, port, path, n_requests, latencies, failures):
+    # one keep-alive connection per simulated caller, reopened if the server
+    # closes it (gunicorn's sync workers answer with Connection: close)
+    reader = writer = None
+    try:
+        for _ in range(n_requests):
+            start = time.perf_counter()
+            if writer is None:
+                reader, writer = await asyncio.open_connection(host, port)
+            status, keep_alive = await send(reader, writer, host, path, make_row())
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                failures.append(status)
+            if not keep_alive:
+                writer.close()
+                writer = None
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(q / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+async def run_load_test(host, port, path, concurrency, requests_per_client):
+    latencies = []
+    failures = []
+    start = time.perf_counter()
+    await asyncio.gather(*[
+        client(host, port, path, requests_per_client, latencies, failures)
+        for _ in range(concurrency)
+    ])
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'failures': len(failures),
+        'concurrency': concurrency,
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'max_ms': round(latencies[-1] * 1000, 2) if latencies else 0.0,
+    }
+
+
+def run():
+    parser = argparse.ArgumentParser(description='concurrent load test for the /predict endpoint')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=9696)
+    parser.add_argument('--path', default='/predict')
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--requests', type=int, default=100, help='requests per concurrent client')
+    args = parser.parse_args()
+
+    report = asyncio.run(
+        run_load_test(args.host, args.port, args.path, args.concurrency, args.requests)
+    )
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    run()
+
+# works against both servers, e.g.
+# python app_predict_async.py            (or: gunicorn --bind=0.0.0.0:9696 app_predict:app)
+# python load_test.py --concurrency 64 --requests 100
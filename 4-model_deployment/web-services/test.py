@@ -9,4 +9,24 @@ sample_input = {
 
 url = 'http://localhost:9696/predict'
 response = requests.post(url, json=sample_input)
-print(response.json())
\ No newline at end of file
+print(response.json())
+
+batch_input = [
+    {"date": "2022-12-25", "store": 2, "promo": 1, "holiday": 0},
+    {"date": "2022-12-26", "store": 3, "promo": 0, "holiday": 1},
+    {"date": "not-a-date", "store": 4, "promo": 0, "holiday": 0},
+]
+
+url = 'http://localhost:9696/predict_batch'
+response = requests.post(url, json=batch_input)
+print(response.json())
+
+# the same rows as a compact columnar body
+columnar_input = {
+    "date": ["2022-12-25", "2022-12-26"],
+    "store": [2, 3],
+    "promo": [1, 0],
+    "holiday": [0, 1],
+}
+response = requests.post(url, json=columnar_input)
+print(response.json())
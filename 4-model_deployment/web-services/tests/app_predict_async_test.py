@@ -0,0 +1,120 @@
+import asyncio
+
+import pytest
+
+import app_predict_async
+from app_predict_async import MicroBatcher, Overloaded
+
+
+def echo_rows(batches):
+    def predict_fn(rows):
+        batches.append(len(rows))
+        return [float(row['store']) for row in rows], {}
+    return predict_fn
+
+
+async def submit_all(batcher, rows):
+    batcher.start()
+    try:
+        return await asyncio.gather(*(batcher.submit(row) for row in rows), return_exceptions=True)
+    finally:
+        await batcher.stop()
+
+
+def test_micro_batcher_groups_concurrent_rows():
+    batches = []
+    batcher = MicroBatcher(echo_rows(batches), max_batch_size=4, max_wait_ms=1000)
+
+    results = asyncio.run(submit_all(batcher, [{'store': store} for store in range(10)]))
+
+    assert results == [float(store) for store in range(10)]
+    # full batches are closed without waiting for the time limit
+    assert batches == [4, 4, 2]
+    assert batcher.stats()['rows'] == 10
+
+
+def test_micro_batcher_closes_batch_after_max_wait():
+    batches = []
+    batcher = MicroBatcher(echo_rows(batches), max_batch_size=100, max_wait_ms=10)
+
+    async def submit_apart():
+        batcher.start()
+        try:
+            first = asyncio.ensure_future(batcher.submit({'store': 1}))
+            await asyncio.sleep(0.2)
+            second = await batcher.submit({'store': 2})
+            return await first, second
+        finally:
+            await batcher.stop()
+
+    assert asyncio.run(submit_apart()) == (1.0, 2.0)
+    assert batches == [1, 1]
+
+
+def test_micro_batcher_reports_row_and_batch_errors():
+    def predict_fn(rows):
+        if any(row.get('fail') for row in rows):
+            raise RuntimeError('model failed')
+        return [1.0] * len(rows), {1: 'missing or invalid fields: [\'date\']'}
+
+    results = asyncio.run(submit_all(MicroBatcher(predict_fn), [{}, {}, {}]))
+    assert results[0] == 1.0 and results[2] == 1.0
+    assert isinstance(results[1], ValueError)
+
+    results = asyncio.run(submit_all(MicroBatcher(predict_fn), [{}, {'fail': True}]))
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+def test_micro_batcher_rejects_rows_beyond_the_queue_size():
+    async def submit_to_full_queue():
+        # not started: nothing takes rows off the queue
+        batcher = MicroBatcher(echo_rows([]), max_queue_size=2)
+        pending = [asyncio.ensure_future(batcher.submit({'store': store})) for store in range(2)]
+        await asyncio.sleep(0)
+        with pytest.raises(Overloaded):
+            await batcher.submit({'store': 3})
+        for future in pending:
+            future.cancel()
+        return batcher.stats()
+
+    assert asyncio.run(submit_to_full_queue())['rejected'] == 1
+
+
+async def request(batcher, body):
+    server = await asyncio.start_server(app_predict_async.make_handler(batcher), '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    async with server:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(
+            b'POST /predict HTTP/1.1\r\nConnection: close\r\n'
+            + f'Content-Length: {len(body)}\r\n\r\n'.encode('latin-1') + body
+        )
+        response = await reader.read()
+        writer.close()
+    return response.split(b'\r\n', 1)[0]
+
+
+@pytest.mark.parametrize('error, status_line', [
+    (ValueError('bad row'), b'HTTP/1.1 400 Bad Request'),
+    (Overloaded('full'), b'HTTP/1.1 503 Service Unavailable'),
+    (RuntimeError('model failed'), b'HTTP/1.1 500 Internal Server Error'),
+])
+def test_handler_maps_errors_to_status(error, status_line):
+    class FailingBatcher:
+        async def submit(self, row):
+            raise error
+
+    assert asyncio.run(request(FailingBatcher(), b'{}')) == status_line
+
+
+def test_handler_predicts_a_row():
+    batcher = MicroBatcher(app_predict_async.predict_rows)
+
+    async def predict():
+        batcher.start()
+        try:
+            return await request(batcher, b'{"date": "2022-12-25", "store": 2, "promo": 1, "holiday": 0}')
+        finally:
+            await batcher.stop()
+
+    assert asyncio.run(predict()) == b'HTTP/1.1 200 OK'
@@ -0,0 +1,39 @@
+import app_predict
+
+
+def post(path, body):
+    response = app_predict.app.test_client().post(path, json=body)
+    return response.status_code, response.get_json()
+
+
+def test_predict_rejects_a_numeric_date():
+    status, body = post('/predict', {'date': 20221225, 'store': 2, 'promo': 1, 'holiday': 0})
+
+    assert status == 400
+    assert body == {'error': app_predict.DATE_ERROR}
+
+
+def test_predict_batch_reports_rows_with_numeric_dates():
+    rows = [
+        {'date': '2022-12-25', 'store': 2, 'promo': 1, 'holiday': 0},
+        {'date': 1671926400, 'store': 2, 'promo': 1, 'holiday': 0},
+    ]
+
+    status, body = post('/predict_batch', rows)
+
+    assert status == 200
+    assert body['predictions'][0] is not None and body['predictions'][1] is None
+    assert body['errors'] == [{'index': 1, 'error': app_predict.DATE_ERROR}]
+
+
+def test_predict_batch_reports_columnar_rows_with_numeric_dates():
+    columns = {'date': ['2022-12-25', 20221226, '2022-12-27'], 'store': [2, 3, 4], 'promo': [1, 0, 1],
+               'holiday': [0, 1, 0]}
+
+    status, body = post('/predict_batch', columns)
+
+    assert status == 200
+    assert [prediction is None for prediction in body['predictions']] == [False, True, False]
+    assert body['errors'] == [{'index': 1, 'error': app_predict.DATE_ERROR}]
+    rows = [{name: values[i] for name, values in columns.items()} for i in (0, 2)]
+    assert [body['predictions'][i] for i in (0, 2)] == post('/predict_batch', rows)[1]['predictions']
@@ -0,0 +1,12 @@
+import os
+import sys
+
+import pytest
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# app_predict loads ./lin_reg.bin when it is imported
+sys.path.insert(0, SERVICE_DIR)
+with pytest.MonkeyPatch.context() as mp:
+    mp.chdir(SERVICE_DIR)
+    import app_predict  # pylint: disable=wrong-import-position,unused-import
@@ -0,0 +1,550 @@
+import os
+import json
+import time
+import logging
+import argparse
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+# Computes the three numbers the backfill stores per window (prediction drift,
+# number of drifted columns, share of missing values) without an Evidently
+# Report: the reference data is profiled once and saved to disk, and a window
+# is compared against the profile with a few vectorized NumPy operations.
+#
+# The statistical tests and the default test selection follow Evidently 0.6,
+# so the results match what `calculate_metrics_postgresql` computes with the
+# Report (see `parity_check`).
+
+PROFILE_VERSION = 1
+
+# name -> (default threshold, drift when the score is above the threshold)
+# distances are drifted when score >= threshold, p-values when p < threshold (KS: p <= threshold)
+STATTESTS = {
+    "jensenshannon": (0.1, True),
+    "wasserstein": (0.1, True),
+    "psi": (0.1, True),
+    "ks": (0.05, False),
+    "chisquare": (0.05, False),
+    "z": (0.05, False),
+}
+
+MISSING_STRINGS = ("",)
+
+
+class ColumnProfile:
+    """Reference distribution of one column.
+
+    Numerical columns keep their sorted finite values, which is all the
+    Wasserstein distance, KS test and histograms need. Categorical columns
+    keep the distinct values and their counts.
+    """
+
+    def __init__(self, name, kind, values, counts=None):
+        self.name = name
+        self.kind = kind
+        self.values = values
+        self.counts = counts
+        if kind == "num":
+            self.size = len(values)
+            self.std = float(np.std(values)) if len(values) else 0.0
+            self.unique = np.unique(values)
+        else:
+            self.size = int(counts.sum())
+            self.std = None
+            self.unique = values
+
+    @classmethod
+    def from_series(cls, series, kind):
+        values = finite_values(series)
+        if kind == "num":
+            return cls(series.name, kind, np.sort(values.astype(float)))
+        categories, counts = np.unique(values, return_counts=True)
+        return cls(series.name, kind, categories, counts)
+
+    def counts_for(self, keys):
+        # reference count of every key, 0 for keys the reference never saw
+        if self.kind == "cat":
+            index = np.minimum(np.searchsorted(self.values, keys), len(self.values) - 1)
+            return np.where(self.values[index] == keys, self.counts[index], 0)
+        return np.searchsorted(self.values, keys, side="right") - np.searchsorted(self.values, keys, side="left")
+
+
+class ReferenceProfile:
+    """Profile of the reference dataset, built once and reused for every window."""
+
+    def __init__(self, columns, prediction="prediction"):
+        self.columns = columns
+        self.prediction = prediction
+
+    @classmethod
+    def from_frame(cls, df, categorical_features, prediction="prediction"):
+        # like Evidently's column mapping: the remaining numeric columns are numerical features
+        numerical_features = [
+            column for column in df.columns
+            if column not in categorical_features and column != prediction
+            and pd.api.types.is_numeric_dtype(df[column]) and not pd.api.types.is_bool_dtype(df[column])
+        ]
+        columns = {}
+        for column in [prediction] + numerical_features:
+            columns[column] = ColumnProfile.from_series(df[column], "num")
+        for column in categorical_features:
+            columns[column] = ColumnProfile.from_series(df[column], "cat")
+        return cls(columns, prediction=prediction)
+
+    def save(self, path):
+        arrays = {}
+        meta = {"version": PROFILE_VERSION, "prediction": self.prediction, "columns": []}
+        for i, column in enumerate(self.columns.values()):
+            meta["columns"].append({"name": column.name, "kind": column.kind})
+            arrays[f"values_{i}"] = column.values
+            if column.counts is not None:
+                arrays[f"counts_{i}"] = column.counts
+        np.savez_compressed(path, meta=np.array(json.dumps(meta)), **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            meta = json.loads(str(data["meta"]))
+            if meta["version"] != PROFILE_VERSION:
+                raise ValueError(f"Unsupported profile version {meta['version']} in {path}")
+            columns = {}
+            for i, column in enumerate(meta["columns"]):
+                counts = data[f"counts_{i}"] if f"counts_{i}" in data else None
+                columns[column["name"]] = ColumnProfile(column["name"], column["kind"], data[f"values_{i}"], counts)
+        return cls(columns, prediction=meta["prediction"])
+
+
+def load_or_build_profile(reference_path, profile_path, categorical_features, read_reference=pd.read_csv):
+    """Loads the profile of `reference_path`, (re)building it when it is
+    missing or older than the reference data."""
+    if os.path.exists(profile_path) and os.path.getmtime(profile_path) >= os.path.getmtime(reference_path):
+        return ReferenceProfile.load(profile_path)
+    profile = ReferenceProfile.from_frame(read_reference(reference_path), categorical_features)
+    profile.save(profile_path)
+    logging.info("Reference profile of %s saved to %s", reference_path, profile_path)
+    return profile
+
+
+def finite_values(series):
+    # the values the statistical tests see: no NaN/None, no +-inf
+    values = series.to_numpy()
+    if values.dtype.kind in "iub":
+        return values
+    if values.dtype.kind == "f":
+        return values[np.isfinite(values)]
+    mask = pd.notna(values)
+    values = values[mask]
+    if len(values) and all(isinstance(value, (int, float, np.number)) for value in values):
+        values = values.astype(float)
+        return values[np.isfinite(values)]
+    return values.astype(str)
+
+
+# --- distances and tests, on percents or raw values ---
+
+def _rel_entr(x, y):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(x > 0, x * np.log(x / y), 0.0)
+
+
+def jensenshannon_distance(reference_percents, current_percents):
+    p = reference_percents / reference_percents.sum()
+    q = current_percents / current_percents.sum()
+    m = (p + q) / 2.0
+    return float(np.sqrt((_rel_entr(p, m).sum() + _rel_entr(q, m).sum()) / 2.0))
+
+
+def psi(reference_percents, current_percents):
+    return float(np.sum((reference_percents - current_percents) * np.log(reference_percents / current_percents)))
+
+
+def wasserstein_distance(sorted_reference, current, current_weights=None):
+    # area between the two empirical CDFs; `current_weights` turns the current
+    # values into weighted points, e.g. histogram bins
+    order = np.argsort(current, kind="mergesort")
+    current = current[order]
+    weights = np.ones(len(current)) if current_weights is None else np.asarray(current_weights, dtype=float)[order]
+    current_cumulative = np.concatenate([[0.0], np.cumsum(weights)]) / weights.sum()
+    all_values = np.concatenate([sorted_reference, current])
+    all_values.sort(kind="mergesort")
+    deltas = np.diff(all_values)
+    reference_cdf = np.searchsorted(sorted_reference, all_values[:-1], side="right") / len(sorted_reference)
+    current_cdf = current_cumulative[np.searchsorted(current, all_values[:-1], side="right")]
+    return float(np.sum(np.abs(reference_cdf - current_cdf) * deltas))
+
+
+def _fill_zeroes(percents):
+    nonzero = percents[percents != 0]
+    smallest = nonzero.min()
+    return np.where(percents == 0, smallest / 10**6 if smallest <= 0.0001 else 0.0001, percents)
+
+
+def _percents(reference_counts, reference_size, current_counts, current_size, fill_zeroes):
+    reference_percents = reference_counts / reference_size
+    current_percents = current_counts / current_size
+    if fill_zeroes:
+        reference_percents = _fill_zeroes(reference_percents)
+        current_percents = _fill_zeroes(current_percents)
+    return reference_percents, current_percents
+
+
+def histogram_percents(column, current, fill_zeroes=True):
+    # Sturges bins over both datasets, as Evidently bins numerical columns
+    # with more than 20 distinct reference values
+    low = min(column.values[0], current.min())
+    high = max(column.values[-1], current.max())
+    edges = np.histogram_bin_edges(np.array([low, high]), bins=_sturges_bins(column.size + len(current), low, high))
+    starts = np.searchsorted(column.values, edges[:-1], side="left")
+    end = np.searchsorted(column.values, edges[-1], side="right")
+    reference_counts = np.diff(np.append(starts, end))
+    current_counts = np.histogram(current, edges)[0]
+    return _percents(reference_counts, column.size, current_counts, len(current), fill_zeroes)
+
+
+def _sturges_bins(n, low, high):
+    # same bin count as np.histogram_bin_edges(..., bins="sturges")
+    if high == low:
+        return 1
+    width = (high - low) / (np.log2(n) + 1.0)
+    return int(np.ceil((high - low) / width))
+
+
+def _align_counts(column, keys, counts):
+    # reference and current counts over the union of the distinct values
+    all_keys = np.union1d(column.unique, keys)
+    current_counts = np.zeros(len(all_keys), dtype=float)
+    current_counts[np.searchsorted(all_keys, keys)] = counts
+    return all_keys, column.counts_for(all_keys), current_counts
+
+
+def _z_pvalue(column, keys, reference_counts, current_counts):
+    n1, n2 = column.size, current_counts.sum()
+    if len(column.unique) == 1 and np.count_nonzero(current_counts) == 1 \
+            and keys[current_counts > 0][0] == column.unique[0]:
+        return 1.0
+    p1 = (n1 - reference_counts[0]) / n1
+    p2 = (n2 - current_counts[0]) / n2
+    p = (p1 * n1 + p2 * n2) / (n1 + n2)
+    z = (p1 - p2) / np.sqrt(p * (1 - p) * (1.0 / n1 + 1.0 / n2))
+    return float(2 * (1 - stats.norm.cdf(np.abs(z))))
+
+
+def discrete_score(column, keys, counts, stattest):
+    """Score of a test that compares value counts: `keys` are the distinct
+    current values (sorted) and `counts` how often each occurred."""
+    keys, reference_counts, current_counts = _align_counts(column, keys, counts)
+    size = current_counts.sum()
+    if stattest == "jensenshannon":
+        return jensenshannon_distance(*_percents(reference_counts, column.size, current_counts, size, False))
+    if stattest == "psi":
+        return psi(*_percents(reference_counts, column.size, current_counts, size, True))
+    if stattest == "chisquare":
+        f_exp = reference_counts * (size / column.size)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            statistic = np.sum((current_counts - f_exp) ** 2 / f_exp)
+        return float(stats.chi2.sf(statistic, len(keys) - 1))
+    if stattest == "z":
+        return _z_pvalue(column, keys, reference_counts, current_counts)
+    raise ValueError(f"{stattest!r} does not work on value counts")
+
+
+def default_stattest(column, n_values):
+    # Evidently's choice of test, by reference size and the number of distinct
+    # values in reference and current data together
+    if column.size <= 1000:
+        if column.kind == "num" and n_values > 5:
+            return "ks"
+        return "chisquare" if n_values > 2 else "z"
+    if column.kind == "num" and n_values > 5:
+        return "wasserstein"
+    return "jensenshannon"
+
+
+def is_drifted(stattest, score, threshold=None):
+    default_threshold, distance = STATTESTS[stattest]
+    threshold = default_threshold if threshold is None else threshold
+    if distance:
+        return bool(score >= threshold)
+    if stattest == "ks":
+        return bool(score <= threshold)
+    return bool(score < threshold)
+
+
+def column_drift(column, current_series, stattest=None, threshold=None):
+    """Drift score of one column against its reference profile.
+
+    Returns `(score, drifted, stattest)`; the score is NaN (not drifted) when
+    the current window has no usable values.
+    """
+    current = finite_values(current_series)
+    if column.kind == "num":
+        current = current.astype(float)
+    if not len(current) or not column.size:
+        return float("nan"), False, stattest
+    if stattest is not None and stattest not in STATTESTS:
+        raise ValueError(f"Unknown stattest {stattest!r}, expected one of {sorted(STATTESTS)}")
+    keys, counts = np.unique(current, return_counts=True)
+    stattest = stattest or default_stattest(column, len(np.union1d(column.unique, keys)))
+    if stattest == "wasserstein":
+        score = wasserstein_distance(column.values, current) / max(column.std, 0.001)
+    elif stattest == "ks":
+        score = float(stats.ks_2samp(column.values, current)[1])
+    elif stattest in ("jensenshannon", "psi") and column.kind == "num" and len(column.unique) > 20:
+        score = (jensenshannon_distance(*histogram_percents(column, current, fill_zeroes=False))
+                 if stattest == "jensenshannon" else psi(*histogram_percents(column, current)))
+    else:
+        score = discrete_score(column, keys, counts, stattest)
+    return score, is_drifted(stattest, score, threshold), stattest
+
+
+def missing_cells(df):
+    # missing cells per row: NaN/None/NaT, +-inf and empty strings
+    missing = np.zeros(len(df), dtype=np.int64)
+    for column in df.columns:
+        values = df[column].to_numpy()
+        if values.dtype.kind == "f":
+            missing += ~np.isfinite(values)
+        elif values.dtype.kind in "iub":
+            continue
+        else:
+            mask = pd.isna(values)
+            if values.dtype == object:
+                mask |= np.isin(values, MISSING_STRINGS + (np.inf, -np.inf))
+            missing += mask
+    return missing
+
+
+def share_missing_values(df):
+    # over all cells of the window
+    if df.empty:
+        return 0.0
+    return int(missing_cells(df).sum()) / (df.shape[0] * df.shape[1])
+
+
+def calculate_metrics(profile, current_data, stattest=None):
+    """The metrics of one window, same keys as `calculate_metrics_postgresql`.
+
+    `stattest` forces one test (e.g. "psi") for every column instead of
+    Evidently's default selection.
+    """
+    drift = {
+        name: column_drift(column, current_data[name], stattest=stattest)
+        for name, column in profile.columns.items()
+    }
+    return {
+        "prediction_drift": drift[profile.prediction][0],
+        "num_drifted_columns": sum(drifted for _, drifted, _ in drift.values()),
+        "share_missing_values": share_missing_values(current_data)
+    }
+
+
+class GroupedReference:
+    """Reference data split by a group column (e.g. `store`), prepared once so
+    every group of a window is compared with its own reference in a single
+    vectorized pass, however many groups there are.
+
+    Numerical columns use the normed Wasserstein distance and categorical
+    ones the Jensen-Shannon distance: the tests Evidently picks for the global
+    metrics, applied per group.
+    """
+
+    def __init__(self, df, group, categorical_features, prediction="prediction"):
+        self.group = group
+        self.prediction = prediction
+        self.categorical_features = [column for column in categorical_features if column != group]
+        self.numerical_features = [prediction] + [
+            column for column in df.columns
+            if column not in categorical_features and column not in (prediction, group)
+            and pd.api.types.is_numeric_dtype(df[column]) and not pd.api.types.is_bool_dtype(df[column])
+        ]
+        keys = group_keys(df, group)
+        self.groups = np.unique(keys[~np.isnan(keys)])
+        self.columns = {}
+        for column in self.numerical_features + self.categorical_features:
+            values = df[column].to_numpy(dtype=float)
+            keep = np.isfinite(values) & ~np.isnan(keys)
+            self.columns[column] = (keys[keep], values[keep])
+
+    def group_ids(self, keys):
+        # position of every (non-missing) key in the union of reference and current groups
+        groups = np.union1d(self.groups, keys)
+        return groups, np.searchsorted(groups, keys)
+
+
+def group_keys(df, group):
+    # groups are numeric ids such as store numbers
+    return pd.to_numeric(df[group], errors="coerce").to_numpy(dtype=float)
+
+
+def _grouped_wasserstein(groups, reference_ids, reference_values, current_ids, current_values):
+    # per group: area between the reference and current CDFs, normed by the
+    # reference std; all groups are sorted and summed together
+    n = len(groups)
+    ids = np.concatenate([reference_ids, current_ids])
+    values = np.concatenate([reference_values, current_values])
+    is_reference = np.concatenate([np.ones(len(reference_ids)), np.zeros(len(current_ids))])
+    order = np.lexsort((values, ids))
+    ids, values, is_reference = ids[order], values[order], is_reference[order]
+
+    reference_size = np.bincount(reference_ids, minlength=n).astype(float)
+    current_size = np.bincount(current_ids, minlength=n).astype(float)
+    group_start = np.searchsorted(ids, np.arange(n))
+    reference_cumulative = np.cumsum(is_reference)
+    current_cumulative = np.cumsum(1 - is_reference)
+    before = group_start[ids] - 1
+    reference_seen = reference_cumulative - np.where(before >= 0, reference_cumulative[np.maximum(before, 0)], 0)
+    current_seen = current_cumulative - np.where(before >= 0, current_cumulative[np.maximum(before, 0)], 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        difference = np.abs(reference_seen / reference_size[ids] - current_seen / current_size[ids])
+    deltas = np.zeros(len(values))
+    same_group = ids[1:] == ids[:-1]
+    deltas[:-1] = np.where(same_group, np.diff(values), 0.0)
+    distance = np.bincount(ids, weights=np.nan_to_num(difference) * deltas, minlength=n)
+
+    mean = np.bincount(reference_ids, weights=reference_values, minlength=n) / np.maximum(reference_size, 1)
+    variance = np.bincount(reference_ids, weights=(reference_values - mean[reference_ids]) ** 2, minlength=n) \
+        / np.maximum(reference_size, 1)
+    distance = distance / np.maximum(np.sqrt(variance), 0.001)
+    distance[(reference_size == 0) | (current_size == 0)] = np.nan
+    return distance
+
+
+def _grouped_jensenshannon(groups, reference_ids, reference_values, current_ids, current_values):
+    # per group Jensen-Shannon distance of the value frequencies
+    n = len(groups)
+    categories, codes = np.unique(np.concatenate([reference_values, current_values]), return_inverse=True)
+    k = len(categories)
+    reference_codes, current_codes = codes[:len(reference_values)], codes[len(reference_values):]
+    reference_counts = np.bincount(reference_ids * k + reference_codes, minlength=n * k).reshape(n, k).astype(float)
+    current_counts = np.bincount(current_ids * k + current_codes, minlength=n * k).reshape(n, k).astype(float)
+    reference_size = reference_counts.sum(axis=1, keepdims=True)
+    current_size = current_counts.sum(axis=1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        p = reference_counts / reference_size
+        q = current_counts / current_size
+        m = (p + q) / 2.0
+        distance = np.sqrt((_rel_entr(p, m).sum(axis=1) + _rel_entr(q, m).sum(axis=1)) / 2.0)
+    distance[(reference_size[:, 0] == 0) | (current_size[:, 0] == 0)] = np.nan
+    return distance
+
+
+def grouped_metrics(reference, current_data, target="sales"):
+    """Drift, missing share and (when `target` is present) RMSE/MAPE of the
+    prediction for every group of one window, e.g. per store.
+
+    Returns a DataFrame with one row per group present in the window.
+    """
+    keys = group_keys(current_data, reference.group)
+    present = ~np.isnan(keys)
+    groups, ids = reference.group_ids(keys[present])
+    n = len(groups)
+    num_rows = np.bincount(ids, minlength=n)
+    num_drifted_columns = np.zeros(n, dtype=np.int64)
+    prediction_drift = np.full(n, np.nan)
+    for column in reference.numerical_features + reference.categorical_features:
+        if column not in current_data:
+            continue
+        reference_keys, reference_values = reference.columns[column]
+        reference_ids = np.searchsorted(groups, reference_keys)
+        values = current_data[column].to_numpy(dtype=float)[present]
+        keep = np.isfinite(values)
+        if column in reference.categorical_features:
+            distance = _grouped_jensenshannon(groups, reference_ids, reference_values, ids[keep], values[keep])
+            drifted = distance >= STATTESTS["jensenshannon"][0]
+        else:
+            distance = _grouped_wasserstein(groups, reference_ids, reference_values, ids[keep], values[keep])
+            drifted = distance >= STATTESTS["wasserstein"][0]
+        num_drifted_columns += drifted
+        if column == reference.prediction:
+            prediction_drift = distance
+
+    missing = np.bincount(ids, weights=missing_cells(current_data)[present], minlength=n)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        share_missing = missing / (num_rows * current_data.shape[1])
+    rmse = mape = np.full(n, np.nan)
+    if target in current_data:
+        actual = current_data[target].to_numpy(dtype=float)[present]
+        predicted = current_data[reference.prediction].to_numpy(dtype=float)[present]
+        scored = np.isfinite(actual) & np.isfinite(predicted)
+        error = (predicted - actual)[scored]
+        scored_ids = ids[scored]
+        scored_rows = np.bincount(scored_ids, minlength=n)
+        nonzero = actual[scored] != 0
+        percentage_rows = np.bincount(scored_ids[nonzero], minlength=n)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rmse = np.sqrt(np.bincount(scored_ids, weights=error ** 2, minlength=n) / scored_rows)
+            mape = np.bincount(scored_ids[nonzero], weights=np.abs(error[nonzero] / actual[scored][nonzero]),
+                               minlength=n) / percentage_rows
+
+    result = pd.DataFrame({
+        reference.group: groups,
+        "num_rows": num_rows,
+        "prediction_drift": prediction_drift,
+        "num_drifted_columns": num_drifted_columns,
+        "share_missing_values": share_missing,
+        "rmse": rmse,
+        "mape": mape
+    })
+    return result[result.num_rows > 0].reset_index(drop=True)
+
+
+def parity_check(reference_data, windows, categorical_features, tolerance=1e-6):
+    """Runs the Evidently Report and the native engine on the same windows
+    and returns the largest absolute difference per metric."""
+    # the backfill flow holds the Report setup, only needed for the check
+    from evidently_metrics_calculation_psql_Prefect import calculate_metrics_postgresql
+
+    profile = ReferenceProfile.from_frame(reference_data, categorical_features)
+    differences = {"prediction_drift": 0.0, "num_drifted_columns": 0.0, "share_missing_values": 0.0}
+    evidently_seconds = native_seconds = 0.0
+    for window_start, current_data in windows:
+        started = time.perf_counter()
+        expected = calculate_metrics_postgresql.fn(reference_data=reference_data, current_data=current_data)
+        evidently_seconds += time.perf_counter() - started
+        started = time.perf_counter()
+        actual = calculate_metrics(profile, current_data)
+        native_seconds += time.perf_counter() - started
+        for key in differences:
+            difference = abs(float(expected[key]) - float(actual[key]))
+            if difference > tolerance:
+                logging.warning("%s %s: evidently %s, native %s", window_start, key, expected[key], actual[key])
+            differences[key] = max(differences[key], difference)
+    logging.info("%d windows: evidently %.3fs, native %.3fs", len(windows), evidently_seconds, native_seconds)
+    return differences
+
+
+def run():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s]: %(message)s")
+    parser = argparse.ArgumentParser(description="build the reference profile or compare the native drift engine with Evidently")
+    parser.add_argument("command", choices=["profile", "parity"])
+    parser.add_argument("--reference", default="./input_data/reference.csv")
+    parser.add_argument("--profile", default="./input_data/reference_profile.npz")
+    parser.add_argument("--days", type=int, default=30, help="parity: number of daily windows from 2022-01-01")
+    parser.add_argument("--tolerance", type=float, default=1e-6)
+    args = parser.parse_args()
+
+    import evidently_metrics_calculation_psql_Prefect as backfill
+
+    if args.command == "profile":
+        profile = ReferenceProfile.from_frame(backfill.read_ref_csv.fn(args.reference), backfill.categorical_features)
+        profile.save(args.profile)
+        logging.info("Reference profile saved to %s", args.profile)
+        return
+
+    reference_data = backfill.read_ref_csv.fn(args.reference)
+    raw_data = backfill.read_raw_csv.fn("./input_data/store_sales.csv")
+    raw_data = backfill.add_predictions.fn(raw_data, backfill.load_model.fn("./models/lin_reg.bin"))
+    end = backfill.begin + pd.Timedelta(days=args.days)
+    windows = backfill.split_windows.fn(raw_data, backfill.begin, end, pd.Timedelta("1D"))
+    differences = parity_check(reference_data, windows, backfill.categorical_features, args.tolerance)
+    logging.info("largest differences: %s", differences)
+    if any(difference > args.tolerance for difference in differences.values()):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    run()
+
+# python drift_engine.py parity --days 90
@@ -1,6 +1,10 @@
 import datetime
 import time
 import logging 
+import os
+import argparse
+from typing import Optional
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import psycopg
 import joblib
@@ -11,19 +15,65 @@ from evidently.report import Report
 from evidently import ColumnMapping
 from evidently.metrics import ColumnDriftMetric, DatasetDriftMetric, DatasetMissingValuesMetric
 
+import drift_engine
+
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s]: %(message)s")
 
+# seconds between two windows when simulating a live feed, 0 for a plain backfill
 SEND_TIMEOUT = 10
 
+# one row per window start: reruns overwrite instead of adding duplicates
 create_table_statement = """
-drop table if exists store_metrics;
-create table store_metrics(
-	timestamp timestamp,
+create table if not exists store_metrics(
+	timestamp timestamp primary key,
 	prediction_drift float,
 	num_drifted_columns integer,
 	share_missing_values float
-)
+);
+-- tables created by older versions had no key: drop duplicates, then add one
+delete from store_metrics a using store_metrics b
+where a.timestamp = b.timestamp and a.ctid < b.ctid;
+create unique index if not exists store_metrics_timestamp_key on store_metrics (timestamp);
+
+-- the same window, broken down per store
+create table if not exists store_metrics_by_store(
+	timestamp timestamp not null,
+	store integer not null,
+	num_rows integer,
+	prediction_drift float,
+	num_drifted_columns integer,
+	share_missing_values float,
+	rmse float,
+	mape float,
+	primary key (timestamp, store)
+);
 """
+
+# all rows of a batch in one statement, as arrays
+upsert_metrics_statement = """
+insert into store_metrics(timestamp, prediction_drift, num_drifted_columns, share_missing_values)
+select * from unnest(%s::timestamp[], %s::float[], %s::integer[], %s::float[])
+on conflict (timestamp) do update set
+	prediction_drift = excluded.prediction_drift,
+	num_drifted_columns = excluded.num_drifted_columns,
+	share_missing_values = excluded.share_missing_values
+"""
+
+upsert_store_metrics_statement = """
+insert into store_metrics_by_store(timestamp, store, num_rows, prediction_drift, num_drifted_columns,
+	share_missing_values, rmse, mape)
+select * from unnest(%s::timestamp[], %s::integer[], %s::integer[], %s::float[], %s::integer[],
+	%s::float[], %s::float[], %s::float[])
+on conflict (timestamp, store) do update set
+	num_rows = excluded.num_rows,
+	prediction_drift = excluded.prediction_drift,
+	num_drifted_columns = excluded.num_drifted_columns,
+	share_missing_values = excluded.share_missing_values,
+	rmse = excluded.rmse,
+	mape = excluded.mape
+"""
+STORE_METRICS_COLUMNS = ["store", "num_rows", "prediction_drift", "num_drifted_columns",
+                         "share_missing_values", "rmse", "mape"]
 @task
 def load_model(model_path):
 	with open(model_path, 'rb') as f_in:
@@ -60,6 +110,8 @@ def read_ref_csv(ref_data):
     
 
 begin = datetime.datetime(2022, 1, 1, 0, 0)
+ENGINES = ("native", "evidently")
+BACKFILL_DAYS = 30
 categorical_features = ["store", "promo", "holiday", "year", "month", "dayofweek", "is_weekend"]
 
 column_mapping = ColumnMapping(
@@ -84,9 +136,20 @@ def prep_db():
 			conn.execute(create_table_statement)
 
 @task
-def calculate_metrics_postgresql(reference_data, current_data, model):
-    
-    current_data['prediction'] = model.predict(current_data[categorical_features].fillna(0))
+def add_predictions(df, model):
+    # one vectorized prediction for the whole backfill instead of one per window
+    df["prediction"] = model.predict(df[categorical_features].fillna(0))
+    return df
+
+@task
+def split_windows(df, start, end, window):
+    # single pass: every row gets the start of its window, then one sort-based groupby
+    df = df[(df.date >= start) & (df.date < end)]
+    window_start = start + ((df.date - start) // window) * window
+    return [(timestamp.to_pydatetime(), group) for timestamp, group in df.groupby(window_start, sort=True)]
+
+@task
+def calculate_metrics_postgresql(reference_data, current_data):
 
     report.run(
         reference_data=reference_data,
@@ -104,46 +167,130 @@ def calculate_metrics_postgresql(reference_data, current_data, model):
         "share_missing_values": share_missing_values
     }
 
+# --- process pool workers: the reference data is read once per worker process ---
+_worker_reference_data = None
+_worker_engine = None
+_worker_store_reference = None
+
+def init_worker(ref_data_path, engine, profile_path, by_store):
+    global _worker_reference_data, _worker_engine, _worker_store_reference
+    _worker_engine = engine
+    reference_data = read_ref_csv.fn(ref_data_path)
+    if engine == "native":
+        _worker_reference_data = drift_engine.ReferenceProfile.load(profile_path)
+    else:
+        _worker_reference_data = reference_data
+    if by_store:
+        _worker_store_reference = drift_engine.GroupedReference(reference_data, "store", categorical_features)
+
+def evaluate_window(current_data):
+    if _worker_engine == "native":
+        metrics = drift_engine.calculate_metrics(_worker_reference_data, current_data)
+    else:
+        metrics = calculate_metrics_postgresql.fn(reference_data=_worker_reference_data,
+                                                  current_data=current_data)
+    # all stores of the window in one grouped pass
+    by_store = None
+    if _worker_store_reference is not None:
+        by_store = drift_engine.grouped_metrics(_worker_store_reference, current_data)
+    return metrics, by_store
+
+def write_metrics(conn, rows, store_rows):
+    # rows: (timestamp, prediction_drift, num_drifted_columns, share_missing_values)
+    # store_rows: (timestamp, per-store DataFrame) for the same windows
+    with conn.transaction():
+        conn.execute(upsert_metrics_statement, [list(column) for column in zip(*rows)])
+        if store_rows:
+            by_store = pd.concat([frame.assign(timestamp=timestamp) for timestamp, frame in store_rows])
+            # NaN (e.g. no reference for a new store) is stored as NULL
+            by_store = by_store.astype(object).where(by_store.notna(), None)
+            conn.execute(upsert_store_metrics_statement,
+                         [by_store["timestamp"].tolist()] + [by_store[column].tolist() for column in STORE_METRICS_COLUMNS])
+
 @flow
-def batch_monitoring_backfill():
+def batch_monitoring_backfill(start: datetime.datetime = begin,
+                              end: Optional[datetime.datetime] = None,
+                              window: str = "1D",
+                              send_timeout: float = 0,
+                              workers: Optional[int] = None,
+                              insert_batch_size: int = 100,
+                              engine: str = "native",
+                              by_store: bool = True):
+    """Computes the monitoring metrics for every `window` (a pandas offset
+    such as "1D" or "6h") between `start` and `end` (default: 30 days later).
+    Windows without data are skipped.
+
+    The windows are evaluated by `workers` processes (default: one per CPU)
+    and the results are upserted `insert_batch_size` windows at a time.
+
+    `engine="native"` compares the windows with a cached profile of the
+    reference data (drift_engine.py), `engine="evidently"` runs the full
+    Evidently Report per window; both give the same numbers.
+
+    With `by_store` the drift, missing share, RMSE and MAPE of every store
+    are written to store_metrics_by_store as well."""
+    if engine not in ENGINES:
+        raise ValueError(f"engine must be one of {ENGINES}, got {engine!r}")
     raw_data_path = "./input_data/store_sales.csv"
     ref_data_path = "./input_data/reference.csv"
+    profile_path = "./input_data/reference_profile.npz"
     model_path = "./models/lin_reg.bin"
+    end = end or start + datetime.timedelta(days=BACKFILL_DAYS)
+    window = pd.Timedelta(window)
+    if send_timeout:
+        # simulating a live feed: one window at a time
+        insert_batch_size = 1
     
     processed_raw_data = read_raw_csv(raw_data_path)
-    reference_data = read_ref_csv(ref_data_path)
     loaded_model = load_model(model_path)
+    processed_raw_data = add_predictions(processed_raw_data, loaded_model)
+    windows = split_windows(processed_raw_data, start, end, window)
+    window_starts = [window_start for window_start, _ in windows]
+    window_data = [current_data for _, current_data in windows]
+    if engine == "native":
+        # built once here, the workers only load it
+        drift_engine.load_or_build_profile(ref_data_path, profile_path, categorical_features,
+                                           read_reference=read_ref_csv.fn)
     
     prep_db()
-    with psycopg.connect("host=localhost port=5432 dbname=store_sales_db user=postgres password=admin", autocommit=True) as conn:
-        # Select 1-day data
-        for i in range(30):
-            current_data = processed_raw_data[
-			(processed_raw_data.date >= (begin + datetime.timedelta(i))) &
-			(processed_raw_data.date < (begin + datetime.timedelta(i + 1)))
-			]
-            
-            # Task: compute metrics
-            metrics = calculate_metrics_postgresql(reference_data= reference_data, 
-                                                   current_data=current_data,
-                                                   model= loaded_model)
-            
-            with conn.cursor() as curr:
-                curr.execute(
-					"""
-					INSERT INTO store_metrics(timestamp, prediction_drift, num_drifted_columns, share_missing_values)
-					VALUES (%s, %s, %s, %s)
-					""",
-					(
-						begin + datetime.timedelta(i),
-						metrics["prediction_drift"],
-						metrics["num_drifted_columns"],
-						metrics["share_missing_values"]
-					)
-				)
-                
-            logging.info("data sent to PostgreSQL")
-            time.sleep(SEND_TIMEOUT)
+    with psycopg.connect("host=localhost port=5432 dbname=store_sales_db user=postgres password=admin", autocommit=True) as conn, \
+            ProcessPoolExecutor(max_workers=workers or os.cpu_count(),
+                                initializer=init_worker, initargs=(ref_data_path, engine, profile_path, by_store)) as executor:
+        batch, store_batch = [], []
+        # map keeps the window order while the workers run ahead
+        for window_start, (metrics, store_metrics) in zip(window_starts, executor.map(evaluate_window, window_data)):
+            batch.append((
+                window_start,
+                metrics["prediction_drift"],
+                metrics["num_drifted_columns"],
+                metrics["share_missing_values"]
+            ))
+            if store_metrics is not None:
+                store_batch.append((window_start, store_metrics))
+            if len(batch) >= insert_batch_size:
+                write_metrics(conn, batch, store_batch)
+                logging.info("%d windows sent to PostgreSQL", len(batch))
+                batch, store_batch = [], []
+            if send_timeout:
+                # only to simulate a live feed for the dashboards
+                time.sleep(send_timeout)
+        if batch:
+            write_metrics(conn, batch, store_batch)
+            logging.info("%d windows sent to PostgreSQL", len(batch))
 
 if __name__ == '__main__':
-	batch_monitoring_backfill()
+    parser = argparse.ArgumentParser(description="backfill store_metrics with Evidently drift metrics")
+    parser.add_argument("--start", type=datetime.datetime.fromisoformat, default=begin)
+    parser.add_argument("--end", type=datetime.datetime.fromisoformat, default=None)
+    parser.add_argument("--window", default="1D", help="window size as a pandas offset, e.g. 1D, 12h, 7D")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, default: number of CPUs")
+    parser.add_argument("--engine", choices=ENGINES, default="native",
+                        help="native: cached reference profile, evidently: full Evidently Report per window")
+    parser.add_argument("--no-by-store", action="store_true", help="skip the per-store breakdown")
+    parser.add_argument("--simulate-live", action="store_true",
+                        help=f"wait {SEND_TIMEOUT}s between windows like a live feed")
+    args = parser.parse_args()
+
+    batch_monitoring_backfill(start=args.start, end=args.end, window=args.window, workers=args.workers,
+                              engine=args.engine, by_store=not args.no_by_store,
+                              send_timeout=SEND_TIMEOUT if args.simulate_live else 0)
@@ -0,0 +1,376 @@
+import json
+import time
+import logging
+import argparse
+from collections import deque
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+import psycopg
+
+import drift_engine
+
+# Near-real-time drift metrics over prediction_logs.
+#
+# The monitor tails prediction_logs by `ingested_at` (like the hourly rollups
+# in prediction_service/schema.py) and only ever reads the new rows. Rows are
+# counted into fixed panes of `pane_seconds` by their `timestamp`; a pane keeps
+# category counts and a histogram of the predictions, never the rows. Once a
+# pane is older than the watermark it is closed and added to
+#   - the current tumbling window (written to store_metrics_tumbling when it
+#     is full; store_metrics holds the daily windows of the backfill)
+#   - a sliding window of the last N panes (written to store_metrics_sliding
+#     after every pane), kept as a running sum: the newest pane is added, the
+#     pane falling out of the window is subtracted.
+# The open panes, the sliding window and the `ingested_at` watermark are
+# saved in one transaction with the emitted metrics, so a restart neither
+# re-reads old rows nor loses or duplicates windows.
+
+CATEGORICAL_FEATURES = ["store", "promo", "holiday", "year", "month", "dayofweek", "is_weekend"]
+MONITORED_COLUMNS = CATEGORICAL_FEATURES + ["prediction"]
+
+create_table_statement = """
+create table if not exists store_metrics_tumbling(
+	timestamp timestamp not null,
+	window_seconds integer not null,
+	num_rows bigint,
+	prediction_drift float,
+	num_drifted_columns integer,
+	share_missing_values float,
+	primary key (timestamp, window_seconds)
+);
+create table if not exists store_metrics_sliding(
+	timestamp timestamp not null,
+	window_seconds integer not null,
+	num_rows bigint,
+	prediction_drift float,
+	num_drifted_columns integer,
+	share_missing_values float,
+	primary key (timestamp, window_seconds)
+);
+create table if not exists drift_monitor_state(
+	name text primary key,
+	ingested_until timestamp not null,
+	state jsonb not null
+);
+"""
+
+upsert_tumbling_statement = """
+insert into store_metrics_tumbling(timestamp, window_seconds, num_rows, prediction_drift, num_drifted_columns, share_missing_values)
+values (%s, %s, %s, %s, %s, %s)
+on conflict (timestamp, window_seconds) do update set
+	num_rows = excluded.num_rows,
+	prediction_drift = excluded.prediction_drift,
+	num_drifted_columns = excluded.num_drifted_columns,
+	share_missing_values = excluded.share_missing_values
+"""
+
+upsert_sliding_statement = """
+insert into store_metrics_sliding(timestamp, window_seconds, num_rows, prediction_drift, num_drifted_columns, share_missing_values)
+values (%s, %s, %s, %s, %s, %s)
+on conflict (timestamp, window_seconds) do update set
+	num_rows = excluded.num_rows,
+	prediction_drift = excluded.prediction_drift,
+	num_drifted_columns = excluded.num_drifted_columns,
+	share_missing_values = excluded.share_missing_values
+"""
+
+EPOCH = np.datetime64(0, "s")
+
+
+class PaneCounts:
+    """Additive summary of the rows of one pane (or of several merged panes).
+
+    `histogram` counts the predictions below the reference range, in each of
+    the bins over the reference range and above it; `overflow_sums` keeps the
+    sum of the values below/above so they can be placed at their mean.
+    """
+
+    def __init__(self, bins):
+        self.rows = 0
+        self.missing = 0
+        self.categories = {column: {} for column in CATEGORICAL_FEATURES}
+        self.histogram = np.zeros(bins + 2)
+        self.overflow_sums = np.zeros(2)
+
+    def add(self, frame, edges):
+        self.rows += len(frame)
+        self.missing += int(frame[MONITORED_COLUMNS].isna().to_numpy().sum())
+        for column in CATEGORICAL_FEATURES:
+            values = frame[column].dropna().to_numpy(dtype=float)
+            counts = self.categories[column]
+            for value, count in zip(*np.unique(values, return_counts=True)):
+                counts[float(value)] = counts.get(float(value), 0) + int(count)
+        predictions = frame["prediction"].dropna().to_numpy(dtype=float)
+        below = predictions < edges[0]
+        above = predictions > edges[-1]
+        inside = predictions[~below & ~above]
+        self.histogram[0] += np.count_nonzero(below)
+        self.histogram[-1] += np.count_nonzero(above)
+        self.histogram[1:-1] += np.histogram(inside, edges)[0]
+        self.overflow_sums += (predictions[below].sum(), predictions[above].sum())
+
+    def merge(self, other, sign=1):
+        self.rows += sign * other.rows
+        self.missing += sign * other.missing
+        for column, other_counts in other.categories.items():
+            counts = self.categories[column]
+            for value, count in other_counts.items():
+                total = counts.get(value, 0) + sign * count
+                if total:
+                    counts[value] = total
+                else:
+                    counts.pop(value, None)
+        self.histogram += sign * other.histogram
+        self.overflow_sums += sign * other.overflow_sums
+
+    def to_dict(self):
+        return {
+            "rows": self.rows,
+            "missing": self.missing,
+            "categories": {column: [[value, count] for value, count in counts.items()]
+                           for column, counts in self.categories.items()},
+            "histogram": self.histogram.tolist(),
+            "overflow_sums": self.overflow_sums.tolist()
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        pane = cls(len(data["histogram"]) - 2)
+        pane.rows = data["rows"]
+        pane.missing = data["missing"]
+        pane.categories = {column: {value: count for value, count in pairs}
+                           for column, pairs in data["categories"].items()}
+        pane.histogram = np.array(data["histogram"], dtype=float)
+        pane.overflow_sums = np.array(data["overflow_sums"], dtype=float)
+        return pane
+
+
+def window_metrics(profile, counts, edges):
+    """Drift metrics of a window from its counts.
+
+    Categorical columns get the same tests as the batch engine. The
+    prediction drift is the normed Wasserstein distance with the window's
+    predictions taken at their bin centres (the values beyond the reference
+    range at their mean), so it is accurate to about half a bin width.
+    """
+    num_drifted_columns = 0
+    for column in CATEGORICAL_FEATURES:
+        values = counts.categories[column]
+        if not values:
+            continue
+        reference = profile.columns[column]
+        keys = np.array(sorted(values))
+        stattest = drift_engine.default_stattest(reference, len(np.union1d(reference.unique, keys)))
+        score = drift_engine.discrete_score(reference, keys, np.array([values[key] for key in keys]), stattest)
+        num_drifted_columns += drift_engine.is_drifted(stattest, score)
+
+    prediction = profile.columns[profile.prediction]
+    prediction_drift = float("nan")
+    if counts.histogram.sum() > 0:
+        below, above = counts.histogram[0], counts.histogram[-1]
+        points = np.concatenate([
+            [counts.overflow_sums[0] / below if below else edges[0]],
+            (edges[:-1] + edges[1:]) / 2,
+            [counts.overflow_sums[1] / above if above else edges[-1]]
+        ])
+        weights = counts.histogram
+        keep = weights > 0
+        prediction_drift = drift_engine.wasserstein_distance(prediction.values, points[keep], weights[keep]) \
+            / max(prediction.std, 0.001)
+        num_drifted_columns += drift_engine.is_drifted("wasserstein", prediction_drift)
+
+    return {
+        "prediction_drift": prediction_drift,
+        "num_drifted_columns": num_drifted_columns,
+        "share_missing_values": counts.missing / (counts.rows * len(MONITORED_COLUMNS)) if counts.rows else 0.0
+    }
+
+
+class OnlineDriftMonitor:
+    """Incremental tumbling and sliding drift windows over a stream of rows.
+
+    Windows are aligned to multiples of their size since the epoch;
+    `tumbling_seconds` and `sliding_seconds` must be multiples of
+    `pane_seconds`. Rows for a pane that is already closed are counted in
+    `late_rows` and ignored.
+    """
+
+    def __init__(self, profile, pane_seconds=60, tumbling_seconds=3600, sliding_seconds=900, bins=200):
+        if tumbling_seconds % pane_seconds or sliding_seconds % pane_seconds:
+            raise ValueError("tumbling_seconds and sliding_seconds must be multiples of pane_seconds")
+        self.profile = profile
+        self.pane_seconds = pane_seconds
+        self.tumbling_seconds = tumbling_seconds
+        self.tumbling_panes = tumbling_seconds // pane_seconds
+        self.sliding_seconds = sliding_seconds
+        reference = profile.columns[profile.prediction].values
+        self.edges = np.linspace(reference[0], reference[-1], bins + 1)
+        self.bins = bins
+        self.open_panes = {}
+        self.next_pane = None
+        self.sliding = deque(maxlen=sliding_seconds // pane_seconds)
+        self.sliding_total = PaneCounts(bins)
+        self.tumbling_total = PaneCounts(bins)
+        self.late_rows = 0
+
+    def pane_start(self, pane):
+        return (EPOCH + np.timedelta64(pane * self.pane_seconds, "s")).astype(object)
+
+    def add(self, frame):
+        if frame.empty:
+            return
+        seconds = (frame["timestamp"].to_numpy(dtype="datetime64[s]") - EPOCH).astype(np.int64)
+        panes = seconds // self.pane_seconds
+        if self.next_pane is None:
+            self.next_pane = int(panes.min())
+        late = panes < self.next_pane
+        self.late_rows += int(np.count_nonzero(late))
+        for pane in np.unique(panes[~late]):
+            counts = self.open_panes.setdefault(int(pane), PaneCounts(self.bins))
+            counts.add(frame[panes == pane], self.edges)
+
+    def advance(self, watermark):
+        """Closes every pane that ends before `watermark` and returns the
+        windows that closed: `(tumbling, sliding)` lists of
+        `(timestamp, num_rows, metrics)`."""
+        tumbling, sliding = [], []
+        if self.next_pane is None:
+            return tumbling, sliding
+        end_pane = int((np.datetime64(watermark, "s") - EPOCH).astype(np.int64)) // self.pane_seconds
+        while self.next_pane < end_pane:
+            if self.sliding_total.rows == 0 and self.tumbling_total.rows == 0:
+                # nothing in flight: jump over the idle panes at once
+                waiting = [pane for pane in self.open_panes if pane < end_pane]
+                if not waiting:
+                    self.next_pane = end_pane
+                    self.sliding.clear()
+                    break
+                if min(waiting) > self.next_pane:
+                    self.next_pane = min(waiting)
+                    self.sliding.clear()
+            pane = self.next_pane
+            counts = self.open_panes.pop(pane, None)
+            if len(self.sliding) == self.sliding.maxlen:
+                expired = self.sliding.popleft()
+                if expired is not None:
+                    self.sliding_total.merge(expired, sign=-1)
+            self.sliding.append(counts)
+            if counts is not None:
+                self.sliding_total.merge(counts)
+                self.tumbling_total.merge(counts)
+            self.next_pane += 1
+
+            window_end = self.pane_start(self.next_pane)
+            if self.sliding_total.rows:
+                sliding.append((window_end, self.sliding_total.rows,
+                                window_metrics(self.profile, self.sliding_total, self.edges)))
+            if self.next_pane % self.tumbling_panes == 0:
+                if self.tumbling_total.rows:
+                    tumbling.append((self.pane_start(self.next_pane - self.tumbling_panes), self.tumbling_total.rows,
+                                     window_metrics(self.profile, self.tumbling_total, self.edges)))
+                self.tumbling_total = PaneCounts(self.bins)
+        return tumbling, sliding
+
+    def to_state(self):
+        return {
+            "next_pane": self.next_pane,
+            "open_panes": {str(pane): counts.to_dict() for pane, counts in self.open_panes.items()},
+            "sliding": [None if counts is None else counts.to_dict() for counts in self.sliding],
+            "tumbling": self.tumbling_total.to_dict(),
+            "late_rows": self.late_rows
+        }
+
+    def load_state(self, state):
+        self.next_pane = state["next_pane"]
+        self.open_panes = {int(pane): PaneCounts.from_dict(counts) for pane, counts in state["open_panes"].items()}
+        self.sliding.clear()
+        self.sliding_total = PaneCounts(self.bins)
+        for counts in state["sliding"]:
+            counts = None if counts is None else PaneCounts.from_dict(counts)
+            self.sliding.append(counts)
+            if counts is not None:
+                self.sliding_total.merge(counts)
+        self.tumbling_total = PaneCounts.from_dict(state["tumbling"])
+        self.late_rows = state["late_rows"]
+
+
+def poll(conn, monitor, name="default", lag=timedelta(seconds=5), lateness=timedelta(minutes=2),
+         chunk_rows=50000):
+    """Reads the rows ingested since the last poll, closes the panes older
+    than `lateness` and writes the closed windows, all in one transaction.
+
+    The saved state is loaded into `monitor` on the first poll; a monitor
+    without saved state starts with the rows ingested after that poll.
+    Returns the number of new rows and of written windows.
+    """
+    rows = 0
+    with conn.transaction():
+        # database clock, the same one that sets ingested_at
+        until = conn.execute("SELECT clock_timestamp()::timestamp - %s", (lag,)).fetchone()[0]
+        saved = conn.execute(
+            "SELECT ingested_until, state FROM drift_monitor_state WHERE name = %s FOR UPDATE", (name,)
+        ).fetchone()
+        since = saved[0] if saved else until
+        if saved and monitor.next_pane is None:
+            monitor.load_state(saved[1])
+        if since < until:
+            # server-side cursor: the new rows are counted chunk by chunk
+            with conn.cursor(name="drift_monitor_rows") as cur:
+                cur.execute(
+                    f"SELECT timestamp, {', '.join(MONITORED_COLUMNS)} FROM prediction_logs "
+                    "WHERE ingested_at >= %s AND ingested_at < %s",
+                    (since, until)
+                )
+                while chunk := cur.fetchmany(chunk_rows):
+                    monitor.add(pd.DataFrame(chunk, columns=["timestamp"] + MONITORED_COLUMNS))
+                    rows += len(chunk)
+        tumbling, sliding = monitor.advance(until - lateness)
+        for window_start, num_rows, metrics in tumbling:
+            conn.execute(upsert_tumbling_statement, (window_start, monitor.tumbling_seconds, num_rows,
+                                                     metrics["prediction_drift"], metrics["num_drifted_columns"],
+                                                     metrics["share_missing_values"]))
+        for window_end, num_rows, metrics in sliding:
+            conn.execute(upsert_sliding_statement, (window_end, monitor.sliding_seconds, num_rows,
+                                                    metrics["prediction_drift"], metrics["num_drifted_columns"],
+                                                    metrics["share_missing_values"]))
+        conn.execute("""
+            INSERT INTO drift_monitor_state (name, ingested_until, state) VALUES (%s, %s, %s)
+            ON CONFLICT (name) DO UPDATE SET ingested_until = excluded.ingested_until, state = excluded.state
+        """, (name, max(since, until), json.dumps(monitor.to_state())))
+    return rows, len(tumbling) + len(sliding)
+
+
+def run():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s]: %(message)s")
+    parser = argparse.ArgumentParser(description="online drift monitor over prediction_logs")
+    parser.add_argument("--conninfo", default="host=localhost port=5432 dbname=store_sales_db user=postgres password=admin")
+    parser.add_argument("--reference", default="./input_data/reference.csv")
+    parser.add_argument("--profile", default="./input_data/reference_profile.npz")
+    parser.add_argument("--pane-seconds", type=int, default=60)
+    parser.add_argument("--tumbling-seconds", type=int, default=3600)
+    parser.add_argument("--sliding-seconds", type=int, default=900)
+    parser.add_argument("--lateness-seconds", type=float, default=120,
+                        help="how long to wait for late rows before a pane is closed")
+    parser.add_argument("--every", type=float, default=10, help="poll every N seconds, 0 to poll once")
+    args = parser.parse_args()
+
+    profile = drift_engine.load_or_build_profile(args.reference, args.profile, CATEGORICAL_FEATURES)
+    # the state is keyed by the window layout, so a different layout starts fresh
+    name = f"{args.pane_seconds}/{args.tumbling_seconds}/{args.sliding_seconds}"
+    with psycopg.connect(args.conninfo, autocommit=True) as conn:
+        conn.execute(create_table_statement)
+        monitor = OnlineDriftMonitor(profile, args.pane_seconds, args.tumbling_seconds, args.sliding_seconds)
+        while True:
+            rows, windows = poll(conn, monitor, name=name, lateness=timedelta(seconds=args.lateness_seconds))
+            logging.info("%d new rows, %d windows written, %d late rows ignored", rows, windows, monitor.late_rows)
+            if not args.every:
+                break
+            time.sleep(args.every)
+
+
+if __name__ == "__main__":
+    run()
+
+# python online_monitor.py --pane-seconds 60 --tumbling-seconds 3600 --sliding-seconds 900
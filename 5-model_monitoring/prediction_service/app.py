@@ -1,8 +1,17 @@
+import os
+import sys
+import atexit
+import logging
+import signal
 from flask import Flask, request, jsonify
 import joblib
 import pandas as pd
 import psycopg
-from datetime import datetime
+from psycopg_pool import ConnectionPool
+
+from prediction_logger import PredictionLogWriter
+from segment_log import ArrowSegmentSink
+from schema import create_schema, ensure_partitions
 
 
 app = Flask("store-sales-prediction")
@@ -16,34 +25,85 @@ DB_CONFIG = {
     "port": 5432
 }
 
-create_table_statement = """
-DROP TABLE IF EXISTS prediction_logs;
-CREATE TABLE prediction_logs (
-    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    store INTEGER,
-    promo INTEGER,
-    holiday INTEGER,
-    year INTEGER,
-    month INTEGER,
-    dayofweek INTEGER,
-    is_weekend INTEGER,
-    prediction FLOAT
-);
-"""
-    
+# bounded pool shared by all requests of this process
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))
+
+# "postgres": batched COPY into prediction_logs from a background thread
+# "segments": local Arrow segment files, loaded into PostgreSQL by segment_log.py
+PREDICTION_LOG_SINK = os.getenv("PREDICTION_LOG_SINK", "postgres")
+PREDICTION_LOG_DIR = os.getenv("PREDICTION_LOG_DIR", "./prediction_segments")
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "500"))
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", "1"))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_WHEN_FULL = os.getenv("LOG_WHEN_FULL", "drop")
+
 def prep_db():
-	with psycopg.connect(**DB_CONFIG, autocommit=True) as conn:
+	# connect to the server's default database, store_sales_db may not exist yet
+	with psycopg.connect(**{**DB_CONFIG, "dbname": "postgres"}, autocommit=True) as conn:
 		res = conn.execute("SELECT 1 FROM pg_database WHERE datname='store_sales_db'")
 		if len(res.fetchall()) == 0:
 			conn.execute("create database store_sales_db;")
-		with psycopg.connect("host=localhost port=5432 dbname=store_sales_db user=postgres password=admin") as conn:
-			conn.execute(create_table_statement)
+	with psycopg.connect(**DB_CONFIG) as conn:
+		# partitioned prediction_logs, indexes and rollup tables, see schema.py
+		create_schema(conn)
+		ensure_partitions(conn)
 
  
 def load_model():
 	with open('./lin_reg.bin', 'rb') as f_in:
 		model = joblib.load(f_in)
 	return model 
+
+def create_pool():
+	pool = ConnectionPool(
+		conninfo=psycopg.conninfo.make_conninfo(**DB_CONFIG),
+		min_size=DB_POOL_MIN_SIZE,
+		max_size=DB_POOL_MAX_SIZE,
+		timeout=DB_POOL_TIMEOUT,
+		open=False
+	)
+	pool.open()
+	atexit.register(pool.close)
+	return pool
+
+def create_log_sink(pool):
+	if PREDICTION_LOG_SINK == "segments":
+		# no database on the request path at all
+		return ArrowSegmentSink(PREDICTION_LOG_DIR).start()
+	return PredictionLogWriter(
+		pool,
+		batch_size=LOG_BATCH_SIZE,
+		flush_interval=LOG_FLUSH_INTERVAL,
+		max_queue_size=LOG_QUEUE_SIZE,
+		when_full=LOG_WHEN_FULL
+	).start()
+
+if PREDICTION_LOG_SINK not in ("postgres", "segments"):
+	raise ValueError(f"unknown PREDICTION_LOG_SINK: {PREDICTION_LOG_SINK}")
+
+# --- Startup: model, log sink (and schema + connection pool) are set up by start() ---
+pool = None
+model = None
+log_sink = None
+
+def start():
+	# once per serving process, not at import: the log sink starts threads
+	global pool, model, log_sink  # pylint: disable=global-statement
+	if PREDICTION_LOG_SINK == "postgres":
+		prep_db()
+		pool = create_pool()
+	model = load_model()
+	log_sink = create_log_sink(pool)
+	# registered after the pool, so it runs first: buffered logs are written before the pool closes
+	atexit.register(log_sink.close)
+
+def create_app():
+	# app factory for a WSGI server, e.g. gunicorn "app:create_app()"
+	start()
+	return app
+
 # --- Feature Preparation ---
 def prepare_features(row):
     date = pd.to_datetime(row['date'])
@@ -56,7 +116,7 @@ def prepare_features(row):
         'dayofweek': date.dayofweek,
         'is_weekend': int(date.dayofweek >= 5)
     }
-    print(features)
+    logging.debug("features: %s", features)
     return features
 
 # --- Predict Function ---
@@ -69,37 +129,17 @@ def predict(model, features):
 
 # --- Log to PostgreSQL ---
 def log_to_postgres(features, prediction):
-    try:
-        with psycopg.connect(**DB_CONFIG) as conn:
-            with conn.cursor() as cur:
-                cur.execute("""
-                    INSERT INTO prediction_logs (
-                        timestamp, store, promo, holiday, year, month, dayofweek, is_weekend, prediction
-                    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                """, (
-                    datetime.now(),
-                    features['store'],
-                    features['promo'],
-                    features['holiday'],
-                    features['year'],
-                    features['month'],
-                    features['dayofweek'],
-                    features['is_weekend'],
-                    prediction
-                ))
-            conn.commit()
-    except Exception as e:
-        print("Failed to log to PostgreSQL:", e)
+    # only hands the row to the log sink, which writes it in batches
+    if not log_sink.log(features, prediction):
+        logging.warning("Prediction log queue is full, dropping log row")
 
 # --- Predict Endpoint ---
 @app.route('/predict', methods=['POST'])
 def predict_endpoint():
-    prep_db()
-    model= load_model()
     input_data = request.get_json()
     features = prepare_features(input_data)
     prediction = predict(model,features)
-    print(prediction)
+    logging.debug("prediction: %s", prediction)
 
     # Log prediction
     log_to_postgres(features, prediction)
@@ -113,6 +153,24 @@ def predict_endpoint():
 def health_check():
     return jsonify({"status": "ok"})
 
+# --- Connection Pool Metrics ---
+@app.route('/metrics/pool', methods=['GET'])
+def pool_metrics():
+    if pool is None:
+        return jsonify({"error": "no connection pool, logging to segment files"}), 404
+    return jsonify(pool.get_stats())
+
+@app.route('/metrics/log_sink', methods=['GET'])
+def log_sink_metrics():
+    return jsonify({"sink": PREDICTION_LOG_SINK, **log_sink.stats()})
+
 # --- Run Server ---
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s]: %(message)s")
+    # the debug reloader runs this file in a watcher process and again in the
+    # child that serves requests (WERKZEUG_RUN_MAIN set): only the child starts
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start()
+    # SIGTERM (docker stop) exits through atexit, so the log sink is flushed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     app.run(debug=True, host='0.0.0.0', port=9696)
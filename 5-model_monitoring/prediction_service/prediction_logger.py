@@ -0,0 +1,153 @@
+import abc
+import queue
+import logging
+import threading
+import time
+from datetime import datetime
+
+LOG_COLUMNS = ["timestamp", "store", "promo", "holiday", "year", "month", "dayofweek", "is_weekend", "prediction"]
+
+copy_statement = f"COPY prediction_logs ({', '.join(LOG_COLUMNS)}) FROM STDIN"
+
+
+def make_log_row(features, prediction):
+    return (
+        datetime.now(),
+        features['store'],
+        features['promo'],
+        features['holiday'],
+        features['year'],
+        features['month'],
+        features['dayofweek'],
+        features['is_weekend'],
+        prediction
+    )
+
+
+class PredictionLogSink(abc.ABC):
+    """Destination of the prediction logs.
+
+    `log` is called on the request path and must be cheap; it returns False
+    if the row was dropped. `close` is called once at shutdown and must
+    persist whatever is still buffered.
+    """
+
+    @abc.abstractmethod
+    def log(self, features, prediction):
+        ...
+
+    @abc.abstractmethod
+    def close(self):
+        ...
+
+    def stats(self):
+        return {}
+
+
+class PredictionLogWriter(PredictionLogSink):
+    """Writes prediction logs to PostgreSQL in the background.
+
+    Requests only put a row on a bounded in-memory queue. A writer thread
+    collects up to `batch_size` rows (or whatever arrived within
+    `flush_interval` seconds) and writes them with a single COPY.
+
+    When the queue is full, `when_full="drop"` drops the row right away and
+    `when_full="block"` waits up to `put_timeout` seconds for space before
+    dropping it, which slows the requests down instead of losing logs.
+    """
+
+    def __init__(self, pool, batch_size=500, flush_interval=1.0, max_queue_size=10000,
+                 when_full="drop", put_timeout=0.1):
+        if when_full not in ("drop", "block"):
+            raise ValueError(f"when_full must be 'drop' or 'block', got {when_full!r}")
+        self.pool = pool
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.when_full = when_full
+        self.put_timeout = put_timeout
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="prediction-log-writer", daemon=True)
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.flushes = 0
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def log(self, features, prediction):
+        row = make_log_row(features, prediction)
+        try:
+            if self.when_full == "block":
+                self.queue.put(row, timeout=self.put_timeout)
+            else:
+                self.queue.put_nowait(row)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def _next_batch(self):
+        try:
+            batch = [self.queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def write_rows(self, rows):
+        try:
+            with self.pool.connection() as conn:
+                with conn.cursor() as cur:
+                    with cur.copy(copy_statement) as copy:
+                        for row in rows:
+                            copy.write_row(row)
+        except Exception as e:
+            # the batch is lost, but logging must never take the service down
+            self.failed += len(rows)
+            logging.error("Failed to write %d prediction logs to PostgreSQL: %s", len(rows), e)
+            return
+        self.written += len(rows)
+        self.flushes += 1
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch = self._next_batch()
+            if batch:
+                self.write_rows(batch)
+
+    def close(self):
+        # stop the thread, then write whatever is still queued
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        rows = []
+        while True:
+            try:
+                rows.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+            if len(rows) == self.batch_size:
+                self.write_rows(rows)
+                rows = []
+        if rows:
+            self.write_rows(rows)
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize(),
+            "written": self.written,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "flushes": self.flushes
+        }
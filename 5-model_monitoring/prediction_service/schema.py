@@ -0,0 +1,224 @@
+import time
+import logging
+import argparse
+from datetime import date, datetime, timedelta
+
+import psycopg
+
+# prediction_logs is range-partitioned by day on `timestamp`: dashboard queries
+# only touch the partitions of the selected time range and old days are
+# removed with a cheap DROP TABLE instead of a DELETE.
+# `ingested_at` is set by the database when a row arrives; the rollups follow
+# it, so rows that are loaded late (e.g. from segment files) are still counted.
+create_table_statement = """
+CREATE TABLE IF NOT EXISTS prediction_logs (
+    timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    store INTEGER,
+    promo INTEGER,
+    holiday INTEGER,
+    year INTEGER,
+    month INTEGER,
+    dayofweek INTEGER,
+    is_weekend INTEGER,
+    prediction FLOAT,
+    ingested_at TIMESTAMP NOT NULL DEFAULT clock_timestamp()
+) PARTITION BY RANGE (timestamp);
+
+CREATE TABLE IF NOT EXISTS prediction_logs_default PARTITION OF prediction_logs DEFAULT;
+
+CREATE INDEX IF NOT EXISTS prediction_logs_store_timestamp_idx ON prediction_logs (store, timestamp);
+CREATE INDEX IF NOT EXISTS prediction_logs_timestamp_brin ON prediction_logs USING brin (timestamp);
+CREATE INDEX IF NOT EXISTS prediction_logs_ingested_at_brin ON prediction_logs USING brin (ingested_at);
+
+CREATE TABLE IF NOT EXISTS prediction_logs_hourly (
+    hour TIMESTAMP NOT NULL,
+    store INTEGER NOT NULL,
+    num_predictions BIGINT NOT NULL,
+    sum_prediction FLOAT NOT NULL,
+    sum_prediction_sq FLOAT NOT NULL,
+    min_prediction FLOAT,
+    max_prediction FLOAT,
+    num_promo BIGINT NOT NULL,
+    num_holiday BIGINT NOT NULL,
+    PRIMARY KEY (hour, store)
+);
+
+CREATE TABLE IF NOT EXISTS rollup_watermarks (
+    name TEXT PRIMARY KEY,
+    watermark TIMESTAMP NOT NULL
+);
+"""
+
+# additive aggregates, so a new slice of rows can be merged into existing hours
+refresh_hourly_statement = """
+INSERT INTO prediction_logs_hourly AS h (
+    hour, store, num_predictions, sum_prediction, sum_prediction_sq,
+    min_prediction, max_prediction, num_promo, num_holiday
+)
+SELECT
+    date_trunc('hour', timestamp), store, count(*), sum(prediction), sum(prediction * prediction),
+    min(prediction), max(prediction), count(*) FILTER (WHERE promo = 1), count(*) FILTER (WHERE holiday = 1)
+FROM prediction_logs
+WHERE ingested_at >= %(since)s AND ingested_at < %(until)s AND store IS NOT NULL
+GROUP BY 1, 2
+ON CONFLICT (hour, store) DO UPDATE SET
+    num_predictions = h.num_predictions + excluded.num_predictions,
+    sum_prediction = h.sum_prediction + excluded.sum_prediction,
+    sum_prediction_sq = h.sum_prediction_sq + excluded.sum_prediction_sq,
+    min_prediction = least(h.min_prediction, excluded.min_prediction),
+    max_prediction = greatest(h.max_prediction, excluded.max_prediction),
+    num_promo = h.num_promo + excluded.num_promo,
+    num_holiday = h.num_holiday + excluded.num_holiday
+"""
+
+PARTITION_PREFIX = "prediction_logs_p"
+
+# gunicorn workers run create_schema and ensure_partitions at the same time;
+# this transaction-level advisory lock makes them take turns
+schema_lock_statement = "SELECT pg_advisory_xact_lock(hashtext('prediction_logs'))"
+
+
+def partition_name(day):
+    return f"{PARTITION_PREFIX}{day:%Y%m%d}"
+
+
+def relation_exists(conn, name):
+    # reads pg_class with the statement's snapshot: to_regclass can answer from
+    # a catalog cache that misses tables other sessions committed meanwhile
+    return conn.execute("SELECT 1 FROM pg_class WHERE relname = %s", (name,)).fetchone() is not None
+
+
+def is_partitioned(conn):
+    row = conn.execute(
+        "SELECT relkind FROM pg_class WHERE oid = to_regclass('prediction_logs')"
+    ).fetchone()
+    return row is None or row[0] == 'p'
+
+
+def create_schema(conn):
+    # CREATE ... IF NOT EXISTS alone still fails when two sessions create the
+    # same table at once, so the whole migration runs under the schema lock
+    with conn.transaction():
+        conn.execute(schema_lock_statement)
+        # a plain prediction_logs table from an older version is renamed and its
+        # rows are copied into the partitioned table
+        legacy = not is_partitioned(conn)
+        if legacy:
+            conn.execute("ALTER TABLE prediction_logs RENAME TO prediction_logs_legacy")
+        conn.execute(create_table_statement)
+        if legacy:
+            conn.execute("""
+                INSERT INTO prediction_logs (timestamp, store, promo, holiday, year, month, dayofweek, is_weekend, prediction)
+                SELECT coalesce(timestamp, CURRENT_TIMESTAMP), store, promo, holiday, year, month, dayofweek, is_weekend, prediction
+                FROM prediction_logs_legacy
+            """)
+            conn.execute("DROP TABLE prediction_logs_legacy")
+            days = conn.execute("SELECT DISTINCT timestamp::date FROM prediction_logs_default").fetchall()
+            for (day,) in days:
+                ensure_partitions(conn, start=day, days=1)
+
+
+def ensure_partitions(conn, start=None, days=8):
+    """Creates the daily partitions for `days` days from `start` (today).
+
+    Rows that already landed in the default partition for one of those days
+    are moved into the new partition before it is attached. Safe to run from
+    several processes at once: a partition is created under the schema lock,
+    by whichever process finds it missing first.
+    """
+    start = start or date.today()
+    created = []
+    for offset in range(days):
+        day = start + timedelta(days=offset)
+        name = partition_name(day)
+        if relation_exists(conn, name):
+            continue
+        bounds = (day, day + timedelta(days=1))
+        with conn.transaction():
+            conn.execute(schema_lock_statement)
+            # another process may have created it while we waited for the lock
+            if relation_exists(conn, name):
+                continue
+            conn.execute(f"CREATE TABLE {name} (LIKE prediction_logs INCLUDING DEFAULTS)")
+            conn.execute(f"""
+                WITH moved AS (
+                    DELETE FROM prediction_logs_default
+                    WHERE timestamp >= %s AND timestamp < %s
+                    RETURNING *
+                )
+                INSERT INTO {name} SELECT * FROM moved
+            """, bounds)
+            conn.execute(
+                f"ALTER TABLE prediction_logs ATTACH PARTITION {name} "
+                f"FOR VALUES FROM ('{bounds[0]}') TO ('{bounds[1]}')"
+            )
+        created.append(name)
+    return created
+
+
+def drop_old_partitions(conn, retention_days):
+    # the hourly rollups of dropped days are kept
+    oldest = partition_name(date.today() - timedelta(days=retention_days))
+    names = [row[0] for row in conn.execute("""
+        SELECT child.relname
+        FROM pg_inherits
+        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.relname = 'prediction_logs' AND child.relname LIKE %s
+    """, (PARTITION_PREFIX + '%',))]
+    dropped = sorted(name for name in names if name < oldest)
+    for name in dropped:
+        conn.execute(f"DROP TABLE {name}")
+    return dropped
+
+
+def refresh_rollups(conn, lag=timedelta(minutes=1)):
+    """Adds the rows ingested since the last refresh to prediction_logs_hourly.
+
+    Rows are only aggregated once they are older than `lag`, which leaves
+    in-flight transactions time to commit.
+    """
+    with conn.transaction():
+        # database clock, the same one that sets ingested_at
+        until = conn.execute("SELECT clock_timestamp()::timestamp - %s", (lag,)).fetchone()[0]
+        row = conn.execute(
+            "SELECT watermark FROM rollup_watermarks WHERE name = 'hourly' FOR UPDATE"
+        ).fetchone()
+        since = row[0] if row else datetime.min
+        if since >= until:
+            return 0
+        cur = conn.execute(refresh_hourly_statement, {"since": since, "until": until})
+        conn.execute("""
+            INSERT INTO rollup_watermarks (name, watermark) VALUES ('hourly', %s)
+            ON CONFLICT (name) DO UPDATE SET watermark = excluded.watermark
+        """, (until,))
+        return cur.rowcount
+
+
+def maintain(conninfo, retention_days, days_ahead=8):
+    with psycopg.connect(conninfo, autocommit=True) as conn:
+        created = ensure_partitions(conn, days=days_ahead)
+        dropped = drop_old_partitions(conn, retention_days)
+        updated = refresh_rollups(conn)
+    logging.info("partitions created: %s, dropped: %s, rollup rows updated: %d", created, dropped, updated)
+
+
+def run():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s]: %(message)s")
+    parser = argparse.ArgumentParser(description="maintain prediction_logs partitions and rollups")
+    parser.add_argument("--conninfo", default="host=localhost port=5432 dbname=store_sales_db user=postgres password=admin")
+    parser.add_argument("--retention-days", type=int, default=90)
+    parser.add_argument("--every", type=float, default=0, help="repeat every N seconds")
+    args = parser.parse_args()
+
+    while True:
+        maintain(args.conninfo, args.retention_days)
+        if not args.every:
+            break
+        time.sleep(args.every)
+
+
+if __name__ == "__main__":
+    run()
+
+# python schema.py --retention-days 90 --every 300
@@ -0,0 +1,241 @@
+import os
+import io
+import glob
+import time
+import shutil
+import logging
+import argparse
+import threading
+from datetime import datetime
+
+import psycopg
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+
+from prediction_logger import LOG_COLUMNS, PredictionLogSink, make_log_row
+
+LOG_SCHEMA = pa.schema([
+    ("timestamp", pa.timestamp("us")),
+    ("store", pa.int32()),
+    ("promo", pa.int32()),
+    ("holiday", pa.int32()),
+    ("year", pa.int32()),
+    ("month", pa.int32()),
+    ("dayofweek", pa.int32()),
+    ("is_weekend", pa.int32()),
+    ("prediction", pa.float64())
+])
+
+OPEN_SUFFIX = ".arrow.open"
+SEALED_SUFFIX = ".arrow"
+
+# the segments already copied into prediction_logs, by file name: a segment
+# whose file could not be removed after its commit is not loaded twice
+create_ledger_statement = """
+CREATE TABLE IF NOT EXISTS loaded_segments (
+    name TEXT PRIMARY KEY,
+    num_rows BIGINT NOT NULL,
+    loaded_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+)
+"""
+
+
+class ArrowSegmentSink(PredictionLogSink):
+    """Appends prediction logs to rotating Arrow IPC segment files.
+
+    Rows are buffered per column and appended as one record batch every
+    `batch_rows` rows. The open segment is written as `<name>.arrow.open`;
+    once it holds `max_segment_rows` rows or its first row is older than
+    `max_segment_seconds` it is sealed by renaming it to `<name>.arrow`.
+    A background thread started by `start` checks the age every
+    `check_interval` seconds, so an idle service seals its last rows too.
+    Only sealed segments are picked up by `load_sealed_segments`.
+    """
+
+    def __init__(self, directory, batch_rows=1024, max_segment_rows=100_000, max_segment_seconds=60.0,
+                 check_interval=1.0):
+        self.directory = directory
+        self.batch_rows = batch_rows
+        self.max_segment_rows = max_segment_rows
+        self.max_segment_seconds = max_segment_seconds
+        self.check_interval = check_interval
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._buffer = [[] for _ in LOG_COLUMNS]
+        self._sink = None
+        self._writer = None
+        self._path = None
+        self._segment_rows = 0
+        self._segment_started_at = 0.0
+        self._sequence = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="segment-sealer", daemon=True)
+        self.rows = 0
+        self.segments = 0
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def log(self, features, prediction):
+        row = make_log_row(features, prediction)
+        with self._lock:
+            if self._writer is None and not self._buffer[0]:
+                # the first row of the next segment starts its age
+                self._segment_started_at = time.monotonic()
+            for column, value in zip(self._buffer, row):
+                column.append(value)
+            if len(self._buffer[0]) >= self.batch_rows:
+                self._write_batch()
+            if self._writer is not None and self._segment_rows >= self.max_segment_rows:
+                self._seal()
+            elif self._is_due():
+                self._write_batch()
+                self._seal()
+        return True
+
+    def _is_due(self):
+        pending = self._writer is not None or self._buffer[0]
+        return pending and time.monotonic() - self._segment_started_at >= self.max_segment_seconds
+
+    def seal_if_due(self):
+        with self._lock:
+            if self._is_due():
+                self._write_batch()
+                self._seal()
+
+    def _run(self):
+        while not self._stop.wait(self.check_interval):
+            try:
+                self.seal_if_due()
+            except Exception as e:
+                # e.g. a full disk: the rows stay buffered for the next check
+                logging.error("Failed to seal the prediction log segment: %s", e)
+
+    def _open_segment(self):
+        self._sequence += 1
+        name = f"segment-{datetime.now():%Y%m%dT%H%M%S%f}-{os.getpid()}-{self._sequence:06d}"
+        self._path = os.path.join(self.directory, name)
+        self._sink = pa.OSFile(self._path + OPEN_SUFFIX, "wb")
+        self._writer = pa.ipc.new_stream(self._sink, LOG_SCHEMA)
+        self._segment_rows = 0
+
+    def _write_batch(self):
+        if not self._buffer[0]:
+            return
+        if self._writer is None:
+            self._open_segment()
+        batch = pa.record_batch(
+            [pa.array(values, type=field.type) for values, field in zip(self._buffer, LOG_SCHEMA)],
+            schema=LOG_SCHEMA
+        )
+        self._writer.write_batch(batch)
+        self._segment_rows += batch.num_rows
+        self.rows += batch.num_rows
+        self._buffer = [[] for _ in LOG_COLUMNS]
+
+    def _seal(self):
+        self._writer.close()
+        self._sink.close()
+        os.rename(self._path + OPEN_SUFFIX, self._path + SEALED_SUFFIX)
+        self._writer = None
+        self.segments += 1
+
+    def flush(self):
+        # write the buffered rows and seal the current segment
+        with self._lock:
+            self._write_batch()
+            if self._writer is not None:
+                self._seal()
+
+    def close(self):
+        # stop the sealer thread, then seal whatever is still buffered
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self.flush()
+
+    def stats(self):
+        return {
+            "buffered": len(self._buffer[0]),
+            "rows": self.rows,
+            "sealed_segments": self.segments,
+            "open_segment_rows": self._segment_rows if self._writer is not None else 0
+        }
+
+
+def read_segment(path):
+    with pa.OSFile(path, "rb") as source:
+        return pa.ipc.open_stream(source).read_all()
+
+
+def copy_table(conn, table):
+    # pyarrow renders the whole table as CSV in one vectorized call, COPY ingests it
+    buffer = io.BytesIO()
+    pa_csv.write_csv(table, buffer, pa_csv.WriteOptions(include_header=False))
+    with conn.cursor() as cur:
+        with cur.copy(f"COPY prediction_logs ({', '.join(LOG_COLUMNS)}) FROM STDIN (FORMAT csv)") as copy:
+            copy.write(buffer.getvalue())
+
+
+def load_sealed_segments(directory, conninfo, keep=False):
+    """Bulk-loads sealed segments into prediction_logs, oldest first.
+
+    Each segment is committed in its own transaction, together with its name
+    in `loaded_segments`, and then moved to `<directory>/loaded` (or deleted
+    when `keep` is False). A segment that is already in `loaded_segments`,
+    e.g. after a crash before its file was removed, is not loaded again.
+    Returns the number of segments and rows loaded.
+    """
+    paths = sorted(glob.glob(os.path.join(directory, "*" + SEALED_SUFFIX)))
+    loaded_dir = os.path.join(directory, "loaded")
+    segments = rows = 0
+    with psycopg.connect(conninfo) as conn:
+        with conn.transaction():
+            conn.execute(create_ledger_statement)
+        for path in paths:
+            name = os.path.basename(path)
+            table = read_segment(path)
+            with conn.transaction():
+                # also keeps two loaders from copying the same segment
+                new = conn.execute(
+                    "INSERT INTO loaded_segments (name, num_rows) VALUES (%s, %s) ON CONFLICT (name) DO NOTHING",
+                    (name, table.num_rows)
+                ).rowcount
+                if new:
+                    copy_table(conn, table)
+            if new:
+                segments += 1
+                rows += table.num_rows
+                logging.info("loaded %s (%d rows)", name, table.num_rows)
+            else:
+                logging.info("skipped %s, already loaded", name)
+            if keep:
+                os.makedirs(loaded_dir, exist_ok=True)
+                shutil.move(path, os.path.join(loaded_dir, name))
+            else:
+                os.remove(path)
+    return segments, rows
+
+
+def run():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s]: %(message)s")
+    parser = argparse.ArgumentParser(description="load sealed prediction log segments into PostgreSQL")
+    parser.add_argument("--dir", default=os.getenv("PREDICTION_LOG_DIR", "./prediction_segments"))
+    parser.add_argument("--conninfo", default="host=localhost port=5432 dbname=store_sales_db user=postgres password=admin")
+    parser.add_argument("--keep", action="store_true", help="move loaded segments to <dir>/loaded instead of deleting them")
+    parser.add_argument("--watch", type=float, default=0, help="keep loading every N seconds")
+    args = parser.parse_args()
+
+    while True:
+        segments, rows = load_sealed_segments(args.dir, args.conninfo, keep=args.keep)
+        logging.info("loaded %d segments, %d rows", segments, rows)
+        if not args.watch:
+            break
+        time.sleep(args.watch)
+
+
+if __name__ == "__main__":
+    run()
+
+# python segment_log.py --dir ./prediction_segments --watch 30
@@ -0,0 +1,246 @@
+import os
+import glob
+import json
+import time
+import uuid
+import logging
+import argparse
+from datetime import datetime
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+# Evidently stores one JSON snapshot per report under
+# workspace/<project>/snapshots/<snapshot_id>.json, so plotting one metric over
+# time means parsing every snapshot. The compactor flattens the numeric
+# results of each snapshot into rows
+#   (snapshot_id, timestamp, metric_index, metric_id, column, field_path, value)
+# e.g. ("0198...", 2022-01-28, 0, "DatasetSummaryMetric", None, "current.number_of_rows", 2831.0)
+# and merges them into one Parquet file per project,
+# workspace/<project>/metrics_index.parquet, sorted by metric and time so a
+# query only decodes the row groups it needs. The ids of the snapshots it
+# covers, including the ones without numeric results, are kept in its schema
+# metadata, so finding the new snapshots only reads the file footer.
+# `metric_id` and `field_path` are the names used by the dashboard panels.
+
+INDEX_FILE = "metrics_index.parquet"
+# the part files that earlier versions wrote per run, merged into INDEX_FILE
+# by the next compaction
+PARTS_DIR = "metrics_index"
+SNAPSHOT_IDS_KEY = b"snapshot_ids"
+
+INDEX_SCHEMA = pa.schema([
+    ("snapshot_id", pa.string()),
+    ("timestamp", pa.timestamp("us")),
+    ("metric_index", pa.int32()),
+    ("metric_id", pa.string()),
+    ("column", pa.string()),
+    ("field_path", pa.string()),
+    ("value", pa.float64())
+])
+
+SORT_KEYS = [("metric_id", "ascending"), ("column", "ascending"), ("field_path", "ascending"),
+             ("timestamp", "ascending")]
+
+
+def _type_name(obj):
+    # "evidently:metric:DatasetSummaryMetric" -> "DatasetSummaryMetric"
+    return obj.get("type", "").rsplit(":", 1)[-1]
+
+
+def _column_name(metric):
+    column = metric.get("column_name")
+    if isinstance(column, dict):
+        return column.get("name")
+    return column
+
+
+def flatten_result(result, prefix=""):
+    """Yields `(field_path, value)` for every numeric leaf of a metric result.
+
+    Lists (histograms, raw samples) and strings are skipped.
+    """
+    for key, value in result.items():
+        if key == "type":
+            continue
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            yield from flatten_result(value, path + ".")
+        elif isinstance(value, bool):
+            yield path, float(value)
+        elif isinstance(value, (int, float)):
+            yield path, float(value)
+
+
+def snapshot_rows(snapshot):
+    """Flattens one snapshot into columns matching INDEX_SCHEMA."""
+    rows = {name: [] for name in INDEX_SCHEMA.names}
+    timestamp = datetime.fromisoformat(snapshot["timestamp"])
+    suite = snapshot["suite"]
+    for index, (metric, result) in enumerate(zip(suite["metrics"], suite["metric_results"])):
+        metric_id = _type_name(metric)
+        column = _column_name(metric)
+        for field_path, value in flatten_result(result):
+            rows["snapshot_id"].append(snapshot["id"])
+            rows["timestamp"].append(timestamp)
+            rows["metric_index"].append(index)
+            rows["metric_id"].append(metric_id)
+            rows["column"].append(column)
+            rows["field_path"].append(field_path)
+            rows["value"].append(value)
+    return rows
+
+
+def index_path(project_dir):
+    return os.path.join(project_dir, INDEX_FILE)
+
+
+def part_paths(project_dir):
+    return sorted(glob.glob(os.path.join(project_dir, PARTS_DIR, "part-*.parquet")))
+
+
+def _snapshot_ids(path):
+    # only the footer is read
+    metadata = pq.read_schema(path).metadata or {}
+    return json.loads(metadata.get(SNAPSHOT_IDS_KEY, b"[]"))
+
+
+def indexed_snapshot_ids(path):
+    if not os.path.exists(path):
+        return set()
+    return set(_snapshot_ids(path))
+
+
+def _read_index(path):
+    # without the metadata, so tables of different files can be concatenated
+    return pq.read_table(path, schema=INDEX_SCHEMA).replace_schema_metadata(None)
+
+
+def compact_project(project_dir, row_group_size=64 * 1024):
+    """Merges the snapshots that are not indexed yet into the project's index.
+
+    Only new snapshot files are parsed. The index is rewritten as a whole,
+    together with the part files of earlier versions, to a temporary file
+    that is renamed into place once complete, so readers always see a whole
+    file. Meant for one compactor per workspace. Returns the number of
+    snapshots added.
+    """
+    path = index_path(project_dir)
+    tables = []
+    snapshot_ids = []
+    if os.path.exists(path):
+        tables.append(_read_index(path))
+        snapshot_ids.extend(_snapshot_ids(path))
+    known = set(snapshot_ids)
+    parts = part_paths(project_dir)
+    for part_path in parts:
+        # a part that was merged already, if the last run stopped before
+        # removing it, adds nothing
+        part_ids = [snapshot_id for snapshot_id in _snapshot_ids(part_path) if snapshot_id not in known]
+        table = _read_index(part_path)
+        tables.append(table.filter(pc.is_in(table.column("snapshot_id"), pa.array(part_ids, pa.string()))))
+        snapshot_ids.extend(part_ids)
+        known.update(part_ids)
+
+    rows = {name: [] for name in INDEX_SCHEMA.names}
+    added = 0
+    for snapshot_path in sorted(glob.glob(os.path.join(project_dir, "snapshots", "*.json"))):
+        snapshot_id = os.path.splitext(os.path.basename(snapshot_path))[0]
+        if snapshot_id in known:
+            continue
+        try:
+            with open(snapshot_path) as f_in:
+                snapshot = json.load(f_in)
+        except (OSError, ValueError) as e:
+            # e.g. still being written: picked up by the next run
+            logging.warning("Skipping snapshot %s: %s", snapshot_path, e)
+            continue
+        for name, values in snapshot_rows(snapshot).items():
+            rows[name].extend(values)
+        # also the snapshots without numeric results, so they are not parsed again
+        snapshot_ids.append(snapshot_id)
+        added += 1
+    if not added and not parts:
+        return 0
+
+    tables.append(pa.table(rows, schema=INDEX_SCHEMA))
+    table = pa.concat_tables(tables).sort_by(SORT_KEYS)
+    table = table.replace_schema_metadata({SNAPSHOT_IDS_KEY: json.dumps(snapshot_ids)})
+    tmp_path = os.path.join(project_dir, f".{INDEX_FILE}.{uuid.uuid4().hex[:8]}")
+    pq.write_table(table, tmp_path, row_group_size=row_group_size, compression="zstd")
+    os.replace(tmp_path, path)
+    for part_path in parts:
+        os.remove(part_path)
+    return added
+
+
+def compact_workspace(workspace):
+    added = {}
+    for project_dir in sorted(glob.glob(os.path.join(workspace, "*", "snapshots"))):
+        project_dir = os.path.dirname(project_dir)
+        added[os.path.basename(project_dir)] = compact_project(project_dir)
+    return added
+
+
+def query_metric(workspace, project_id, metric_id, field_path, column=None, start=None, end=None):
+    """Time series of one metric field from the index.
+
+    Returns a table with `timestamp`, `snapshot_id` and `value`, sorted by
+    time, for the snapshots with `start <= timestamp < end`. The table is
+    empty while the project has no index yet.
+    """
+    path = index_path(os.path.join(workspace, project_id))
+    if not os.path.exists(path):
+        return INDEX_SCHEMA.empty_table().select(["timestamp", "snapshot_id", "value"])
+    filters = [("metric_id", "=", metric_id), ("field_path", "=", field_path)]
+    if column is not None:
+        filters.append(("column", "=", column))
+    if start is not None:
+        filters.append(("timestamp", ">=", start))
+    if end is not None:
+        filters.append(("timestamp", "<", end))
+    table = pq.read_table(path, schema=INDEX_SCHEMA, columns=["timestamp", "snapshot_id", "value", "column"],
+                          filters=filters)
+    if column is None:
+        # metrics without a column, not e.g. every ColumnSummaryMetric at once
+        table = table.filter(pc.is_null(table.column("column")))
+    return table.select(["timestamp", "snapshot_id", "value"]).sort_by("timestamp")
+
+
+def run():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s]: %(message)s")
+    parser = argparse.ArgumentParser(description="index the metrics of Evidently workspace snapshots")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    compact = subparsers.add_parser("compact", help="add new snapshots to the per-project index")
+    compact.add_argument("--workspace", default="./workspace")
+    compact.add_argument("--watch", type=float, default=0, help="keep compacting every N seconds")
+    query = subparsers.add_parser("query", help="print a metric over time")
+    query.add_argument("--workspace", default="./workspace")
+    query.add_argument("--project", required=True)
+    query.add_argument("--metric", required=True, help="e.g. DatasetSummaryMetric")
+    query.add_argument("--field", required=True, help="e.g. current.number_of_rows")
+    query.add_argument("--column", default=None)
+    query.add_argument("--start", type=datetime.fromisoformat, default=None)
+    query.add_argument("--end", type=datetime.fromisoformat, default=None)
+    args = parser.parse_args()
+
+    if args.command == "query":
+        table = query_metric(args.workspace, args.project, args.metric, args.field,
+                             column=args.column, start=args.start, end=args.end)
+        print(table.to_pandas().to_string(index=False))
+        return
+
+    while True:
+        for project_id, added in compact_workspace(args.workspace).items():
+            logging.info("%s: %d new snapshots indexed", project_id, added)
+        if not args.watch:
+            break
+        time.sleep(args.watch)
+
+
+if __name__ == "__main__":
+    run()
+
+# python snapshot_index.py compact --workspace ./workspace --watch 60
+# python snapshot_index.py query --project <project_id> --metric DatasetSummaryMetric --field current.number_of_rows
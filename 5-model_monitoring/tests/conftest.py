@@ -0,0 +1,43 @@
+import os
+import sys
+import uuid
+
+import psycopg
+import pytest
+
+# the prediction service modules import each other by name
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "prediction_service")
+)
+
+# pylint: disable=wrong-import-position
+import schema
+
+SERVER_CONNINFO = os.getenv("TEST_POSTGRES_CONNINFO", "host=localhost port=5432 user=postgres password=admin")
+
+
+@pytest.fixture
+def conninfo():
+    """A new database with the prediction_logs schema, dropped after the test.
+
+    Tests that use it are skipped when no PostgreSQL server is reachable.
+    """
+    try:
+        admin = psycopg.connect(SERVER_CONNINFO, dbname="postgres", autocommit=True, connect_timeout=2)
+    except psycopg.OperationalError as e:
+        pytest.skip(f"PostgreSQL is not available: {e}")
+    name = f"store_sales_test_{uuid.uuid4().hex[:8]}"
+    with admin:
+        admin.execute(f"CREATE DATABASE {name}")
+        try:
+            database = psycopg.conninfo.make_conninfo(SERVER_CONNINFO, dbname=name)
+            with psycopg.connect(database) as conn:
+                schema.create_schema(conn)
+            yield database
+        finally:
+            admin.execute(f"DROP DATABASE {name} WITH (FORCE)")
+
+
+def log_features(store=1, promo=0):
+    return {"store": store, "promo": promo, "holiday": 0, "year": 2022, "month": 1, "dayofweek": 1,
+            "is_weekend": 0}
@@ -0,0 +1,79 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import drift_engine
+from evidently_metrics_calculation_psql_Prefect import categorical_features
+
+REFERENCE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "input_data", "reference.csv")
+
+
+@pytest.fixture(scope="module")
+def reference():
+    df = pd.read_csv(REFERENCE)
+    df["date"] = pd.to_datetime(df["date"])
+    return df
+
+
+def windows(reference):
+    shifted = reference.sample(300, random_state=2)
+    shifted["prediction"] += 30
+    shifted.loc[shifted.index[:20], "promo"] = np.nan
+    return [
+        ("sample", reference.sample(300, random_state=1)),
+        ("shifted", shifted),
+        ("few stores", reference[reference.store <= 3].sample(100, random_state=3)),
+    ]
+
+
+def test_native_engine_matches_evidently(reference):
+    differences = drift_engine.parity_check(reference, windows(reference), categorical_features)
+
+    assert differences == pytest.approx(
+        {"prediction_drift": 0.0, "num_drifted_columns": 0.0, "share_missing_values": 0.0}, abs=1e-6
+    )
+
+
+def test_native_engine_detects_shifted_predictions(reference):
+    profile = drift_engine.ReferenceProfile.from_frame(reference, categorical_features)
+    sample, shifted, _ = [current for _, current in windows(reference)]
+
+    expected = drift_engine.calculate_metrics(profile, sample)
+    metrics = drift_engine.calculate_metrics(profile, shifted)
+
+    assert expected["prediction_drift"] < 0.1 < metrics["prediction_drift"]
+    assert metrics["num_drifted_columns"] > expected["num_drifted_columns"]
+    assert expected["share_missing_values"] == 0.0
+    assert metrics["share_missing_values"] == 20 / shifted.size
+
+
+def test_grouped_metrics_compares_every_store_with_its_own_reference(reference):
+    grouped = drift_engine.GroupedReference(reference, "store", categorical_features)
+    current = reference.sample(400, random_state=4)
+    current = pd.concat([current, current.iloc[:5].assign(store=999)])
+    current["prediction"] = current["prediction"] * 1.1
+
+    result = drift_engine.grouped_metrics(grouped, current)
+
+    assert result["num_rows"].sum() == len(current)
+    for store in (1, 2, 3):
+        row = result[result.store == store].iloc[0]
+        store_reference = reference[reference.store == store]
+        store_current = current[current.store == store]
+        drift, _, _ = drift_engine.column_drift(
+            drift_engine.ColumnProfile.from_series(store_reference["prediction"], "num"),
+            store_current["prediction"],
+            stattest="wasserstein",
+        )
+        error = store_current["prediction"] - store_current["sales"]
+        assert row["num_rows"] == len(store_current)
+        assert row["prediction_drift"] == pytest.approx(drift)
+        assert row["rmse"] == pytest.approx(np.sqrt((error ** 2).mean()))
+        assert row["mape"] == pytest.approx((error / store_current["sales"]).abs().mean())
+    # a store without reference data has no drift score, but its errors
+    new_store = result[result.store == 999].iloc[0]
+    assert np.isnan(new_store["prediction_drift"])
+    assert new_store["num_rows"] == 5
+    assert not np.isnan(new_store["rmse"])
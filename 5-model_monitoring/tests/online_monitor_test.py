@@ -0,0 +1,108 @@
+import os
+from datetime import datetime, timedelta
+
+import pandas as pd
+import psycopg
+import pytest
+
+import drift_engine
+from online_monitor import MONITORED_COLUMNS, CATEGORICAL_FEATURES, OnlineDriftMonitor, create_table_statement, poll
+
+REFERENCE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "input_data", "reference.csv")
+START = datetime(2022, 1, 1)
+
+
+@pytest.fixture(scope="module")
+def reference():
+    return pd.read_csv(REFERENCE)
+
+
+@pytest.fixture(scope="module")
+def profile(reference):
+    return drift_engine.ReferenceProfile.from_frame(reference, CATEGORICAL_FEATURES)
+
+
+def rows_at(reference, offset, seconds, count):
+    # `count` reference rows logged `seconds` after START
+    frame = reference[MONITORED_COLUMNS].iloc[offset:offset + count].copy()
+    frame.insert(0, "timestamp", START + timedelta(seconds=seconds))
+    return frame
+
+
+def window_rows(windows):
+    return [(timestamp, num_rows) for timestamp, num_rows, _ in windows]
+
+
+def test_advance_rolls_panes_into_tumbling_and_sliding_windows(reference, profile):
+    # panes of 1 minute, tumbling windows of 3 and a sliding window of 2
+    monitor = OnlineDriftMonitor(profile, pane_seconds=60, tumbling_seconds=180, sliding_seconds=120)
+    monitor.add(pd.concat([
+        rows_at(reference, 0, 10, 10),
+        rows_at(reference, 10, 70, 5),
+        rows_at(reference, 15, 200, 7),
+    ]))
+
+    tumbling, sliding = monitor.advance(START + timedelta(minutes=2))
+    assert tumbling == []
+    assert window_rows(sliding) == [(START + timedelta(minutes=1), 10), (START + timedelta(minutes=2), 15)]
+
+    # a row for a closed pane is late
+    monitor.add(rows_at(reference, 30, 90, 1))
+    assert monitor.late_rows == 1
+
+    tumbling, sliding = monitor.advance(START + timedelta(minutes=4))
+    # the empty third minute pushes the first one out of the sliding window
+    assert window_rows(sliding) == [(START + timedelta(minutes=3), 5), (START + timedelta(minutes=4), 7)]
+    assert window_rows(tumbling) == [(START, 15)]
+    # the histogram approximation of the exact Wasserstein distance
+    exact, _, _ = drift_engine.column_drift(
+        profile.columns["prediction"], reference["prediction"].iloc[:15], stattest="wasserstein"
+    )
+    assert tumbling[0][2]["prediction_drift"] == pytest.approx(exact, abs=0.01)
+    assert monitor.advance(START + timedelta(minutes=4)) == ([], [])
+
+
+def test_saved_state_continues_the_same_windows(reference, profile):
+    def monitor():
+        return OnlineDriftMonitor(profile, pane_seconds=60, tumbling_seconds=180, sliding_seconds=120)
+
+    first = monitor()
+    first.add(pd.concat([rows_at(reference, 0, 10, 10), rows_at(reference, 10, 130, 5)]))
+    first.advance(START + timedelta(minutes=2))
+    restarted = monitor()
+    restarted.load_state(first.to_state())
+
+    assert restarted.advance(START + timedelta(minutes=3)) == first.advance(START + timedelta(minutes=3))
+
+
+def test_advance_skips_idle_panes_at_once(reference, profile):
+    monitor = OnlineDriftMonitor(profile, pane_seconds=60, tumbling_seconds=180, sliding_seconds=120)
+    monitor.add(rows_at(reference, 0, 0, 3))
+    monitor.advance(START + timedelta(minutes=3))
+    monitor.add(rows_at(reference, 3, 30 * 24 * 3600, 4))
+
+    tumbling, sliding = monitor.advance(START + timedelta(days=30, minutes=3))
+
+    assert window_rows(tumbling) == [(START + timedelta(days=30), 4)]
+    assert window_rows(sliding) == [(START + timedelta(days=30, minutes=1), 4),
+                                    (START + timedelta(days=30, minutes=2), 4)]
+
+
+def test_poll_keeps_tumbling_windows_apart_from_the_daily_backfill(reference, profile, conninfo):
+    with psycopg.connect(conninfo, autocommit=True) as conn:
+        conn.execute(create_table_statement)
+        # the daily window of evidently_metrics_calculation_psql_Prefect.py
+        conn.execute("create table store_metrics(timestamp timestamp primary key, prediction_drift float)")
+        conn.execute("insert into store_metrics values (%s, 0.5)", (START,))
+        monitor = OnlineDriftMonitor(profile, pane_seconds=60, tumbling_seconds=180, sliding_seconds=120)
+        poll(conn, monitor, lag=timedelta(0))
+        rows = rows_at(reference, 0, 10, 10)
+        with conn.cursor().copy(f"COPY prediction_logs ({', '.join(rows.columns)}) FROM STDIN") as copy:
+            for row in rows.itertuples(index=False):
+                copy.write_row(row)
+
+        assert poll(conn, monitor, lag=timedelta(0))[0] == 10
+        assert conn.execute("select * from store_metrics").fetchall() == [(START, 0.5)]
+        assert conn.execute(
+            "select timestamp, window_seconds, num_rows from store_metrics_tumbling"
+        ).fetchall() == [(START, 180, 10)]
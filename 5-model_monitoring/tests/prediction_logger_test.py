@@ -0,0 +1,52 @@
+import psycopg
+import pytest
+from psycopg_pool import ConnectionPool
+
+from prediction_logger import PredictionLogSink, PredictionLogWriter
+
+from .conftest import log_features
+
+
+def test_prediction_log_sink_is_abstract():
+    class NoClose(PredictionLogSink):
+        def log(self, features, prediction):
+            return True
+
+    with pytest.raises(TypeError):
+        NoClose()  # pylint: disable=abstract-class-instantiated
+
+
+def test_writer_copies_rows_in_batches_and_flushes_on_close(conninfo):
+    with ConnectionPool(conninfo, min_size=1, max_size=2) as pool:
+        writer = PredictionLogWriter(pool, batch_size=10, flush_interval=0.05).start()
+        for i in range(25):
+            assert writer.log(log_features(store=i), float(i))
+        writer.close()
+        stats = writer.stats()
+
+    assert stats["written"] == 25
+    assert stats["queued"] == 0
+    assert stats["failed"] == stats["dropped"] == 0
+    with psycopg.connect(conninfo) as conn:
+        rows = conn.execute("SELECT store, prediction FROM prediction_logs ORDER BY store").fetchall()
+    assert rows == [(i, float(i)) for i in range(25)]
+
+
+def test_writer_drops_rows_when_the_queue_is_full():
+    # not started: nothing takes rows off the queue
+    writer = PredictionLogWriter(pool=None, max_queue_size=2)
+
+    assert [writer.log(log_features(), 1.0) for _ in range(3)] == [True, True, False]
+    assert writer.stats()["dropped"] == 1
+
+
+def test_writer_counts_rows_of_a_failed_copy():
+    class FailingPool:
+        def connection(self):
+            raise psycopg.OperationalError("connection refused")
+
+    writer = PredictionLogWriter(FailingPool())
+    writer.write_rows([("row",)] * 3)
+
+    assert writer.stats()["failed"] == 3
+    assert writer.stats()["written"] == 0
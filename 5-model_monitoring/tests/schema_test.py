@@ -0,0 +1,31 @@
+import threading
+from datetime import date
+
+import psycopg
+
+import schema
+
+
+def test_concurrent_workers_create_each_partition_once(conninfo):
+    # what gunicorn workers do on startup, all at once
+    barrier = threading.Barrier(4)
+    created = []
+    failures = []
+
+    def prep_db():
+        try:
+            with psycopg.connect(conninfo) as conn:
+                barrier.wait()
+                schema.create_schema(conn)
+                created.extend(schema.ensure_partitions(conn, start=date(2022, 1, 1), days=3))
+        except Exception as e:  # pylint: disable=broad-except
+            failures.append(e)
+
+    workers = [threading.Thread(target=prep_db) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert not failures
+    assert sorted(created) == [schema.partition_name(date(2022, 1, day)) for day in (1, 2, 3)]
@@ -0,0 +1,67 @@
+import os
+import glob
+import time
+import shutil
+
+import psycopg
+
+from segment_log import ArrowSegmentSink, read_segment, load_sealed_segments
+
+from .conftest import log_features
+
+
+def sealed(directory):
+    return sorted(glob.glob(os.path.join(directory, "*.arrow")))
+
+
+def test_sink_seals_a_segment_when_it_is_full(tmp_path):
+    sink = ArrowSegmentSink(str(tmp_path), batch_rows=2, max_segment_rows=4)
+    for i in range(5):
+        sink.log(log_features(store=i), float(i))
+
+    assert len(sealed(tmp_path)) == 1
+    table = read_segment(sealed(tmp_path)[0])
+    assert table.column("store").to_pylist() == [0, 1, 2, 3]
+    assert sink.stats() == {"buffered": 1, "rows": 4, "sealed_segments": 1, "open_segment_rows": 0}
+
+    sink.close()
+    assert len(sealed(tmp_path)) == 2
+    assert not glob.glob(os.path.join(tmp_path, "*.open"))
+
+
+def test_sink_seals_an_idle_segment_when_it_is_old_enough(tmp_path):
+    sink = ArrowSegmentSink(str(tmp_path), batch_rows=100, max_segment_seconds=0.2, check_interval=0.02).start()
+    sink.log(log_features(), 1.0)
+    try:
+        # no more rows arrive: the sealer thread seals the buffered one
+        deadline = time.monotonic() + 5
+        while not sealed(tmp_path) and time.monotonic() < deadline:
+            time.sleep(0.02)
+    finally:
+        sink.close()
+
+    assert len(sealed(tmp_path)) == 1
+    assert read_segment(sealed(tmp_path)[0]).num_rows == 1
+
+
+def test_load_sealed_segments_loads_each_segment_once(conninfo, tmp_path):
+    directory = tmp_path / "segments"
+    sink = ArrowSegmentSink(str(directory), batch_rows=2, max_segment_rows=2)
+    for i in range(4):
+        sink.log(log_features(store=i), float(i))
+    sink.close()
+    first = sealed(directory)[0]
+    shutil.copy(first, tmp_path / "copy")
+
+    assert load_sealed_segments(str(directory), conninfo) == (2, 4)
+    assert sealed(directory) == []
+
+    # e.g. the loader crashed after the commit, before removing the file
+    shutil.copy(tmp_path / "copy", first)
+    assert load_sealed_segments(str(directory), conninfo, keep=True) == (0, 0)
+    assert os.listdir(directory / "loaded") == [os.path.basename(first)]
+    with psycopg.connect(conninfo) as conn:
+        stores = [row[0] for row in conn.execute("SELECT store FROM prediction_logs ORDER BY store")]
+        ledger = conn.execute("SELECT count(*), sum(num_rows) FROM loaded_segments").fetchone()
+    assert stores == [0, 1, 2, 3]
+    assert ledger == (2, 4)
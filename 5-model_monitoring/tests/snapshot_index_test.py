@@ -0,0 +1,128 @@
+import json
+from datetime import datetime
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import snapshot_index
+
+
+def write_snapshot(project_dir, snapshot_id, day, rows, prediction_mean):
+    snapshot = {
+        "id": snapshot_id,
+        "timestamp": datetime(2022, 1, day).isoformat(),
+        "suite": {
+            "metrics": [
+                {"type": "evidently:metric:DatasetSummaryMetric"},
+                {
+                    "type": "evidently:metric:ColumnSummaryMetric",
+                    "column_name": {"type": "evidently:base:ColumnName", "name": "prediction"},
+                },
+            ],
+            "metric_results": [
+                {"type": "evidently:metric_result:DatasetSummaryMetricResult",
+                 "current": {"number_of_rows": rows, "date_column": None, "columns": ["store"]}},
+                {"type": "evidently:metric_result:ColumnSummaryResult",
+                 "current_characteristics": {"mean": prediction_mean, "histogram": [1, 2]}},
+            ],
+        },
+    }
+    snapshots = project_dir / "snapshots"
+    snapshots.mkdir(parents=True, exist_ok=True)
+    (snapshots / f"{snapshot_id}.json").write_text(json.dumps(snapshot))
+
+
+def test_snapshot_rows_keeps_the_numeric_leaves():
+    snapshot = {
+        "id": "s1",
+        "timestamp": "2022-01-02T00:00:00",
+        "suite": {
+            "metrics": [{"type": "evidently:metric:DatasetDriftMetric"}],
+            "metric_results": [{"type": "x", "drift_share": 0.5, "dataset_drift": True, "name": "y",
+                                "counts": {"drifted": 3, "values": [1, 2]}}],
+        },
+    }
+
+    rows = snapshot_index.snapshot_rows(snapshot)
+
+    assert list(zip(rows["field_path"], rows["value"])) == [
+        ("drift_share", 0.5), ("dataset_drift", 1.0), ("counts.drifted", 3.0)
+    ]
+    assert set(rows["metric_id"]) == {"DatasetDriftMetric"}
+
+
+def test_compact_project_indexes_only_new_snapshots(tmp_path):
+    project_dir = tmp_path / "project"
+    write_snapshot(project_dir, "b", 2, 20, 210.0)
+    write_snapshot(project_dir, "a", 1, 10, 200.0)
+
+    assert snapshot_index.compact_project(str(project_dir)) == 2
+    assert snapshot_index.compact_project(str(project_dir)) == 0
+    write_snapshot(project_dir, "c", 3, 30, 220.0)
+    (project_dir / "snapshots" / "broken.json").write_text("{")
+    assert snapshot_index.compact_project(str(project_dir)) == 1
+
+    rows = snapshot_index.query_metric(str(tmp_path), "project", "DatasetSummaryMetric", "current.number_of_rows")
+    assert rows.column("snapshot_id").to_pylist() == ["a", "b", "c"]
+    assert rows.column("value").to_pylist() == [10.0, 20.0, 30.0]
+    # one file per project, rewritten by each run
+    assert sorted(path.name for path in project_dir.iterdir()) == ["metrics_index.parquet", "snapshots"]
+
+
+def test_compact_project_merges_the_part_files_of_earlier_versions(tmp_path):
+    project_dir = tmp_path / "project"
+    write_snapshot(project_dir, "a", 1, 10, 200.0)
+    write_snapshot(project_dir, "b", 2, 20, 210.0)
+    snapshot_index.compact_project(str(project_dir))
+    # a part per run, as earlier versions wrote them: "b" was merged already
+    parts_dir = project_dir / snapshot_index.PARTS_DIR
+    parts_dir.mkdir()
+    for snapshot_id, day in (("b", 2), ("c", 3)):
+        snapshot = json.loads((project_dir / "snapshots" / "b.json").read_text())
+        snapshot.update(id=snapshot_id, timestamp=datetime(2022, 1, day).isoformat())
+        schema = snapshot_index.INDEX_SCHEMA.with_metadata({snapshot_index.SNAPSHOT_IDS_KEY: json.dumps([snapshot_id])})
+        pq.write_table(pa.table(snapshot_index.snapshot_rows(snapshot), schema=schema),
+                       str(parts_dir / f"part-{day}.parquet"))
+
+    assert snapshot_index.compact_project(str(project_dir)) == 0
+
+    assert snapshot_index.part_paths(str(project_dir)) == []
+    assert snapshot_index.indexed_snapshot_ids(snapshot_index.index_path(str(project_dir))) == {"a", "b", "c"}
+    rows = snapshot_index.query_metric(str(tmp_path), "project", "DatasetSummaryMetric", "current.number_of_rows")
+    assert rows.column("snapshot_id").to_pylist() == ["a", "b", "c"]
+
+
+def test_compact_project_remembers_snapshots_without_numeric_results(tmp_path):
+    project_dir = tmp_path / "project"
+    snapshots = project_dir / "snapshots"
+    snapshots.mkdir(parents=True)
+    empty = {"id": "empty", "timestamp": "2022-01-01T00:00:00", "suite": {"metrics": [], "metric_results": []}}
+    (snapshots / "empty.json").write_text(json.dumps(empty))
+
+    assert snapshot_index.compact_project(str(project_dir)) == 1
+    assert snapshot_index.compact_project(str(project_dir)) == 0
+    assert snapshot_index.indexed_snapshot_ids(snapshot_index.index_path(str(project_dir))) == {"empty"}
+
+
+def test_query_metric_without_index_is_empty(tmp_path):
+    rows = snapshot_index.query_metric(str(tmp_path), "project", "DatasetSummaryMetric", "current.number_of_rows")
+
+    assert rows.num_rows == 0
+    assert rows.column_names == ["timestamp", "snapshot_id", "value"]
+
+
+def test_query_metric_filters_by_column_and_time(tmp_path):
+    project_dir = tmp_path / "project"
+    for day in (1, 2, 3):
+        write_snapshot(project_dir, f"s{day}", day, day, 200.0 + day)
+    snapshot_index.compact_workspace(str(tmp_path))
+
+    rows = snapshot_index.query_metric(
+        str(tmp_path), "project", "ColumnSummaryMetric", "current_characteristics.mean",
+        column="prediction", start=datetime(2022, 1, 2), end=datetime(2022, 1, 3)
+    )
+    assert rows.column("value").to_pylist() == [202.0]
+    # the metric has a column: without one, nothing matches
+    rows = snapshot_index.query_metric(str(tmp_path), "project", "ColumnSummaryMetric",
+                                       "current_characteristics.mean")
+    assert rows.num_rows == 0
@@ -0,0 +1,322 @@
+"""Throughput benchmark of ModelService.lambda_handler.
+
+Runs the handler on synthetic Kinesis events for every model x batch size,
+publishing to an in-memory Kinesis, and reports records/s, per-record
+latency percentiles and the peak memory allocated per invocation.
+
+    python -m benchmark.bench_handler
+    python -m benchmark.bench_handler --check benchmark/baseline.local.json
+    python -m benchmark.bench_handler --save-baseline benchmark/baseline.local.json
+
+Throughput depends on the CPU and the Python version, so `--check` only
+fails against a baseline recorded on the same machine fingerprint. Against
+another machine's baseline the comparison is informational, and a missing
+baseline is recorded by the first check. With `--strict` (the default when
+the CI variable is set) a missing baseline or one from another machine is an
+error instead. `--tolerance` (BENCHMARK_TOLERANCE) is the allowed regression.
+"""
+
+import gc
+import os
+import sys
+import json
+import time
+import base64
+import random
+import argparse
+import datetime
+import platform
+import tracemalloc
+
+import model
+import publishing
+import event_codec
+from fake_kinesis import FakeKinesis
+
+
+def sales_input(rng):
+    date = datetime.date(2022, 1, 1) + datetime.timedelta(days=rng.randrange(730))
+    return {
+        "date": date.isoformat(),
+        "store": rng.randrange(1, 51),
+        "promo": rng.randrange(2),
+        "holiday": int(rng.random() < 0.05),
+    }
+
+
+def make_event(batch_size, seed=1, encoding="json"):
+    rng = random.Random(seed)
+    records = []
+    for sales_id in range(batch_size):
+        sales_event = {"sales_input": sales_input(rng), "sales_id": sales_id}
+        if encoding == "binary":
+            payload = event_codec.encode_sales_event(sales_event)
+        else:
+            payload = json.dumps(sales_event).encode("utf-8")
+        data = base64.b64encode(payload)
+        records.append(
+            {
+                "kinesis": {
+                    "data": data.decode("utf-8"),
+                    "sequenceNumber": str(sales_id),
+                    "partitionKey": str(sales_id),
+                }
+            }
+        )
+    return {"Records": records}
+
+
+class ModelMock:
+    def predict(self, x):
+        return [500.0] * len(x)
+
+
+def real_model(n_rows=5000, seed=1):
+    # the pipeline the training notebooks log to MLflow, fitted on synthetic rows
+    # pylint: disable=import-outside-toplevel
+    from sklearn.pipeline import make_pipeline
+    from sklearn.linear_model import LinearRegression
+    from sklearn.feature_extraction import DictVectorizer
+
+    rng = random.Random(seed)
+    model_service = model.ModelService(None)
+    rows = [model_service.prepare_features(sales_input(rng)) for _ in range(n_rows)]
+    target = [row["store"] * 10 + row["promo"] * 50 + rng.random() for row in rows]
+    return make_pipeline(DictVectorizer(), LinearRegression()).fit(rows, target)
+
+
+def create_model(name, model_location=None):
+    if name == "mock":
+        return ModelMock()
+    if model_location is not None:
+        return model.load_model_from(model_location)
+    return real_model()
+
+
+def percentile(sorted_values, q):
+    index = min(len(sorted_values) - 1, int(round(q / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run_case(
+    scoring_model, batch_size, min_seconds=1.0, min_invocations=5, encoding="json"
+):
+    event = make_event(batch_size, encoding=encoding)
+    kinesis = FakeKinesis()
+    kinesis.create_stream(StreamName="sales_predictions", ShardCount=1)
+    publisher = publishing.KinesisBatchPublisher(kinesis, "sales_predictions")
+    if encoding == "binary":
+        publisher.encode = event_codec.encode_prediction
+    model_service = model.ModelService(
+        scoring_model, "benchmark", callbacks=[publisher]
+    )
+    model_service.lambda_handler(event)  # warm-up
+
+    durations = []
+    # like timeit: no garbage collection pauses inside the timed calls
+    gc.collect()
+    gc.disable()
+    try:
+        started = time.perf_counter()
+        while (
+            len(durations) < min_invocations
+            or time.perf_counter() - started < min_seconds
+        ):
+            invocation_started = time.perf_counter()
+            model_service.lambda_handler(event)
+            durations.append(time.perf_counter() - invocation_started)
+            # keep the fake stream from growing over the run
+            kinesis.create_stream(StreamName="sales_predictions", ShardCount=1)
+            kinesis.calls.clear()
+    finally:
+        gc.enable()
+
+    # separate pass: tracing allocations slows everything down
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    before, _ = tracemalloc.get_traced_memory()
+    model_service.lambda_handler(event)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    per_record_us = sorted(duration / batch_size * 1e6 for duration in durations)
+    return {
+        "batch_size": batch_size,
+        "invocations": len(durations),
+        # from the fastest invocation: the least disturbed by other processes,
+        # so the most repeatable number to compare against a baseline
+        "records_per_sec": 1e6 / per_record_us[0],
+        "latency_us_p50": percentile(per_record_us, 50),
+        "latency_us_p95": percentile(per_record_us, 95),
+        "latency_us_p99": percentile(per_record_us, 99),
+        "peak_alloc_kib": (peak - before) / 1024,
+    }
+
+
+def cpu_model():
+    try:
+        with open("/proc/cpuinfo", "rt", encoding="utf-8") as f_in:
+            for line in f_in:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor()
+
+
+def machine_fingerprint():
+    """What the numbers of a run depend on, besides the code."""
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "cpu": cpu_model(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def check(results, baseline, tolerance):
+    """Regressions against the baseline as `(case, message)`: lower
+    throughput or more memory than `tolerance` allows."""
+    regressions = []
+    for name, result in results.items():
+        expected = baseline.get(name)
+        if expected is None:
+            continue
+        if result["records_per_sec"] < expected["records_per_sec"] * (1 - tolerance):
+            regressions.append(
+                (
+                    name,
+                    f"{result['records_per_sec']:.0f} records/s, "
+                    f"baseline {expected['records_per_sec']:.0f}",
+                )
+            )
+        if result["peak_alloc_kib"] > expected["peak_alloc_kib"] * (1 + tolerance):
+            regressions.append(
+                (
+                    name,
+                    f"{result['peak_alloc_kib']:.0f} KiB peak, "
+                    f"baseline {expected['peak_alloc_kib']:.0f}",
+                )
+            )
+    return regressions
+
+
+def print_results(results):
+    header = (
+        f"{'case':<20}{'records/s':>12}{'p50 us':>10}{'p95 us':>10}"
+        f"{'p99 us':>10}{'peak KiB':>10}"
+    )
+    print(header)
+    for name, result in results.items():
+        print(
+            f"{name:<20}{result['records_per_sec']:>12.0f}"
+            f"{result['latency_us_p50']:>10.1f}{result['latency_us_p95']:>10.1f}"
+            f"{result['latency_us_p99']:>10.1f}{result['peak_alloc_kib']:>10.0f}"
+        )
+
+
+def run():
+    parser = argparse.ArgumentParser(description="benchmark the streaming handler")
+    parser.add_argument("--models", default="mock,real")
+    parser.add_argument("--batch-sizes", default="1,10,100,500")
+    parser.add_argument(
+        "--encodings", default="json", help="record formats, e.g. json,binary"
+    )
+    parser.add_argument("--min-seconds", type=float, default=1.0)
+    parser.add_argument(
+        "--model-location",
+        default=None,
+        help="a model to load instead of the synthetic one",
+    )
+    parser.add_argument("--output", default=None, help="write the results as JSON")
+    parser.add_argument(
+        "--check", default=None, help="baseline JSON to compare against"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=float(os.getenv("BENCHMARK_TOLERANCE", "0.3")),
+        help="allowed throughput/memory regression, e.g. 0.3 for 30%%",
+    )
+    parser.add_argument(
+        "--strict",
+        action="store_true",
+        default=bool(os.getenv("CI")),
+        help="fail without a baseline of this machine instead of recording one",
+    )
+    parser.add_argument("--save-baseline", default=None)
+    args = parser.parse_args()
+
+    models = {
+        name: create_model(name, args.model_location) for name in args.models.split(",")
+    }
+    # json cases are named "<model>-<batch size>", the others get a suffix
+    cases = {
+        f"{name}-{batch_size}"
+        + ("" if encoding == "json" else f"-{encoding}"): (name, batch_size, encoding)
+        for encoding in args.encodings.split(",")
+        for name in models
+        for batch_size in map(int, args.batch_sizes.split(","))
+    }
+
+    def measure(case):
+        name, batch_size, encoding = cases[case]
+        return run_case(
+            models[name], batch_size, min_seconds=args.min_seconds, encoding=encoding
+        )
+
+    results = {case: measure(case) for case in cases}
+    print_results(results)
+
+    report = {"fingerprint": machine_fingerprint(), "results": results}
+    for path in filter(None, [args.output, args.save_baseline]):
+        with open(path, "wt", encoding="utf-8") as f_out:
+            json.dump(report, f_out, indent=2)
+
+    if args.check is not None:
+        check_baseline(args.check, report, measure, args.tolerance, args.strict)
+
+
+def check_baseline(path, report, measure, tolerance, strict=False):
+    """Compares the report with the baseline in `path` and exits 1 on
+    regressions, if the baseline comes from the same machine. With `strict`,
+    exits 2 if there is no baseline of this machine to compare with."""
+    if not os.path.exists(path):
+        if strict:
+            print(
+                f"no baseline at {path}: record one on this machine with "
+                "--save-baseline"
+            )
+            sys.exit(2)
+        with open(path, "wt", encoding="utf-8") as f_out:
+            json.dump(report, f_out, indent=2)
+        print(f"no baseline yet: saved this run to {path}")
+        return
+    with open(path, "rt", encoding="utf-8") as f_in:
+        baseline = json.load(f_in)
+    regressions = check(report["results"], baseline["results"], tolerance)
+    if baseline.get("fingerprint") != report["fingerprint"]:
+        # another CPU or Python: the differences say little about the code
+        for case, message in regressions:
+            print(f"slower {case}: {message}")
+        print(
+            f"{path} was recorded on {baseline.get('fingerprint')}, this is "
+            f"{report['fingerprint']}: the comparison is informational only"
+        )
+        if strict:
+            sys.exit(2)
+        return
+    if regressions:
+        # measured again before failing: a busy machine slows single runs
+        retried = {case: measure(case) for case, _ in regressions}
+        regressions = check(retried, baseline["results"], tolerance)
+    for case, message in regressions:
+        print(f"REGRESSION {case}: {message}")
+    if regressions:
+        sys.exit(1)
+    print(f"no regressions against {path} (tolerance {tolerance:.0%})")
+
+
+if __name__ == "__main__":
+    run()
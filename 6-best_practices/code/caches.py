@@ -0,0 +1,200 @@
+import sys
+import time
+import pickle
+import threading
+from collections import OrderedDict
+
+
+def estimate_model_size(model):
+    # serialized size as a proxy for the in-memory footprint
+    try:
+        return len(pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception:  # pylint: disable=broad-exception-caught
+        return sys.getsizeof(model)
+
+
+class BoundedLRU:
+    """Values in least recently used order, bounded by their total weight.
+
+    `put` evicts the least recently used values until the total weight is
+    at most `max_weight` again, but always keeps the value just put. Not
+    thread-safe: the caches below hold their own lock around it.
+    """
+
+    def __init__(self, max_weight):
+        self.max_weight = max_weight
+        self.weight = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, value, weight=1):
+        self.pop(key)
+        self._entries[key] = (value, weight)
+        self.weight += weight
+        while self.weight > self.max_weight and len(self._entries) > 1:
+            _, (_, evicted_weight) = self._entries.popitem(last=False)
+            self.weight -= evicted_weight
+            self.evictions += 1
+
+    def pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.weight -= entry[1]
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(self._entries)
+
+
+class _PendingLoad:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.model = None
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.model
+
+
+class ModelCache:
+    """LRU cache of loaded models keyed by run ID, bounded by a memory budget.
+
+    Concurrent requests for a version that is not loaded yet share a single
+    load of `loader(run_id)`. The least recently used models are evicted once
+    their total size, as measured by `sizeof`, exceeds `max_bytes`; the model
+    just loaded is always kept.
+    """
+
+    def __init__(self, loader, max_bytes=1024**3, sizeof=estimate_model_size):
+        self.loader = loader
+        self.sizeof = sizeof
+        self._models = BoundedLRU(max_bytes)
+        self._loading = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, run_id):
+        with self._lock:
+            model = self._models.get(run_id)
+            if model is not None:
+                self.hits += 1
+                return model
+
+            self.misses += 1
+            pending = self._loading.get(run_id)
+            if pending is not None:
+                owner = False
+            else:
+                pending = self._loading[run_id] = _PendingLoad()
+                owner = True
+
+        if not owner:
+            return pending.wait()
+
+        try:
+            # outside the lock: other versions are served meanwhile
+            model = self.loader(run_id)
+            size = self.sizeof(model)
+        except Exception as e:
+            with self._lock:
+                del self._loading[run_id]
+            pending.error = e
+            pending.done.set()
+            raise
+
+        with self._lock:
+            self._models.put(run_id, model, size)
+            del self._loading[run_id]
+
+        pending.model = model
+        pending.done.set()
+        return model
+
+    def __contains__(self, run_id):
+        return run_id in self._models
+
+    def stats(self):
+        return {
+            "models": list(self._models),
+            "max_bytes": self._models.max_weight,
+            "bytes": self._models.weight,
+            "hits": self.hits,
+            "misses": self.misses,
+            # a model is only loaded when it is not cached, and only leaves
+            # the cache by eviction
+            "loads": len(self._models) + self._models.evictions,
+            "evictions": self._models.evictions,
+        }
+
+
+class PredictionCache:
+    """LRU cache of published prediction events with a time to live.
+
+    Keyed by `(sales_id, model_version)`. Kinesis redelivers the whole batch
+    after a failure, so the records that were already scored and published
+    are answered from here instead. Entries expire after `ttl_seconds`; the
+    least recently used are dropped beyond `max_entries`.
+    """
+
+    def __init__(self, max_entries=100_000, ttl_seconds=3600.0, clock=time.monotonic):
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self._entries = BoundedLRU(max_entries)
+        # shared by the shard threads of the consumer
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= self.clock():
+                self._entries.pop(key)
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, prediction_event):
+        with self._lock:
+            self._entries.put(key, (self.clock() + self.ttl_seconds, prediction_event))
+
+    def put_event(self, prediction_event):
+        sales_id = prediction_event["prediction"]["sales_id"]
+        self.put((sales_id, prediction_event["version"]), prediction_event)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self._entries.max_weight,
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "evictions": self._entries.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,370 @@
+"""Long-running Kinesis consumer, an alternative to the Lambda trigger.
+
+Every shard of the input stream is read by its own thread, which scores a
+batch of records with a ModelService exactly like one Lambda invocation and
+then checkpoints the last sequence number of the batch. After a restart
+each shard continues after its checkpoint, so a batch that failed (e.g. a
+PublishError) is read and scored again. After a reshard, a child shard is
+only read once its parent shards are read to their end, so the records of a
+partition key are still scored in order.
+
+    INPUT_STREAM_NAME=sales_events RUN_ID=... python consumer.py
+"""
+
+import os
+import time
+import base64
+import signal
+import logging
+import sqlite3
+import threading
+
+import model
+
+logger = logging.getLogger(__name__)
+
+# the checkpoint of a shard that was closed by a reshard and read to its end
+SHARD_END = "SHARD_END"
+
+
+class CheckpointStore:
+    """Last processed sequence number per (stream, shard), kept in SQLite."""
+
+    def __init__(self, path=":memory:"):
+        # one connection shared by the shard threads, serialised by the lock
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "create table if not exists checkpoints("
+                "stream text not null, shard_id text not null, "
+                "sequence_number text not null, updated_at real not null, "
+                "primary key (stream, shard_id))"
+            )
+
+    def get(self, stream_name, shard_id):
+        with self._lock:
+            row = self._conn.execute(
+                "select sequence_number from checkpoints where stream = ? and shard_id = ?",
+                (stream_name, shard_id),
+            ).fetchone()
+        return row[0] if row else None
+
+    def save(self, stream_name, shard_id, sequence_number):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "insert into checkpoints values (?, ?, ?, ?) "
+                "on conflict (stream, shard_id) do update set "
+                "sequence_number = excluded.sequence_number, updated_at = excluded.updated_at",
+                (stream_name, shard_id, sequence_number, time.time()),
+            )
+
+    def close(self):
+        self._conn.close()
+
+
+def kinesis_event(records):
+    # the event Lambda would deliver for these records, so ModelService is
+    # used unchanged
+    return {
+        "Records": [
+            {
+                "kinesis": {
+                    "data": base64.b64encode(record["Data"]).decode("ascii"),
+                    "sequenceNumber": record["SequenceNumber"],
+                    "partitionKey": record["PartitionKey"],
+                }
+            }
+            for record in records
+        ]
+    }
+
+
+class ShardWorker:
+    """Reads one shard in batches and checkpoints after every scored batch."""
+
+    def __init__(self, consumer, shard_id):
+        self.consumer = consumer
+        self.shard_id = shard_id
+        # own ModelService and publisher: a flush only sends this shard's events
+        self.model_service = consumer.service_factory()
+        self.iterator = None
+        # read to the end of a shard closed by a reshard
+        self.closed = False
+        self.stats = {
+            "records": 0,
+            "batches": 0,
+            "errors": 0,
+            "failed_batches": 0,
+            "behind_latest": None,
+        }
+
+    def reset_iterator(self):
+        # continue after the checkpoint; without one, a child shard from its
+        # start (its parents were read) and other shards from the initial
+        # position
+        consumer = self.consumer
+        checkpoint = consumer.checkpoints.get(consumer.stream_name, self.shard_id)
+        if checkpoint is None:
+            initial_position = consumer.initial_position
+            if consumer.parents.get(self.shard_id):
+                initial_position = "TRIM_HORIZON"
+            kwargs = {"ShardIteratorType": initial_position}
+        else:
+            kwargs = {
+                "ShardIteratorType": "AFTER_SEQUENCE_NUMBER",
+                "StartingSequenceNumber": checkpoint,
+            }
+        response = consumer.kinesis_client.get_shard_iterator(
+            StreamName=consumer.stream_name, ShardId=self.shard_id, **kwargs
+        )
+        self.iterator = response["ShardIterator"]
+
+    def poll_once(self):
+        """Reads and scores one batch, returns the number of records read.
+
+        Sets `closed` once a shard closed by a reshard is read to its end.
+        """
+        consumer = self.consumer
+        if self.closed:
+            return 0
+        if consumer.checkpoints.get(consumer.stream_name, self.shard_id) == SHARD_END:
+            self.closed = True
+            return 0
+        if self.iterator is None:
+            self.reset_iterator()
+        response = consumer.kinesis_client.get_records(
+            ShardIterator=self.iterator, Limit=consumer.batch_size
+        )
+        records = response["Records"]
+        self.stats["behind_latest"] = response.get("MillisBehindLatest")
+
+        if records:
+            try:
+                result = self.model_service.lambda_handler(kinesis_event(records))
+            except Exception:
+                # not checkpointed: the batch is read again from the checkpoint
+                self.stats["failed_batches"] += 1
+                self.iterator = None
+                raise
+            consumer.checkpoints.save(
+                consumer.stream_name, self.shard_id, records[-1]["SequenceNumber"]
+            )
+            self.stats["records"] += len(records)
+            self.stats["batches"] += 1
+            self.stats["errors"] += len(result.get("errors", []))
+
+        self.iterator = response.get("NextShardIterator")
+        if self.iterator is None:
+            consumer.checkpoints.save(consumer.stream_name, self.shard_id, SHARD_END)
+            self.closed = True
+        return len(records)
+
+    def run(self, stop):
+        consumer = self.consumer
+        while not stop.is_set():
+            started = time.monotonic()
+            try:
+                read = self.poll_once()
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                # e.g. an expired iterator or a failed publish: back off, retry
+                logger.warning("shard %s: %s", self.shard_id, e)
+                self.iterator = None
+                stop.wait(consumer.error_backoff)
+                continue
+            if self.closed:
+                logger.info("shard %s is closed", self.shard_id)
+                try:
+                    # its children can be read now, not only at the next refresh
+                    consumer.start_workers()
+                except Exception as e:  # pylint: disable=broad-exception-caught
+                    logger.warning("starting the child shards failed: %s", e)
+                return
+            # a full batch: read on, at most one call per min_poll_interval
+            # (GetRecords allows 5 calls per second and shard)
+            wait = consumer.poll_interval if read == 0 else consumer.min_poll_interval
+            stop.wait(max(0.0, wait - (time.monotonic() - started)))
+
+
+class StreamConsumer:
+    """Runs one ShardWorker thread per shard of `stream_name`.
+
+    `service_factory` returns a new ModelService for each shard. The shard
+    list is refreshed every `shard_refresh_seconds`, so shards added by a
+    reshard get a worker as well: once their parent shards are read to their
+    end, like the Kinesis Client Library does.
+    """
+
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+
+    def __init__(
+        self,
+        kinesis_client,
+        stream_name,
+        service_factory,
+        checkpoints,
+        *,
+        batch_size=500,
+        initial_position="TRIM_HORIZON",
+        poll_interval=1.0,
+        min_poll_interval=0.2,
+        shard_refresh_seconds=60.0,
+        error_backoff=1.0,
+    ):
+        self.kinesis_client = kinesis_client
+        self.stream_name = stream_name
+        self.service_factory = service_factory
+        self.checkpoints = checkpoints
+        self.batch_size = batch_size
+        self.initial_position = initial_position
+        self.poll_interval = poll_interval
+        self.min_poll_interval = min_poll_interval
+        self.shard_refresh_seconds = shard_refresh_seconds
+        self.error_backoff = error_backoff
+        self.workers = {}
+        # parent shard ids per shard, from the last list_shards
+        self.parents = {}
+        self._threads = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def list_shards(self):
+        response = self.kinesis_client.list_shards(StreamName=self.stream_name)
+        self.parents = {
+            shard["ShardId"]: [
+                shard[key]
+                for key in ("ParentShardId", "AdjacentParentShardId")
+                if shard.get(key) is not None
+            ]
+            for shard in response["Shards"]
+        }
+        return list(self.parents)
+
+    def is_finished(self, shard_id):
+        return self.checkpoints.get(self.stream_name, shard_id) == SHARD_END
+
+    def is_ready(self, shard_id):
+        # parents that are no longer listed have expired, their records too
+        return all(
+            parent not in self.parents or self.is_finished(parent)
+            for parent in self.parents.get(shard_id, [])
+        )
+
+    def worker(self, shard_id):
+        if shard_id not in self.workers:
+            self.workers[shard_id] = ShardWorker(self, shard_id)
+        return self.workers[shard_id]
+
+    def drain(self):
+        """Polls every shard until none returns records, on the calling thread.
+
+        For tests and benchmarks against a stream that is not written to.
+        """
+        total = 0
+        while True:
+            read = closed = 0
+            for shard_id in self.list_shards():
+                if self.is_ready(shard_id) and not self.is_finished(shard_id):
+                    worker = self.worker(shard_id)
+                    read += worker.poll_once()
+                    # the children of a shard that just closed are ready now
+                    closed += worker.closed
+            if not read and not closed:
+                return total
+            total += read
+
+    def start_workers(self):
+        with self._lock:
+            if self._stop.is_set():
+                return
+            for shard_id in self.list_shards():
+                if shard_id in self._threads or self.is_finished(shard_id):
+                    # running, or closed after a reshard and fully processed
+                    continue
+                if not self.is_ready(shard_id):
+                    # started when the last of its parents closes
+                    continue
+                thread = threading.Thread(
+                    target=self.worker(shard_id).run,
+                    args=(self._stop,),
+                    name=f"shard-{shard_id}",
+                    daemon=True,
+                )
+                self._threads[shard_id] = thread
+                thread.start()
+                logger.info("reading shard %s", shard_id)
+
+    def run(self):
+        while not self._stop.is_set():
+            try:
+                self.start_workers()
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                logger.warning("listing the shards failed: %s", e)
+            self._stop.wait(self.shard_refresh_seconds)
+        with self._lock:
+            threads = list(self._threads.values())
+        for thread in threads:
+            thread.join()
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        return {
+            shard_id: dict(worker.stats) for shard_id, worker in self.workers.items()
+        }
+
+
+def create_service_factory(prediction_stream_name, run_id, test_run):
+    # the model is loaded once and shared, callbacks are per shard; the shared
+    # ActiveModel lets a hot swap of its ModelWatcher reach every shard
+    model_service = model.init(
+        prediction_stream_name=prediction_stream_name,
+        run_id=run_id,
+        test_run=True,
+    )
+    kinesis_client = None if test_run else model.create_kinesis_client()
+
+    def service_factory():
+        return model.ModelService(
+            model=None,
+            # configured like the callbacks of init(), e.g. PREDICTION_ENCODING
+            emitter=model.create_emitter(kinesis_client, prediction_stream_name),
+            active_model=model_service.active_model,
+            model_cache=model_service.model_cache,
+            # shared: a redelivered record is found whichever shard reads it
+            prediction_cache=model_service.prediction_cache,
+        )
+
+    return service_factory
+
+
+def run():
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s [%(levelname)s]: %(message)s"
+    )
+    stream_name = os.getenv("INPUT_STREAM_NAME", "sales_events")
+    consumer = StreamConsumer(
+        model.create_kinesis_client(),
+        stream_name,
+        create_service_factory(
+            prediction_stream_name=os.getenv(
+                "PREDICTIONS_STREAM_NAME", "sales_predictions"
+            ),
+            run_id=os.getenv("RUN_ID", "080e0226c1fc49cc818d3c023625b36d"),
+            test_run=os.getenv("TEST_RUN", "False") == "True",
+        ),
+        CheckpointStore(os.getenv("CHECKPOINT_DB", "checkpoints.sqlite")),
+        batch_size=int(os.getenv("BATCH_SIZE", "500")),
+        initial_position=os.getenv("INITIAL_POSITION", "TRIM_HORIZON"),
+        poll_interval=float(os.getenv("POLL_SECONDS", "1.0")),
+    )
+    # docker stop / Ctrl-C: finish the current batches, then exit
+    signal.signal(signal.SIGTERM, lambda *_: consumer.stop())
+    signal.signal(signal.SIGINT, lambda *_: consumer.stop())
+    consumer.run()
+    logger.info("stopped: %s", consumer.stats())
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,168 @@
+"""Compact binary encoding of sales events and predictions.
+
+A JSON record starts with "{" once leading whitespace and a UTF-8 byte order
+mark are skipped, a binary record with its format version byte, so both can
+be mixed on a stream and told apart per record.
+
+Sales event, version 1 (18 bytes, little-endian), then the run_id as UTF-8
+if flag 1 is set:
+
+    version u1 | flags u1 | store u2 | promo u1 | holiday u1 |
+    date i4 (days since 1970-01-01) | sales_id i8
+
+Prediction, version 1 (18 bytes), then the model version as UTF-8, empty
+for a version of None. A prediction whose sales_id is not an int64 is
+published as JSON instead:
+
+    version u1 | flags u1 | sales_id i8 | sales_prediction f8
+
+The fixed part of a sales event maps onto a NumPy structured dtype, so a
+whole batch is decoded into columns at once instead of parsing one JSON document per record.
+Single records are encoded with `struct` using the same layout.
+"""
+
+import json
+import struct
+import datetime
+
+import numpy as np
+
+UTF8_BOM = b"\xef\xbb\xbf"
+JSON_WHITESPACE = b" \t\r\n"
+SALES_EVENT_V1 = 1
+PREDICTION_V1 = 1
+FLAG_RUN_ID = 1
+
+SALES_RECORD_V1 = np.dtype(
+    [
+        ("version", "u1"),
+        ("flags", "u1"),
+        ("store", "<u2"),
+        ("promo", "u1"),
+        ("holiday", "u1"),
+        ("date", "<i4"),
+        ("sales_id", "<i8"),
+    ]
+)
+
+# the same layouts for one record at a time
+SALES_STRUCT_V1 = struct.Struct("<BBHBBiq")
+PREDICTION_STRUCT_V1 = struct.Struct("<BBqd")
+
+EPOCH = datetime.date(1970, 1, 1)
+
+
+def is_json(payload):
+    # json.loads accepts both, and neither can start a binary record
+    if payload.startswith(UTF8_BOM):
+        payload = payload[len(UTF8_BOM) :]
+    return payload.lstrip(JSON_WHITESPACE)[:1] == b"{"
+
+
+def encode_sales_event(sales_event):
+    sales_input = sales_event["sales_input"]
+    date = datetime.date.fromisoformat(str(sales_input["date"])[:10])
+    run_id = sales_event.get("run_id")
+    record = SALES_STRUCT_V1.pack(
+        SALES_EVENT_V1,
+        FLAG_RUN_ID if run_id is not None else 0,
+        sales_input["store"],
+        sales_input["promo"],
+        sales_input["holiday"],
+        (date - EPOCH).days,
+        sales_event["sales_id"],
+    )
+    return record + (run_id.encode("utf-8") if run_id is not None else b"")
+
+
+def check_sales_record(payload):
+    if not payload or is_json(payload):
+        raise ValueError("not a binary sales record")
+    if payload[0] != SALES_EVENT_V1:
+        raise ValueError(f"unknown sales record version {payload[0]}")
+    if len(payload) < SALES_RECORD_V1.itemsize:
+        raise ValueError(f"sales record of {len(payload)} bytes is truncated")
+    if payload[1] & FLAG_RUN_ID:
+        # raises UnicodeDecodeError (a ValueError) before the batch is decoded
+        payload[SALES_RECORD_V1.itemsize :].decode("utf-8")
+
+
+def decode_sales_batch(payloads):
+    """Decodes binary sales records into columns.
+
+    Returns a dict of NumPy arrays (`sales_id`, `store`, `promo`, `holiday`,
+    `year`, `month`, `dayofweek`, `is_weekend`) and the list of run_ids,
+    None where a record has none. The payloads must pass
+    `check_sales_record`.
+    """
+    size = SALES_RECORD_V1.itemsize
+    fixed = np.frombuffer(
+        b"".join(payload[:size] for payload in payloads), dtype=SALES_RECORD_V1
+    )
+    days = fixed["date"].astype("int64")
+    dates = days.astype("datetime64[D]")
+    months = dates.astype("datetime64[M]").astype("int64")
+    # 1970-01-01 was a Thursday; Monday=0 like pandas' dayofweek
+    dayofweek = (days + 3) % 7
+    columns = {
+        "sales_id": fixed["sales_id"],
+        "store": fixed["store"],
+        "promo": fixed["promo"],
+        "holiday": fixed["holiday"],
+        "year": months // 12 + 1970,
+        "month": months % 12 + 1,
+        "dayofweek": dayofweek,
+        "is_weekend": (dayofweek >= 5).astype("int64"),
+    }
+    run_ids = [
+        payload[size:].decode("utf-8") if payload[1] & FLAG_RUN_ID else None
+        for payload in payloads
+    ]
+    return columns, run_ids
+
+
+FEATURE_COLUMNS = [
+    "store",
+    "promo",
+    "holiday",
+    "year",
+    "month",
+    "dayofweek",
+    "is_weekend",
+]
+
+
+def feature_dicts(columns):
+    # the model takes the same feature dicts as prepare_features builds;
+    # tolist() turns whole columns into Python ints at once
+    values = [columns[name].tolist() for name in FEATURE_COLUMNS]
+    return [dict(zip(FEATURE_COLUMNS, row)) for row in zip(*values)]
+
+
+def encode_prediction(prediction_event):
+    """The binary record of a prediction event, or its JSON if it does not fit
+    the layout, e.g. a string sales_id or one outside the int64 range."""
+    prediction = prediction_event["prediction"]
+    try:
+        record = PREDICTION_STRUCT_V1.pack(
+            PREDICTION_V1, 0, prediction["sales_id"], prediction["sales_prediction"]
+        )
+    except struct.error:
+        # decode_prediction tells the formats apart per record
+        return json.dumps(prediction_event).encode("utf-8")
+    version = prediction_event["version"]
+    return record + (str(version).encode("utf-8") if version is not None else b"")
+
+
+def decode_prediction(data):
+    """The prediction event of a record in either format."""
+    if is_json(data):
+        return json.loads(data)
+    if data[0] != PREDICTION_V1 or len(data) < PREDICTION_STRUCT_V1.size:
+        raise ValueError("not a binary prediction record")
+    _, _, sales_id, sales_prediction = PREDICTION_STRUCT_V1.unpack_from(data)
+    return {
+        "model": "sales_prediction_model",
+        "version": data[PREDICTION_STRUCT_V1.size :].decode("utf-8") or None,
+        "prediction": {"sales_prediction": sales_prediction, "sales_id": sales_id},
+    }
@@ -0,0 +1,168 @@
+import time
+import hashlib
+import threading
+
+# keyword arguments are named like the boto3 ones
+# pylint: disable=invalid-name
+
+MAX_HASH_KEY = 2**128 - 1
+
+
+class FakeKinesis:
+    """In-memory stand-in for the Kinesis client, for tests and benchmarks.
+
+    Implements the calls used by the consumer and the publishers:
+    `create_stream`, `split_shard`, `list_shards`, `get_shard_iterator`,
+    `get_records`, `put_record` and `put_records`. Like Kinesis, records are
+    routed to the open shard whose hash key range holds the MD5 of their
+    partition key and get increasing sequence numbers; shard iterators are
+    plain strings. A split closes the parent shard: its iterator ends
+    (`NextShardIterator` None) once its records are read.
+
+    `failures` maps a partition key to the number of times `put_records`
+    rejects it, and `calls` holds the partition keys of every `put_records`
+    call.
+    """
+
+    def __init__(self, failures=None):
+        self.streams = {}
+        self.shards = {}
+        self.failures = failures or {}
+        self.calls = []
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def create_stream(self, StreamName, ShardCount=1):
+        with self._lock:
+            self.streams[StreamName] = {}
+            self.shards[StreamName] = {}
+            width = (MAX_HASH_KEY + 1) // ShardCount
+            for index in range(ShardCount):
+                end = (
+                    MAX_HASH_KEY if index == ShardCount - 1 else (index + 1) * width - 1
+                )
+                self._add_shard(StreamName, index * width, end)
+
+    def _add_shard(self, stream_name, start, end, parent=None):
+        shard_id = f"shardId-{len(self.shards[stream_name]):012d}"
+        shard = {
+            "ShardId": shard_id,
+            "HashKeyRange": {"StartingHashKey": str(start), "EndingHashKey": str(end)},
+        }
+        if parent is not None:
+            shard["ParentShardId"] = parent
+        self.shards[stream_name][shard_id] = shard
+        self.streams[stream_name][shard_id] = []
+        return shard_id
+
+    def split_shard(self, StreamName, ShardToSplit, NewStartingHashKey):
+        with self._lock:
+            shard = self._shards(StreamName)[ShardToSplit]
+            if "EndingSequenceNumber" in shard:
+                raise ValueError(f"shard {ShardToSplit} is closed")
+            start = int(shard["HashKeyRange"]["StartingHashKey"])
+            end = int(shard["HashKeyRange"]["EndingHashKey"])
+            middle = int(NewStartingHashKey)
+            shard["EndingSequenceNumber"] = f"{self._sequence:056d}"
+            self._add_shard(StreamName, start, middle - 1, parent=ShardToSplit)
+            self._add_shard(StreamName, middle, end, parent=ShardToSplit)
+
+    def _shards(self, stream_name):
+        if stream_name not in self.shards:
+            raise KeyError(f"stream {stream_name} not found")
+        return self.shards[stream_name]
+
+    def shard_for(self, stream_name, partition_key):
+        key_hash = int(hashlib.md5(partition_key.encode("utf-8")).hexdigest(), 16)
+        for shard_id, shard in self._shards(stream_name).items():
+            hash_range = shard["HashKeyRange"]
+            if "EndingSequenceNumber" not in shard and int(
+                hash_range["StartingHashKey"]
+            ) <= key_hash <= int(hash_range["EndingHashKey"]):
+                return shard_id
+        raise KeyError(f"no open shard for {partition_key}")
+
+    def _append(self, stream_name, data, partition_key):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        with self._lock:
+            shard_id = self.shard_for(stream_name, partition_key)
+            self._sequence += 1
+            sequence_number = f"{self._sequence:056d}"
+            self.streams[stream_name][shard_id].append(
+                {
+                    "SequenceNumber": sequence_number,
+                    "Data": data,
+                    "PartitionKey": partition_key,
+                    "ApproximateArrivalTimestamp": time.time(),
+                }
+            )
+        return {"ShardId": shard_id, "SequenceNumber": sequence_number}
+
+    def put_record(self, StreamName, Data, PartitionKey):
+        return self._append(StreamName, Data, PartitionKey)
+
+    def put_records(self, StreamName, Records):
+        self.calls.append([entry["PartitionKey"] for entry in Records])
+        results = []
+        for entry in Records:
+            key = entry["PartitionKey"]
+            if self.failures.get(key, 0) > 0:
+                self.failures[key] -= 1
+                results.append(
+                    {
+                        "ErrorCode": "ProvisionedThroughputExceededException",
+                        "ErrorMessage": "Rate exceeded for shard",
+                    }
+                )
+            else:
+                results.append(self._append(StreamName, entry["Data"], key))
+        failed = sum("ErrorCode" in result for result in results)
+        return {"FailedRecordCount": failed, "Records": results}
+
+    def list_shards(self, StreamName):
+        shards = []
+        for shard in self._shards(StreamName).values():
+            shard = dict(shard)
+            ending = shard.pop("EndingSequenceNumber", None)
+            if ending is not None:
+                shard["SequenceNumberRange"] = {"EndingSequenceNumber": ending}
+            shards.append(shard)
+        return {"Shards": shards}
+
+    def get_shard_iterator(
+        self, StreamName, ShardId, ShardIteratorType, StartingSequenceNumber=None
+    ):
+        records = self.streams[StreamName][ShardId]
+        if ShardIteratorType == "TRIM_HORIZON":
+            position = 0
+        elif ShardIteratorType == "LATEST":
+            position = len(records)
+        elif ShardIteratorType == "AFTER_SEQUENCE_NUMBER":
+            position = sum(
+                1
+                for record in records
+                if int(record["SequenceNumber"]) <= int(StartingSequenceNumber)
+            )
+        else:
+            raise ValueError(f"unsupported ShardIteratorType {ShardIteratorType}")
+        return {"ShardIterator": f"{StreamName}|{ShardId}|{position}"}
+
+    def get_records(self, ShardIterator, Limit=10000):
+        stream_name, shard_id, position = ShardIterator.split("|")
+        position = int(position)
+        with self._lock:
+            records = self.streams[stream_name][shard_id]
+            batch = records[position : position + Limit]
+            behind = len(records) - position - len(batch)
+            closed = "EndingSequenceNumber" in self.shards[stream_name][shard_id]
+        next_iterator = f"{stream_name}|{shard_id}|{position + len(batch)}"
+        if closed and not behind:
+            # the end of a closed shard
+            next_iterator = None
+        return {
+            "Records": batch,
+            "NextShardIterator": next_iterator,
+            # records left rather than milliseconds, enough to see the lag
+            "MillisBehindLatest": behind,
+        }
@@ -1,36 +1,141 @@
 import os
 import json
+import time
 import base64
-
-import boto3
-import mlflow
-import pandas as pd
-
-# pylint: disable=invalid-name
+import pickle
+import datetime
+from contextlib import contextmanager
+
+import event_codec
+from caches import ModelCache, PredictionCache
+from publishing import PredictionEmitter, CallbackDispatcher, KinesisBatchPublisher
+from model_watcher import (
+    CANARY_SALES,
+    ActiveModel,
+    ModelWatcher,
+    registry_version_source,
+    local_path_version_source,
+)
+
+# mlflow, boto3 and pandas take seconds to import: they are imported where they
+# are needed, so a model exported with scripts/export_model.py is served
+# without importing MLflow at all
+# pylint: disable=invalid-name,import-outside-toplevel
 
 
 def get_model_location(run_id):
     model_location = os.getenv("MODEL_LOCATION")
 
     if model_location is not None:
-        return model_location
+        # "{run_id}" in it is replaced by the run, e.g. /models/{run_id} to
+        # serve several versions from local directories
+        return model_location.replace("{run_id}", str(run_id))
 
     S3_BUCKET_NAME = os.getenv("S3_BUCKET_NAME", "mlartifact-s3")
     EXP_ID = os.getenv("EXP_ID", "6")
+    # MODEL_FORMAT=pickle: the slim artifact exported next to the MLflow model
+    artifact = "model.pkl" if os.getenv("MODEL_FORMAT") == "pickle" else "model"
 
-    model_location = f"s3://{S3_BUCKET_NAME}/{EXP_ID}/{run_id}/artifacts/model"
+    model_location = f"s3://{S3_BUCKET_NAME}/{EXP_ID}/{run_id}/artifacts/{artifact}"
     return model_location
 
 
-def load_mode(run_id):
+def parse_date(value):
+    # "2022-12-25", also with a time part, without a parser import; dateutil
+    # for the other formats pd.to_datetime accepted, e.g. "2022-1-5" or
+    # "2022/12/25" (Python 3.9's fromisoformat only takes YYYY-MM-DD)
+    text = str(value)
+    try:
+        return datetime.date.fromisoformat(text[:10])
+    except ValueError:
+        from dateutil import parser
+
+        return parser.parse(text).date()
+
+
+class InitTimer:
+    """Wall time of the cold-start phases, in milliseconds."""
+
+    def __init__(self):
+        self.timings = {}
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = (time.perf_counter() - started) * 1000
+            self.timings[name] = self.timings.get(name, 0.0) + elapsed
+
+
+def is_pickle_location(model_location):
+    return model_location.endswith(".pkl")
+
+
+def download_model(model_location, timer=None):
+    """Local path of the model artifact, downloaded from S3 if needed."""
+    timer = timer or InitTimer()
+
+    if not is_pickle_location(model_location):
+        with timer.phase("imports"):
+            import mlflow
+        with timer.phase("download"):
+            return mlflow.artifacts.download_artifacts(artifact_uri=model_location)
+
+    if not model_location.startswith("s3://"):
+        return model_location
+
+    with timer.phase("imports"):
+        import boto3
+    with timer.phase("download"):
+        bucket, key = model_location[len("s3://") :].split("/", 1)
+        local_path = os.path.join("/tmp", key.replace("/", "_"))
+        if not os.path.exists(local_path):
+            boto3.client("s3").download_file(bucket, key, local_path)
+    return local_path
+
+
+def deserialize_model(local_path, timer=None):
+    timer = timer or InitTimer()
+
+    if not is_pickle_location(local_path):
+        with timer.phase("imports"):
+            import mlflow
+        with timer.phase("deserialize"):
+            return mlflow.pyfunc.load_model(local_path)
+
+    # the fitted pipeline itself: only scikit-learn is imported to unpickle it
+    with timer.phase("deserialize"):
+        with open(local_path, "rb") as f_in:
+            return pickle.load(f_in)
+
+
+def load_model_from(model_location, timer=None):
+    return deserialize_model(download_model(model_location, timer), timer)
+
+
+def load_mode(run_id, timer=None):
 
     # local path
     model_path = get_model_location(run_id)
-    model = mlflow.pyfunc.load_model(model_path)
+    model = load_model_from(model_path, timer)
 
     return model
 
 
+def load_run_model(run_id):
+    # the loader of a ModelCache: a MODEL_LOCATION without "{run_id}" is the
+    # same model for every run, and must not score records of another version
+    model_location = os.getenv("MODEL_LOCATION")
+    if model_location is not None and "{run_id}" not in model_location:
+        raise ValueError(
+            f"MODEL_LOCATION={model_location} has no {{run_id}} placeholder, "
+            f"cannot load run {run_id}"
+        )
+    return load_mode(run_id)
+
+
 def base64_decode(encoded_data):
 
     decoded_data = base64.b64decode(encoded_data).decode("utf-8")
@@ -39,77 +144,295 @@ def base64_decode(encoded_data):
     return sales_event
 
 
+def record_error(index, record, message):
+    return {
+        "index": index,
+        "sequence_number": record.get("kinesis", {}).get("sequenceNumber"),
+        "error": message,
+    }
+
+
 class ModelService:
 
-    def __init__(self, model, model_version=None, callbacks=None):
-        self.model = model
-        self.model_version = model_version
-        self.callbacks = callbacks or []
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        model,
+        model_version=None,
+        callbacks=None,
+        *,
+        model_cache=None,
+        dispatcher=None,
+        prediction_cache=None,
+        active_model=None,
+        emitter=None,
+    ):
+        # a shared ActiveModel replaces model and model_version
+        self.active_model = active_model or ActiveModel(model, model_version)
+        # optional CallbackDispatcher: callbacks run on its threads instead of
+        # inline; an emitter from create_emitter() replaces both
+        self.emitter = emitter or PredictionEmitter(callbacks, dispatcher)
+        # optional ModelCache: events with a "run_id" are scored by that version
+        self.model_cache = model_cache
+        # optional PredictionCache of published events by (sales_id, version)
+        self.prediction_cache = prediction_cache
+        # per-phase cold-start times and the ModelWatcher, set by init()
+        self.init_timings = {}
+        self.watcher = None
+
+    @property
+    def model(self):
+        return self.active_model.current[0]
+
+    @property
+    def model_version(self):
+        return self.active_model.current[1]
+
+    @property
+    def callbacks(self):
+        return self.emitter.callbacks
+
+    @property
+    def predict_chunk_size(self):
+        # records are scored in chunks of this size, so that with a
+        # dispatcher the callbacks of one chunk overlap with the next chunk
+        return self.emitter.chunk_size
+
+    @predict_chunk_size.setter
+    def predict_chunk_size(self, chunk_size):
+        self.emitter.chunk_size = chunk_size
+
+    def swap_model(self, model, model_version):
+        self.active_model.swap(model, model_version)
 
     def prepare_features(self, row):
-        date = pd.to_datetime(row["date"])
+        # dayofweek: Monday=0 like pandas
+        date = parse_date(row["date"])
         features = {
             "store": row["store"],
             "promo": row["promo"],
             "holiday": row["holiday"],
             "year": date.year,
             "month": date.month,
-            "dayofweek": date.dayofweek,
-            "is_weekend": int(date.dayofweek >= 5),
+            "dayofweek": date.weekday(),
+            "is_weekend": int(date.weekday() >= 5),
         }
         return features
 
-    def predict(self, features):
+    def predict(self, features, model=None):
 
-        pred = self.model.predict(features)
+        if model is None:
+            model = self.model
+        pred = model.predict(features)
         return float(pred[0])
 
-    def lambda_handler(self, event):
-
-        predictions_events = []
-
-        for record in event["Records"]:
-            encoded_data = record["kinesis"]["data"]
-            decoded_data = base64.b64decode(encoded_data).decode("utf-8")
-            sales_event = json.loads(decoded_data)
-
-            sales = sales_event["sales_input"]
-            sales_id = sales_event["sales_id"]
-
-            features = self.prepare_features(sales)
-            prediction = self.predict(features)
-
-            prediction_event = {
+    def predict_batch(self, features_batch, model=None):
+        # one model call for a list of feature dicts
+        if model is None:
+            model = self.model
+        preds = model.predict(features_batch)
+        return [float(pred) for pred in preds]
+
+    def version_for(self, run_id, model_version):
+        # the version that scores a record, without loading it
+        if run_id is None or self.model_cache is None:
+            return model_version
+        return run_id
+
+    def load_models(self, decoded, pending, records, model, model_version):
+        """Loads the model of every pending record, each version once.
+
+        Returns the models keyed by version, the pending positions whose model
+        is loaded, and an error entry per record whose model cannot be loaded:
+        only those records fail, not the batch.
+        """
+        models = {model_version: model}
+        unavailable = {}
+        loaded, errors = [], []
+        for position in pending:
+            _, _, run_id, index = decoded[position]
+            record_version = self.version_for(run_id, model_version)
+            if record_version not in models and record_version not in unavailable:
+                try:
+                    models[record_version] = self.model_cache.get(run_id)
+                except Exception as e:  # pylint: disable=broad-exception-caught
+                    # a missing run, a fixed MODEL_LOCATION, S3 errors...
+                    unavailable[record_version] = f"{type(e).__name__}: {e}"
+            if record_version in unavailable:
+                errors.append(
+                    record_error(index, records[index], unavailable[record_version])
+                )
+            else:
+                loaded.append(position)
+        return models, loaded, errors
+
+    def decode_records(self, records):
+        """Decodes the Kinesis records and prepares their features.
+
+        Records may be JSON or binary (event_codec), detected per record; the
+        binary ones are decoded together into columns. Returns the decoded
+        records as `(sales_id, features, run_id, index)` tuples in record
+        order and one error entry per record that could not be decoded.
+        """
+        decoded = {}
+        errors = []
+        binary = []
+        for index, record in enumerate(records):
+            try:
+                payload = base64.b64decode(record["kinesis"]["data"])
+                if event_codec.is_json(payload):
+                    sales_event = json.loads(payload)
+                    features = self.prepare_features(sales_event["sales_input"])
+                    decoded[index] = (
+                        sales_event["sales_id"],
+                        features,
+                        sales_event.get("run_id"),
+                        index,
+                    )
+                else:
+                    event_codec.check_sales_record(payload)
+                    binary.append((index, payload))
+            except (KeyError, TypeError, ValueError) as e:
+                errors.append(record_error(index, record, f"{type(e).__name__}: {e}"))
+
+        if binary:
+            columns, run_ids = event_codec.decode_sales_batch(
+                [payload for _, payload in binary]
+            )
+            for (index, _), sales_id, features, run_id in zip(
+                binary,
+                columns["sales_id"].tolist(),
+                event_codec.feature_dicts(columns),
+                run_ids,
+            ):
+                decoded[index] = (sales_id, features, run_id, index)
+        return [decoded[index] for index in sorted(decoded)], errors
+
+    def score(self, decoded, models, model_version):
+        """Predictions and model versions for the decoded records, in order.
+
+        Records are grouped by the model that scores them, with one predict
+        call per model.
+        """
+        batches = {}
+        for position, (_, _, run_id, _) in enumerate(decoded):
+            record_version = self.version_for(run_id, model_version)
+            batches.setdefault(record_version, []).append(position)
+
+        predictions = [None] * len(decoded)
+        for record_version, positions in batches.items():
+            features_batch = [decoded[position][1] for position in positions]
+            batch_predictions = self.predict_batch(
+                features_batch, model=models[record_version]
+            )
+            for position, prediction in zip(positions, batch_predictions):
+                predictions[position] = (prediction, record_version)
+        return predictions
+
+    def prediction_events(self, decoded, models, model_version):
+        predictions = self.score(decoded, models, model_version)
+        return [
+            {
                 "model": "sales_prediction_model",
-                "version": self.model_version,
-                "prediction": {"sales_prediction": prediction, "sales_id": sales_id},
+                "version": record_version,
+                "prediction": {
+                    "sales_prediction": prediction,
+                    "sales_id": sales_id,
+                },
             }
+            for (sales_id, _, _, _), (prediction, record_version) in zip(
+                decoded, predictions
+            )
+        ]
+
+    def cached_predictions(self, decoded, model_version, predictions_events):
+        """Fills in the events of records that were already published.
+
+        Returns the positions of the records that still have to be scored.
+        """
+        if self.prediction_cache is None:
+            return list(range(len(decoded)))
+
+        pending = []
+        for position, (sales_id, _, run_id, _) in enumerate(decoded):
+            key = (sales_id, self.version_for(run_id, model_version))
+            prediction_event = self.prediction_cache.get(key)
+            if prediction_event is None:
+                pending.append(position)
+            else:
+                predictions_events[position] = prediction_event
+        return pending
+
+    def emit_predictions(  # pylint: disable=too-many-arguments
+        self, decoded, pending, models, model_version, predictions_events
+    ):
+        # scored in chunks of predict_chunk_size, so that the callbacks start
+        # on the first chunk while the next one is predicted
+        chunk_size = self.predict_chunk_size or len(pending) or 1
+        for start in range(0, len(pending), chunk_size):
+            positions = pending[start : start + chunk_size]
+            chunk_events = self.prediction_events(
+                [decoded[position] for position in positions], models, model_version
+            )
+            for position, prediction_event in zip(positions, chunk_events):
+                self.emitter.emit(prediction_event)
+                predictions_events[position] = prediction_event
 
-            for callback in self.callbacks:
-                callback(prediction_event)
-
-            predictions_events.append(prediction_event)
-
-        return {"predictions": predictions_events}
-
+    def lambda_handler(self, event):
 
-class KinesisCallbacks:
+        # one model for the whole batch, even if a swap happens meanwhile
+        model, model_version = self.active_model.current
+        decoded, errors = self.decode_records(event["Records"])
 
-    def __init__(self, kinesis_client, prediction_stream_name):
-        self.kinesis_client = kinesis_client
-        self.prediction_stream_name = prediction_stream_name
+        predictions_events = [None] * len(decoded)
+        # a redelivered record is answered from the cache and not published again
+        pending = self.cached_predictions(decoded, model_version, predictions_events)
 
-    def put_record(self, prediction_event):
-        sales_id = prediction_event["prediction"]["sales_id"]
+        models, pending, load_errors = self.load_models(
+            decoded, pending, event["Records"], model, model_version
+        )
+        errors = sorted(errors + load_errors, key=lambda error: error["index"])
+
+        try:
+            self.emit_predictions(
+                decoded, pending, models, model_version, predictions_events
+            )
+            self.emitter.finish_invocation()
+        except Exception:
+            self.emitter.discard_invocation()
+            raise
+
+        if self.prediction_cache is not None:
+            # only once published: a failed flush makes Lambda redeliver the
+            # batch, and those records must be published then
+            for position in pending:
+                self.prediction_cache.put_event(predictions_events[position])
+
+        # without the records whose model could not be loaded
+        result = {"predictions": [p for p in predictions_events if p is not None]}
+        if errors:
+            result["errors"] = errors
+        return result
+
+
+def create_version_source(run_id):
+    registry_name = os.getenv("MODEL_REGISTRY_NAME")
+    if registry_name is not None:
+        return registry_version_source(
+            registry_name, os.getenv("MODEL_REGISTRY_ALIAS", "champion")
+        )
 
-        self.kinesis_client.put_record(
-            StreamName=self.prediction_stream_name,
-            Data=json.dumps(prediction_event),
-            PartitionKey=str(sales_id),
+    model_location = get_model_location(run_id)
+    if not os.path.isdir(model_location):
+        raise ValueError(
+            "MODEL_POLL_SECONDS needs MODEL_REGISTRY_NAME or a local MODEL_LOCATION, "
+            f"{model_location} cannot change version"
         )
+    return local_path_version_source(model_location)
 
 
 def create_kinesis_client():
+    import boto3
+
     endpoint_url = os.getenv("KINESIS_ENDPOINT_URL")
 
     if endpoint_url is None:
@@ -118,16 +441,82 @@ def create_kinesis_client():
     return boto3.client("kinesis", endpoint_url=endpoint_url)
 
 
-def init(prediction_stream_name: str, run_id: str, test_run: bool):
+def create_prediction_cache():
+    cache_size = int(os.getenv("PREDICTION_CACHE_SIZE", "0"))
+    if cache_size <= 0:
+        return None
+
+    return PredictionCache(
+        max_entries=cache_size,
+        ttl_seconds=float(os.getenv("PREDICTION_CACHE_TTL_SECONDS", "3600")),
+    )
 
+
+def create_emitter(kinesis_client, prediction_stream_name):
+    """The callbacks of a ModelService, as the environment configures them.
+
+    A KinesisBatchPublisher in the PREDICTION_ENCODING format, run on
+    CALLBACK_THREADS threads if set. No callbacks without a client.
+    """
     callbacks = []
-    model = load_mode(run_id=run_id)
-    if not test_run:
-        kinesis_client = create_kinesis_client()
+    if kinesis_client is not None:
+        publisher = KinesisBatchPublisher(kinesis_client, prediction_stream_name)
+        if os.getenv("PREDICTION_ENCODING") == "binary":
+            publisher.encode = event_codec.encode_prediction
+        callbacks.append(publisher)
+
+    callback_threads = int(os.getenv("CALLBACK_THREADS", "0"))
+    if callback_threads <= 0 or not callbacks:
+        return PredictionEmitter(callbacks)
+    return PredictionEmitter(
+        callbacks,
+        CallbackDispatcher(callbacks, num_lanes=callback_threads),
+        chunk_size=int(os.getenv("PREDICT_CHUNK_SIZE", "100")),
+    )
 
-        kinesis_callback = KinesisCallbacks(kinesis_client, prediction_stream_name)
-        callbacks.append(kinesis_callback.put_record)
 
-    model_service = ModelService(model=model, model_version=run_id, callbacks=callbacks)
+def init(prediction_stream_name: str, run_id: str, test_run: bool):
+
+    timer = InitTimer()
+    model = load_mode(run_id=run_id, timer=timer)
+    kinesis_client = None
+    if not test_run:
+        # boto3 import and client setup
+        with timer.phase("kinesis_client"):
+            kinesis_client = create_kinesis_client()
+
+    model_cache = None
+    cache_max_mb = os.getenv("MODEL_CACHE_MAX_MB")
+    if cache_max_mb is not None:
+        model_cache = ModelCache(
+            loader=load_run_model, max_bytes=int(cache_max_mb) * 1024**2
+        )
+
+    model_service = ModelService(
+        model=model,
+        model_version=run_id,
+        model_cache=model_cache,
+        prediction_cache=create_prediction_cache(),
+        emitter=create_emitter(kinesis_client, prediction_stream_name),
+    )
+
+    # the first prediction pays for lazy initialisation inside the model,
+    # do it here instead of in the first invocation
+    with timer.phase("first_prediction"):
+        model_service.predict(model_service.prepare_features(CANARY_SALES[0]))
+    model_service.init_timings = timer.timings
+    # one JSON line in the CloudWatch logs of every cold start
+    print(json.dumps({"init_timings_ms": timer.timings}))
+
+    poll_seconds = float(os.getenv("MODEL_POLL_SECONDS", "0"))
+    if poll_seconds > 0:
+        watcher = ModelWatcher(
+            model_service,
+            create_version_source(run_id),
+            load_model_from,
+            poll_interval=poll_seconds,
+        )
+        watcher.start()
+        model_service.watcher = watcher
 
     return model_service
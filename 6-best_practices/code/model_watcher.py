@@ -0,0 +1,146 @@
+import os
+import math
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+CANARY_SALES = [
+    {"date": "2022-12-25", "store": 2, "promo": 1, "holiday": 0},
+    {"date": "2023-03-14", "store": 7, "promo": 0, "holiday": 0},
+    {"date": "2023-07-01", "store": 1, "promo": 1, "holiday": 1},
+]
+
+
+class ActiveModel:
+    """The serving model and its version.
+
+    Both are swapped together as one tuple, so a request never sees the new
+    model with the old version or the other way round. ModelServices that
+    share one, e.g. the per-shard services of consumer.py, all see a swap.
+    """
+
+    def __init__(self, model, model_version):
+        self.current = (model, model_version)
+
+    def swap(self, model, model_version):
+        self.current = (model, model_version)
+
+
+def registry_version_source(model_name, alias):
+    # the registered version behind an alias, e.g. models:/store-sales@champion
+    # mlflow takes seconds to import, and only this source needs it
+    import mlflow  # pylint: disable=import-outside-toplevel
+
+    client = mlflow.MlflowClient()
+
+    def latest_version():
+        model_version = client.get_model_version_by_alias(model_name, alias)
+        return model_version.run_id, model_version.source
+
+    return latest_version
+
+
+def local_path_version_source(model_path):
+    # a model directory that gets replaced in place: the run_id in MLmodel
+    # identifies the version, the modification time if there is none
+    def latest_version():
+        mlmodel_path = os.path.join(model_path, "MLmodel")
+        with open(mlmodel_path, "rt", encoding="utf-8") as f_in:
+            for line in f_in:
+                if line.startswith("run_id:"):
+                    return line.split(":", 1)[1].strip(), model_path
+        return str(os.path.getmtime(mlmodel_path)), model_path
+
+    return latest_version
+
+
+class Poller:
+    """Calls `check` every `interval` seconds on a daemon thread."""
+
+    def __init__(self, check, interval, name):
+        self.check = check
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.check()
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+
+class ModelWatcher:
+    """Polls for a new model version and hot-swaps it into a ModelService.
+
+    The new model is loaded with `loader(location)` and warmed up on the
+    canary rows in a background thread; it only replaces the serving model
+    if every canary prediction is a finite number, so requests never wait
+    for a cold or broken model. A version that fails to load or verify is
+    kept in `rejected` and not tried again: the next version is.
+    """
+
+    def __init__(
+        self,
+        model_service,
+        version_source,
+        loader,
+        canary_sales=None,
+        poll_interval=60.0,
+    ):
+        self.model_service = model_service
+        self.version_source = version_source
+        self.loader = loader
+        self.canary_sales = canary_sales or CANARY_SALES
+        self.last_error = None
+        self.rejected = set()
+        self.poller = Poller(self.poll, poll_interval, name="model-watcher")
+
+    def verify(self, model):
+        for sales in self.canary_sales:
+            features = self.model_service.prepare_features(sales)
+            prediction = self.model_service.predict(features, model=model)
+            if not math.isfinite(prediction):
+                raise ValueError(f"canary prediction is not finite: {prediction}")
+
+    def check_once(self):
+        version, location = self.version_source()
+        if version == self.model_service.model_version or version in self.rejected:
+            return False
+
+        try:
+            model = self.loader(location)
+            self.verify(model)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            # keep serving the current model, and do not download a broken
+            # version again on every poll
+            self.rejected.add(version)
+            self.last_error = f"{version}: {e}"
+            logger.warning("model %s rejected: %s", version, e)
+            return False
+
+        previous_version = self.model_service.model_version
+        self.model_service.swap_model(model, version)
+        self.last_error = None
+        logger.info("swapped model %s -> %s", previous_version, version)
+        return True
+
+    def poll(self):
+        try:
+            self.check_once()
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            self.last_error = str(e)
+            logger.warning("model version check failed: %s", e)
+
+    def start(self):
+        self.poller.start()
+
+    def stop(self):
+        self.poller.stop()
@@ -0,0 +1,279 @@
+import json
+import time
+import zlib
+import queue
+import random
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def json_encode(prediction_event):
+    return json.dumps(prediction_event).encode("utf-8")
+
+
+class KinesisCallbacks:
+
+    def __init__(self, kinesis_client, prediction_stream_name):
+        self.kinesis_client = kinesis_client
+        self.prediction_stream_name = prediction_stream_name
+
+    def put_record(self, prediction_event):
+        sales_id = prediction_event["prediction"]["sales_id"]
+
+        self.kinesis_client.put_record(
+            StreamName=self.prediction_stream_name,
+            Data=json.dumps(prediction_event),
+            PartitionKey=str(sales_id),
+        )
+
+
+def partition_key(prediction_event):
+    # the same key the prediction is published with
+    return str(prediction_event["prediction"]["sales_id"])
+
+
+class CallbackDispatcher:
+    """Runs the callbacks of prediction events on a fixed set of threads.
+
+    Every thread ("lane") has a bounded queue, and all events with the same
+    partition key go to the same lane, so callbacks see the events of one
+    key in order. `dispatch` blocks when the lane is full. `barrier` waits
+    until every dispatched event was handled and raises the first callback
+    error of the invocation.
+    """
+
+    def __init__(self, callbacks, num_lanes=4, max_pending=1000, key=partition_key):
+        self.callbacks = callbacks
+        self.key = key
+        self.lanes = [queue.Queue(maxsize=max_pending) for _ in range(num_lanes)]
+        self.errors = []
+        self._errors_lock = threading.Lock()
+        for index, lane in enumerate(self.lanes):
+            thread = threading.Thread(
+                target=self._run, args=(lane,), name=f"callbacks-{index}", daemon=True
+            )
+            thread.start()
+
+    def dispatch(self, prediction_event):
+        # crc32 rather than hash(): stable across processes
+        key = self.key(prediction_event).encode("utf-8")
+        self.lanes[zlib.crc32(key) % len(self.lanes)].put(prediction_event)
+
+    def _run(self, lane):
+        while True:
+            prediction_event = lane.get()
+            try:
+                for callback in self.callbacks:
+                    callback(prediction_event)
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                with self._errors_lock:
+                    self.errors.append(e)
+            finally:
+                lane.task_done()
+
+    def barrier(self):
+        for lane in self.lanes:
+            lane.join()
+        with self._errors_lock:
+            errors, self.errors = self.errors, []
+        if errors:
+            raise errors[0]
+
+
+class PredictionEmitter:
+    """Hands the prediction events of an invocation to the callbacks.
+
+    Callbacks run inline, or on the threads of an optional
+    CallbackDispatcher. `chunk_size` is the number of records a ModelService
+    scores at a time, so the callbacks of one chunk overlap with the
+    prediction of the next; None scores the whole batch at once.
+    """
+
+    def __init__(self, callbacks=None, dispatcher=None, chunk_size=None):
+        self.callbacks = callbacks or []
+        self.dispatcher = dispatcher
+        self.chunk_size = chunk_size
+
+    def run_callbacks(self, prediction_event):
+        for callback in self.callbacks:
+            callback(prediction_event)
+
+    def emit(self, prediction_event):
+        if self.dispatcher is None:
+            self.run_callbacks(prediction_event)
+        else:
+            self.dispatcher.dispatch(prediction_event)
+
+    def finish_invocation(self):
+        if self.dispatcher is not None:
+            # every callback of this invocation has run before it returns
+            self.dispatcher.barrier()
+
+        # batching callbacks send what they collected before the invocation ends
+        for callback in self.callbacks:
+            flush = getattr(callback, "flush", None)
+            if flush is not None:
+                flush()
+
+    def discard_invocation(self):
+        # a failed invocation is redelivered and scored again: what it buffered
+        # must not go out with the next invocation's flush
+        if self.dispatcher is not None:
+            try:
+                self.dispatcher.barrier()
+            except Exception:  # pylint: disable=broad-exception-caught
+                # the invocation is failing already
+                pass
+        for callback in self.callbacks:
+            discard = getattr(callback, "discard", None)
+            if discard is not None:
+                discard()
+
+
+# PutRecords limits
+MAX_RECORDS_PER_PUT = 500
+MAX_BYTES_PER_PUT = 5 * 1024**2
+MAX_RETRY_DELAY = 2.0
+
+
+class PublishError(Exception):
+
+    def __init__(self, message, failed_entries, unsent_entries=()):
+        super().__init__(message)
+        self.failed_entries = failed_entries
+        # the chunks after the failed one, not attempted
+        self.unsent_entries = list(unsent_entries)
+
+
+class Backoff:
+    """Exponential backoff with full jitter, capped at MAX_RETRY_DELAY."""
+
+    def __init__(self, max_attempts=5, base_delay=0.05, sleep=time.sleep):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.sleep = sleep
+
+    def attempts(self):
+        # yields the attempt numbers, sleeping before every retry
+        for attempt in range(self.max_attempts):
+            if attempt:
+                delay = min(MAX_RETRY_DELAY, self.base_delay * 2**attempt)
+                self.sleep(random.uniform(0, delay))
+            yield attempt
+
+
+class KinesisBatchPublisher:
+    """Collects prediction events and sends them with `put_records`.
+
+    Used as a callback: events are only buffered, `flush` sends them in
+    chunks of at most 500 records / 5 MB. Entries that Kinesis rejects
+    (throttling, internal errors) are retried on their own with exponential
+    backoff and jitter; if some still fail after `max_attempts`, `flush`
+    raises PublishError so the invocation fails and Lambda retries the batch.
+    The chunks after a failed one are not sent, and neither the failed nor
+    the unsent entries are kept: the retried batch scores and publishes
+    them again. `discard` drops the events of an invocation that failed
+    before its flush.
+    """
+
+    def __init__(
+        self,
+        kinesis_client,
+        prediction_stream_name,
+        max_attempts=5,
+        base_delay=0.05,
+        sleep=time.sleep,
+    ):
+        self.kinesis_client = kinesis_client
+        self.prediction_stream_name = prediction_stream_name
+        self.backoff = Backoff(max_attempts, base_delay, sleep)
+        self.entries = []
+        # json_encode, or event_codec.encode_prediction for binary records
+        self.encode = json_encode
+        # callbacks may run on several dispatcher threads
+        self._lock = threading.Lock()
+        self.stats = {
+            "sent": 0,
+            "retried": 0,
+            "failed": 0,
+            "discarded": 0,
+            "put_calls": 0,
+        }
+
+    def __call__(self, prediction_event):
+        sales_id = prediction_event["prediction"]["sales_id"]
+        entry = {
+            "Data": self.encode(prediction_event),
+            "PartitionKey": str(sales_id),
+        }
+        with self._lock:
+            self.entries.append(entry)
+
+    def discard(self):
+        # the events of a failed invocation
+        with self._lock:
+            discarded, self.entries = len(self.entries), []
+        self.stats["discarded"] += discarded
+
+    @staticmethod
+    def chunks(entries):
+        chunk, chunk_bytes = [], 0
+        for entry in entries:
+            # the partition key counts towards the request size too
+            size = len(entry["Data"]) + len(entry["PartitionKey"].encode("utf-8"))
+            if chunk and (
+                len(chunk) == MAX_RECORDS_PER_PUT
+                or chunk_bytes + size > MAX_BYTES_PER_PUT
+            ):
+                yield chunk
+                chunk, chunk_bytes = [], 0
+            chunk.append(entry)
+            chunk_bytes += size
+        if chunk:
+            yield chunk
+
+    def put_chunk(self, entries):
+        # returns the entries that still failed after all attempts
+        for attempt in self.backoff.attempts():
+            if attempt:
+                self.stats["retried"] += len(entries)
+            self.stats["put_calls"] += 1
+            try:
+                response = self.kinesis_client.put_records(
+                    StreamName=self.prediction_stream_name, Records=entries
+                )
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                # e.g. throttled as a whole: retry the full chunk
+                logger.warning("put_records failed: %s", e)
+                continue
+            failed = [
+                entry
+                for entry, result in zip(entries, response["Records"])
+                if "ErrorCode" in result
+            ]
+            self.stats["sent"] += len(entries) - len(failed)
+            if not failed:
+                return []
+            entries = failed
+        return entries
+
+    def flush(self):
+        # the buffer is emptied first: nothing is left for the next flush,
+        # whether this one succeeds or not
+        with self._lock:
+            entries, self.entries = self.entries, []
+        chunks = list(self.chunks(entries))
+        for index, chunk in enumerate(chunks):
+            failed = self.put_chunk(chunk)
+            if failed:
+                unsent = [entry for rest in chunks[index + 1 :] for entry in rest]
+                self.stats["failed"] += len(failed)
+                self.stats["discarded"] += len(unsent)
+                raise PublishError(
+                    f"{len(failed) + len(unsent)} of {len(entries)} prediction "
+                    "events were not published",
+                    failed,
+                    unsent,
+                )
@@ -0,0 +1,49 @@
+"""Exports an MLflow model as a single pickle for the slim cold-start path.
+
+The Lambda then loads the fitted scikit-learn pipeline with `pickle.load`
+instead of importing MLflow and resolving the model directory.
+
+    python scripts/export_model.py --model-uri runs:/<RUN_ID>/model --output model.pkl
+    python scripts/export_model.py --model-uri runs:/<RUN_ID>/model \\
+        --upload s3://mlartifact-s3/6/<RUN_ID>/artifacts/model.pkl
+
+Serve it with MODEL_FORMAT=pickle (model.pkl next to the MLflow model) or
+MODEL_LOCATION pointing at the file.
+"""
+
+import os
+import pickle
+import argparse
+
+import boto3
+import mlflow
+
+
+def export_model(model_uri, output):
+    model = mlflow.sklearn.load_model(model_uri)
+    with open(output, "wb") as f_out:
+        pickle.dump(model, f_out, protocol=pickle.HIGHEST_PROTOCOL)
+    return os.path.getsize(output)
+
+
+def upload(output, s3_uri):
+    bucket, key = s3_uri[len("s3://") :].split("/", 1)
+    boto3.client("s3").upload_file(output, bucket, key)
+
+
+def run():
+    parser = argparse.ArgumentParser(description="export an MLflow model as model.pkl")
+    parser.add_argument("--model-uri", required=True, help="e.g. runs:/<RUN_ID>/model")
+    parser.add_argument("--output", default="model.pkl")
+    parser.add_argument("--upload", default=None, help="s3:// URI to upload it to")
+    args = parser.parse_args()
+
+    size = export_model(args.model_uri, args.output)
+    print(f"exported {args.model_uri} to {args.output} ({size} bytes)")
+    if args.upload is not None:
+        upload(args.output, args.upload)
+        print(f"uploaded to {args.upload}")
+
+
+if __name__ == "__main__":
+    run()
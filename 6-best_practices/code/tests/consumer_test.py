@@ -0,0 +1,254 @@
+import json
+import time
+import threading
+
+import pytest
+
+import model
+import consumer
+import publishing
+import event_codec
+from fake_kinesis import FakeKinesis
+
+
+class ModelMock:
+    def predict(self, x):
+        return [float(features["store"]) for features in x]
+
+
+def put_sales(kinesis, stream_name, count, start=0):
+    for sales_id in range(start, start + count):
+        sales_event = {
+            "sales_input": {
+                "date": "2022-12-25",
+                "store": sales_id,
+                "promo": 1,
+                "holiday": 0,
+            },
+            "sales_id": sales_id,
+        }
+        kinesis.put_record(
+            StreamName=stream_name,
+            Data=json.dumps(sales_event),
+            PartitionKey=str(sales_id),
+        )
+
+
+def published(kinesis, stream_name):
+    return [
+        json.loads(record["Data"])["prediction"]
+        for records in kinesis.streams[stream_name].values()
+        for record in records
+    ]
+
+
+def make_consumer(kinesis, checkpoints, callback_factory=None, **kwargs):
+    def service_factory():
+        callbacks = [
+            publishing.KinesisBatchPublisher(
+                kinesis, "sales_predictions", sleep=lambda _: None
+            )
+        ]
+        if callback_factory is not None:
+            callbacks.insert(0, callback_factory())
+        return model.ModelService(ModelMock(), "Test123", callbacks=callbacks)
+
+    return consumer.StreamConsumer(
+        kinesis, "sales_events", service_factory, checkpoints, **kwargs
+    )
+
+
+@pytest.fixture(name="kinesis")
+def fixture_kinesis():
+    kinesis = FakeKinesis()
+    kinesis.create_stream(StreamName="sales_events", ShardCount=4)
+    kinesis.create_stream(StreamName="sales_predictions", ShardCount=1)
+    return kinesis
+
+
+def test_consumer_scores_every_shard_and_checkpoints(kinesis):
+    put_sales(kinesis, "sales_events", 100)
+    checkpoints = consumer.CheckpointStore()
+
+    read = make_consumer(kinesis, checkpoints, batch_size=7).drain()
+
+    assert read == 100
+    predictions = published(kinesis, "sales_predictions")
+    assert sorted(p["sales_id"] for p in predictions) == list(range(100))
+    assert all(p["sales_prediction"] == p["sales_id"] for p in predictions)
+    for shard_id, records in kinesis.streams["sales_events"].items():
+        assert (
+            checkpoints.get("sales_events", shard_id) == records[-1]["SequenceNumber"]
+        )
+
+    # a restarted consumer continues after the checkpoints
+    put_sales(kinesis, "sales_events", 3)
+    assert make_consumer(kinesis, checkpoints).drain() == 3
+
+
+def test_consumer_rereads_batch_that_failed(kinesis):
+    put_sales(kinesis, "sales_events", 20)
+    failures = {"left": 2}
+
+    def flaky_callback():
+        def callback(_):
+            if failures["left"]:
+                failures["left"] -= 1
+                raise RuntimeError("downstream unavailable")
+
+        return callback
+
+    stream_consumer = make_consumer(
+        kinesis, consumer.CheckpointStore(), flaky_callback, error_backoff=0
+    )
+    with pytest.raises(RuntimeError):
+        stream_consumer.drain()
+    with pytest.raises(RuntimeError):
+        stream_consumer.drain()
+    stream_consumer.drain()
+
+    sales_ids = [p["sales_id"] for p in published(kinesis, "sales_predictions")]
+    # the failed batches were not published, then scored again
+    assert sorted(sales_ids) == list(range(20))
+    assert sum(w.stats["failed_batches"] for w in stream_consumer.workers.values()) == 2
+
+
+def test_consumer_threads_read_shards_until_stopped(kinesis, tmp_path):
+    put_sales(kinesis, "sales_events", 200)
+    stream_consumer = make_consumer(
+        kinesis,
+        consumer.CheckpointStore(str(tmp_path / "checkpoints.sqlite")),
+        batch_size=50,
+        poll_interval=0.01,
+        min_poll_interval=0,
+    )
+    runner = threading.Thread(target=stream_consumer.run)
+    runner.start()
+    deadline = time.monotonic() + 5
+    while (
+        len(published(kinesis, "sales_predictions")) < 200
+        and time.monotonic() < deadline
+    ):
+        time.sleep(0.01)
+    stream_consumer.stop()
+    runner.join()
+
+    assert len(published(kinesis, "sales_predictions")) == 200
+    assert sum(stats["records"] for stats in stream_consumer.stats().values()) == 200
+    assert len(stream_consumer.stats()) == 4
+
+
+def test_service_factory_shares_the_hot_swapped_model(monkeypatch):
+    loaded = model.ModelService(ModelMock(), "v1")
+    monkeypatch.setattr(model, "init", lambda **kwargs: loaded)
+    service_factory = consumer.create_service_factory(
+        "sales_predictions", "v1", test_run=True
+    )
+    shard_services = [service_factory(), service_factory()]
+    new_model = ModelMock()
+
+    # what the ModelWatcher of init() does
+    loaded.swap_model(new_model, "v2")
+
+    assert [(s.model, s.model_version) for s in shard_services] == [
+        (new_model, "v2")
+    ] * 2
+
+
+def test_service_factory_publishes_like_init(monkeypatch, kinesis):
+    monkeypatch.setenv("PREDICTION_ENCODING", "binary")
+    monkeypatch.setenv("CALLBACK_THREADS", "2")
+    monkeypatch.setattr(model, "init", lambda **kwargs: model.ModelService(None))
+    monkeypatch.setattr(model, "create_kinesis_client", lambda: kinesis)
+    service_factory = consumer.create_service_factory(
+        "sales_predictions", "v1", test_run=False
+    )
+
+    emitter = service_factory().emitter
+
+    assert [callback.encode for callback in emitter.callbacks] == [
+        event_codec.encode_prediction
+    ]
+    assert len(emitter.dispatcher.lanes) == 2
+    assert emitter.chunk_size == 100
+
+
+def split_first_shard(kinesis):
+    hash_range = kinesis.shards["sales_events"]["shardId-000000000000"]["HashKeyRange"]
+    start = int(hash_range["StartingHashKey"])
+    end = int(hash_range["EndingHashKey"])
+    kinesis.split_shard(
+        StreamName="sales_events",
+        ShardToSplit="shardId-000000000000",
+        NewStartingHashKey=str((start + end) // 2),
+    )
+    return [
+        shard_id
+        for shard_id, shard in kinesis.shards["sales_events"].items()
+        if shard.get("ParentShardId") == "shardId-000000000000"
+    ]
+
+
+def test_consumer_reads_child_shards_after_their_parent(tmp_path):
+    kinesis = FakeKinesis()
+    kinesis.create_stream(StreamName="sales_events", ShardCount=1)
+    kinesis.create_stream(StreamName="sales_predictions", ShardCount=1)
+    put_sales(kinesis, "sales_events", 20)
+    split_first_shard(kinesis)
+    put_sales(kinesis, "sales_events", 20, start=20)
+    scored = []
+    checkpoints = consumer.CheckpointStore(str(tmp_path / "checkpoints.sqlite"))
+
+    def recording_callback():
+        return lambda event: scored.append(event["prediction"]["sales_id"])
+
+    read = make_consumer(kinesis, checkpoints, recording_callback, batch_size=5).drain()
+
+    assert read == 40
+    # the records of the parent first, in order, although the batches are small
+    assert scored[:20] == list(range(20))
+    assert sorted(scored[20:]) == list(range(20, 40))
+    assert checkpoints.get("sales_events", "shardId-000000000000") == consumer.SHARD_END
+    # a restarted consumer neither reads the parent again nor misses new records
+    put_sales(kinesis, "sales_events", 5, start=40)
+    assert make_consumer(kinesis, checkpoints).drain() == 5
+
+
+def test_consumer_threads_start_child_shards_when_their_parent_closes(kinesis):
+    put_sales(kinesis, "sales_events", 100)
+    child_shards = split_first_shard(kinesis)
+    put_sales(kinesis, "sales_events", 100, start=100)
+    scored = []
+
+    def recording_callback():
+        return lambda event: scored.append(event["prediction"]["sales_id"])
+
+    stream_consumer = make_consumer(
+        kinesis,
+        consumer.CheckpointStore(),
+        recording_callback,
+        batch_size=3,
+        poll_interval=0.01,
+        min_poll_interval=0,
+        # only the closing parent can start its children in time
+        shard_refresh_seconds=60,
+    )
+    runner = threading.Thread(target=stream_consumer.run)
+    runner.start()
+    deadline = time.monotonic() + 5
+    while len(scored) < 200 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    stream_consumer.stop()
+    runner.join()
+
+    assert sorted(scored) == list(range(200))
+    parent = kinesis.streams["sales_events"]["shardId-000000000000"]
+    parent_ids = {json.loads(record["Data"])["sales_id"] for record in parent}
+    children = {
+        json.loads(record["Data"])["sales_id"]
+        for shard_id in child_shards
+        for record in kinesis.streams["sales_events"][shard_id]
+    }
+    assert children
+    # every record of the parent was scored before the first of its children
+    assert max(map(scored.index, parent_ids)) < min(map(scored.index, children))
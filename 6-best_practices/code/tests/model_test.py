@@ -1,6 +1,18 @@
+import json
+import base64
+import pickle
+import threading
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
 
 import model
+import caches
+import publishing
+import event_codec
+import model_watcher
+from fake_kinesis import FakeKinesis
 
 
 def read_text(file):
@@ -41,6 +53,24 @@ def test_prepare_features():
     assert actual_features == expected_features
 
 
+@pytest.mark.parametrize(
+    "date, expected",
+    [
+        ("2022-12-25T10:30:00", (2022, 12, 6)),
+        ("2022-1-5", (2022, 1, 2)),
+        ("2022-1-28", (2022, 1, 4)),
+        ("2022/12/25", (2022, 12, 6)),
+    ],
+)
+def test_prepare_features_parses_dates_like_pandas(date, expected):
+    model_service = model.ModelService(None)
+    sales_input = {"date": date, "store": 2, "promo": 1, "holiday": 0}
+
+    features = model_service.prepare_features(sales_input)
+
+    assert (features["year"], features["month"], features["dayofweek"]) == expected
+
+
 # Creates a fake (mock) model that always returns the prediction 500.0
 # This is useful for testing, so you don’t use a real model instead class ModelMock:
 
@@ -100,3 +130,611 @@ def test_lambda_handler():
     }
 
     assert actual_prediction == expected_predictions
+
+
+def test_model_watcher_swaps_verified_model():
+    model_service = model.ModelService(model=ModelMock(500.0), model_version="v1")
+    new_model = ModelMock(300.0)
+
+    watcher = model_watcher.ModelWatcher(
+        model_service,
+        version_source=lambda: ("v2", "/models/v2"),
+        loader=lambda location: new_model,
+    )
+
+    assert watcher.check_once()
+    assert model_service.model is new_model
+    assert model_service.model_version == "v2"
+    # same version again: nothing to do
+    assert not watcher.check_once()
+
+
+def test_model_watcher_keeps_model_when_canary_fails():
+    old_model = ModelMock(500.0)
+    model_service = model.ModelService(model=old_model, model_version="v1")
+
+    watcher = model_watcher.ModelWatcher(
+        model_service,
+        version_source=lambda: ("v2", "/models/v2"),
+        loader=lambda location: ModelMock(float("nan")),
+    )
+
+    assert not watcher.check_once()
+    assert model_service.model is old_model
+    assert model_service.model_version == "v1"
+    assert watcher.last_error.startswith("v2")
+
+
+def test_model_watcher_does_not_retry_a_rejected_version():
+    model_service = model.ModelService(model=ModelMock(500.0), model_version="v1")
+    versions = iter([("v2", "/models/v2"), ("v2", "/models/v2"), ("v3", "/models/v3")])
+    loaded = []
+
+    def loader(location):
+        loaded.append(location)
+        return ModelMock(float("nan") if location.endswith("v2") else 300.0)
+
+    watcher = model_watcher.ModelWatcher(
+        model_service, version_source=lambda: next(versions), loader=loader
+    )
+
+    assert not watcher.check_once()
+    assert not watcher.check_once()
+    assert watcher.rejected == {"v2"}
+    assert watcher.check_once()
+    assert model_service.model_version == "v3"
+    assert loaded == ["/models/v2", "/models/v3"]
+
+
+def test_init_keeps_a_reference_to_its_model_watcher(monkeypatch):
+    monkeypatch.setenv("MODEL_POLL_SECONDS", "3600")
+    monkeypatch.setattr(model, "load_mode", lambda run_id, timer: ModelMock(500.0))
+    monkeypatch.setattr(
+        model, "create_version_source", lambda run_id: lambda: (run_id, None)
+    )
+
+    model_service = model.init("sales_predictions", "v1", test_run=True)
+    model_service.watcher.stop()
+
+    assert model_service.watcher.model_service is model_service
+
+
+def test_services_sharing_an_active_model_see_a_swap():
+    active_model = model_watcher.ActiveModel(ModelMock(500.0), "v1")
+    services = [model.ModelService(None, active_model=active_model) for _ in range(2)]
+    new_model = ModelMock(300.0)
+
+    services[0].swap_model(new_model, "v2")
+
+    assert [(s.model, s.model_version) for s in services] == [(new_model, "v2")] * 2
+
+
+def test_model_cache_evicts_least_recently_used():
+    cache = caches.ModelCache(
+        loader=lambda run_id: ModelMock(len(run_id)), max_bytes=2, sizeof=lambda m: 1
+    )
+
+    cache.get("run-a")
+    cache.get("run-b")
+    cache.get("run-a")
+    cache.get("run-c")
+
+    assert "run-a" in cache
+    assert "run-b" not in cache
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 3
+    assert cache.stats()["loads"] == 3
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["bytes"] == 2
+
+
+def test_model_cache_loads_once_for_concurrent_requests():
+    release = threading.Event()
+    load_calls = []
+
+    def slow_loader(run_id):
+        load_calls.append(run_id)
+        release.wait()
+        return ModelMock(100.0)
+
+    cache = caches.ModelCache(loader=slow_loader, sizeof=lambda m: 1)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = [executor.submit(cache.get, "run-a") for _ in range(8)]
+        release.set()
+        models = [future.result() for future in futures]
+
+    assert load_calls == ["run-a"]
+    assert all(m is models[0] for m in models)
+
+
+def test_lambda_handler_selects_model_by_run_id():
+    sales_event = {
+        "sales_input": {"date": "2022-12-25", "store": 2, "promo": 1, "holiday": 0},
+        "sales_id": 513,
+        "run_id": "run-b",
+    }
+    encoded = base64.b64encode(json.dumps(sales_event).encode("utf-8")).decode("utf-8")
+    event = {
+        "Records": [
+            {"kinesis": {"data": read_text("data.b64")}},
+            {"kinesis": {"data": encoded}},
+        ]
+    }
+
+    cache = caches.ModelCache(loader=lambda run_id: ModelMock(300.0))
+    model_service = model.ModelService(
+        model=ModelMock(500.0), model_version="run-a", model_cache=cache
+    )
+    predictions = model_service.lambda_handler(event)["predictions"]
+
+    assert predictions[0]["version"] == "run-a"
+    assert predictions[0]["prediction"]["sales_prediction"] == 500.0
+    assert predictions[1]["version"] == "run-b"
+    assert predictions[1]["prediction"]["sales_prediction"] == 300.0
+
+
+def test_lambda_handler_reports_records_whose_model_cannot_be_loaded():
+    def encode(sales_id, run_id):
+        sales_event = {
+            "sales_input": {"date": "2022-12-25", "store": 2, "promo": 1, "holiday": 0},
+            "sales_id": sales_id,
+            "run_id": run_id,
+        }
+        return base64.b64encode(json.dumps(sales_event).encode("utf-8")).decode("utf-8")
+
+    load_calls = []
+
+    def loader(run_id):
+        load_calls.append(run_id)
+        if run_id == "missing":
+            raise OSError(f"no model for run {run_id}")
+        return ModelMock(300.0)
+
+    event = {
+        "Records": [
+            {"kinesis": {"data": encode(1, None), "sequenceNumber": "1"}},
+            {"kinesis": {"data": encode(2, "missing"), "sequenceNumber": "2"}},
+            {"kinesis": {"data": encode(3, "run-b"), "sequenceNumber": "3"}},
+            {"kinesis": {"data": encode(4, "missing"), "sequenceNumber": "4"}},
+        ]
+    }
+    model_service = model.ModelService(
+        model=ModelMock(500.0),
+        model_version="run-a",
+        model_cache=caches.ModelCache(loader=loader),
+    )
+    result = model_service.lambda_handler(event)
+
+    assert [
+        (p["prediction"]["sales_id"], p["version"]) for p in result["predictions"]
+    ] == [(1, "run-a"), (3, "run-b")]
+    assert [(e["index"], e["sequence_number"]) for e in result["errors"]] == [
+        (1, "2"),
+        (3, "4"),
+    ]
+    assert result["errors"][0]["error"] == "OSError: no model for run missing"
+    # once per batch, not once per record
+    assert load_calls == ["missing", "run-b"]
+
+
+def test_get_model_location_fills_in_run_id(monkeypatch):
+    monkeypatch.setenv("MODEL_LOCATION", "/models/{run_id}")
+
+    assert model.get_model_location("run-b") == "/models/run-b"
+
+
+def test_load_run_model_rejects_runs_of_a_fixed_model_location(monkeypatch):
+    # every run would be scored by the one model at MODEL_LOCATION
+    monkeypatch.setenv("MODEL_LOCATION", "/app/model")
+
+    with pytest.raises(ValueError, match="placeholder"):
+        caches.ModelCache(model.load_run_model).get("run-b")
+
+
+class CountingModelMock(ModelMock):
+    def __init__(self, value):
+        super().__init__(value)
+        self.calls = 0
+
+    def predict(self, x):
+        self.calls += 1
+        return [self.value + i for i in range(len(x))]
+
+
+def test_lambda_handler_predicts_batch_once_and_reports_bad_records():
+    def encode(sales_id):
+        sales_event = {
+            "sales_input": {"date": "2022-12-25", "store": 2, "promo": 1, "holiday": 0},
+            "sales_id": sales_id,
+        }
+        return base64.b64encode(json.dumps(sales_event).encode("utf-8")).decode("utf-8")
+
+    event = {
+        "Records": [
+            {"kinesis": {"data": encode(1)}},
+            {"kinesis": {"data": "not base64!", "sequenceNumber": "42"}},
+            {"kinesis": {"data": encode(2)}},
+            {"kinesis": {"data": encode(3)}},
+        ]
+    }
+
+    model_mock = CountingModelMock(100.0)
+    model_service = model.ModelService(model=model_mock, model_version="v1")
+    result = model_service.lambda_handler(event)
+
+    assert model_mock.calls == 1
+    assert [p["prediction"]["sales_id"] for p in result["predictions"]] == [1, 2, 3]
+    assert [p["prediction"]["sales_prediction"] for p in result["predictions"]] == [
+        100.0,
+        101.0,
+        102.0,
+    ]
+    assert len(result["errors"]) == 1
+    assert result["errors"][0]["index"] == 1
+    assert result["errors"][0]["sequence_number"] == "42"
+
+
+def make_kinesis(failures=None):
+    kinesis = FakeKinesis(failures=failures)
+    kinesis.create_stream(StreamName="predictions")
+    return kinesis
+
+
+def published(kinesis):
+    return [
+        json.loads(record["Data"])
+        for record in kinesis.streams["predictions"]["shardId-000000000000"]
+    ]
+
+
+def prediction_event(sales_id):
+    return {
+        "model": "sales_prediction_model",
+        "version": "v1",
+        "prediction": {"sales_prediction": 1.0, "sales_id": sales_id},
+    }
+
+
+def test_batch_publisher_chunks_and_retries_failed_entries():
+    kinesis = make_kinesis(failures={"3": 1, "700": 2})
+    publisher = publishing.KinesisBatchPublisher(
+        kinesis, "predictions", sleep=lambda s: None
+    )
+
+    for sales_id in range(1200):
+        publisher(prediction_event(sales_id))
+    publisher.flush()
+
+    # 500 + 500 + 200, then the failed entries alone
+    assert [len(call) for call in kinesis.calls] == [500, 1, 500, 1, 1, 200]
+    assert len(published(kinesis)) == 1200
+    assert publisher.stats["sent"] == 1200
+    assert not publisher.entries
+
+
+def test_batch_publisher_raises_when_retries_are_exhausted():
+    kinesis = make_kinesis(failures={"1": 10})
+    publisher = publishing.KinesisBatchPublisher(
+        kinesis, "predictions", max_attempts=3, sleep=lambda s: None
+    )
+    publisher(prediction_event(1))
+    publisher(prediction_event(2))
+
+    with pytest.raises(publishing.PublishError) as error:
+        publisher.flush()
+
+    assert [entry["PartitionKey"] for entry in error.value.failed_entries] == ["1"]
+    assert len(published(kinesis)) == 1
+
+
+def test_batch_publisher_keeps_nothing_after_a_failed_flush():
+    # sales_id 3 is in the first of three chunks
+    kinesis = make_kinesis(failures={"3": 10})
+    publisher = publishing.KinesisBatchPublisher(
+        kinesis, "predictions", max_attempts=2, sleep=lambda s: None
+    )
+    for sales_id in range(1200):
+        publisher(prediction_event(sales_id))
+
+    with pytest.raises(publishing.PublishError) as error:
+        publisher.flush()
+
+    assert [entry["PartitionKey"] for entry in error.value.failed_entries] == ["3"]
+    # the other chunks are left to the redelivered batch
+    assert len(error.value.unsent_entries) == 700
+    assert len(published(kinesis)) == 499
+    assert not publisher.entries
+
+    publisher(prediction_event(5000))
+    publisher.flush()
+    assert published(kinesis)[-1]["prediction"]["sales_id"] == 5000
+    assert len(published(kinesis)) == 500
+
+
+def test_lambda_handler_flushes_batch_publisher():
+    kinesis = make_kinesis()
+    publisher = publishing.KinesisBatchPublisher(kinesis, "predictions")
+    event = {"Records": [{"kinesis": {"data": read_text("data.b64")}}] * 3}
+
+    model_service = model.ModelService(
+        model=ModelMock(500.0), model_version="v1", callbacks=[publisher]
+    )
+    model_service.lambda_handler(event)
+
+    assert len(kinesis.calls) == 1
+    assert [record["prediction"]["sales_id"] for record in published(kinesis)] == [
+        512
+    ] * 3
+
+
+class FailingModelMock(ModelMock):
+    """Fails on the given predict calls, counted from 1."""
+
+    def __init__(self, value, failing_calls):
+        super().__init__(value)
+        self.failing_calls = failing_calls
+        self.calls = 0
+
+    def predict(self, x):
+        self.calls += 1
+        if self.calls in self.failing_calls:
+            raise RuntimeError("model failed")
+        return super().predict(x)
+
+
+def test_failed_invocation_does_not_publish_its_buffered_events():
+    kinesis = make_kinesis()
+    publisher = publishing.KinesisBatchPublisher(kinesis, "predictions")
+    model_service = model.ModelService(
+        model=FailingModelMock(500.0, failing_calls={2}),
+        model_version="v1",
+        callbacks=[publisher],
+    )
+    # 1 and 2 are buffered by the first chunk, the second chunk fails
+    model_service.predict_chunk_size = 2
+    failing = {
+        "Records": [{"kinesis": {"data": encode_sales_event(i)}} for i in (1, 2, 3)]
+    }
+
+    with pytest.raises(RuntimeError):
+        model_service.lambda_handler(failing)
+    model_service.lambda_handler(
+        {"Records": [{"kinesis": {"data": encode_sales_event(10)}}]}
+    )
+
+    assert [record["prediction"]["sales_id"] for record in published(kinesis)] == [10]
+    assert publisher.stats["discarded"] == 2
+
+
+def test_callback_dispatcher_keeps_order_per_key_and_waits_at_barrier():
+    seen = []
+    seen_lock = threading.Lock()
+
+    def slow_callback(dispatched):
+        sales_id = dispatched["prediction"]["sales_id"]
+        # uneven work so the lanes interleave
+        threading.Event().wait(0.001 * (sales_id % 3))
+        with seen_lock:
+            seen.append((sales_id, dispatched["version"]))
+
+    dispatcher = publishing.CallbackDispatcher([slow_callback], num_lanes=4)
+    for version in range(5):
+        for sales_id in range(20):
+            event = prediction_event(sales_id)
+            event["version"] = version
+            dispatcher.dispatch(event)
+    dispatcher.barrier()
+
+    assert len(seen) == 100
+    for sales_id in range(20):
+        assert [v for s, v in seen if s == sales_id] == list(range(5))
+
+
+def test_callback_dispatcher_raises_callback_errors_at_barrier():
+    def failing_callback(dispatched):
+        raise RuntimeError(f"failed {dispatched['prediction']['sales_id']}")
+
+    dispatcher = publishing.CallbackDispatcher([failing_callback], num_lanes=2)
+    dispatcher.dispatch(prediction_event(7))
+
+    with pytest.raises(RuntimeError, match="failed 7"):
+        dispatcher.barrier()
+    # the errors are reported once
+    dispatcher.barrier()
+
+
+def test_lambda_handler_with_dispatcher_publishes_every_prediction():
+    kinesis = make_kinesis()
+    publisher = publishing.KinesisBatchPublisher(kinesis, "predictions")
+    dispatcher = publishing.CallbackDispatcher([publisher], num_lanes=3)
+    model_service = model.ModelService(
+        model=ModelMock(500.0),
+        model_version="v1",
+        callbacks=[publisher],
+        dispatcher=dispatcher,
+    )
+    model_service.predict_chunk_size = 2
+    event = {"Records": [{"kinesis": {"data": read_text("data.b64")}}] * 5}
+
+    result = model_service.lambda_handler(event)
+
+    assert len(result["predictions"]) == 5
+    assert len(published(kinesis)) == 5
+
+
+def test_load_model_from_pickle_times_phases(tmp_path):
+    model_path = tmp_path / "model.pkl"
+    with open(model_path, "wb") as f_out:
+        pickle.dump(ModelMock(42.0), f_out)
+    timer = model.InitTimer()
+
+    loaded = model.load_model_from(str(model_path), timer)
+
+    assert loaded.predict([{}]) == [42.0]
+    # a local pickle is neither downloaded nor loaded through MLflow
+    assert list(timer.timings) == ["deserialize"]
+
+
+def encode_sales_event(sales_id):
+    sales_event = {
+        "sales_input": {"date": "2022-12-25", "store": 2, "promo": 1, "holiday": 0},
+        "sales_id": sales_id,
+    }
+    return base64.b64encode(json.dumps(sales_event).encode("utf-8")).decode("utf-8")
+
+
+def test_lambda_handler_answers_redelivered_records_from_prediction_cache():
+    kinesis = make_kinesis(failures={"2": 5})
+    publisher = publishing.KinesisBatchPublisher(
+        kinesis, "predictions", max_attempts=1, sleep=lambda s: None
+    )
+    model_mock = CountingModelMock(100.0)
+    cache = caches.PredictionCache()
+    model_service = model.ModelService(
+        model=model_mock,
+        model_version="v1",
+        callbacks=[publisher],
+        prediction_cache=cache,
+    )
+    batch = {"Records": [{"kinesis": {"data": encode_sales_event(i)}} for i in (1, 2)]}
+
+    # sales_id 2 is not published: nothing may be cached, the batch is redelivered
+    with pytest.raises(publishing.PublishError):
+        model_service.lambda_handler(batch)
+    assert len(cache) == 0
+    kinesis.failures = {}
+    first = model_service.lambda_handler(batch)["predictions"]
+
+    redelivered = {
+        "Records": batch["Records"] + [{"kinesis": {"data": encode_sales_event(3)}}]
+    }
+    second = model_service.lambda_handler(redelivered)["predictions"]
+
+    assert second[:2] == first
+    assert [p["prediction"]["sales_id"] for p in second] == [1, 2, 3]
+    # 1 and 2 published once more by the successful retry, 3 once, none again
+    assert [record["prediction"]["sales_id"] for record in published(kinesis)] == [
+        1,
+        1,
+        2,
+        3,
+    ]
+    assert model_mock.calls == 3
+    assert cache.stats()["hits"] == 2
+
+
+def test_prediction_cache_expires_and_evicts_entries():
+    now = [0.0]
+    cache = caches.PredictionCache(max_entries=2, ttl_seconds=10, clock=lambda: now[0])
+    cache.put((1, "v1"), prediction_event(1))
+    cache.put((2, "v1"), prediction_event(2))
+
+    assert cache.get((1, "v1")) == prediction_event(1)
+    assert cache.get((1, "v2")) is None
+    cache.put((3, "v1"), prediction_event(3))
+    # 2 was the least recently used
+    assert cache.get((2, "v1")) is None
+    now[0] = 10.0
+    assert cache.get((3, "v1")) is None
+
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["expired"]) == (1, 3, 1)
+    assert stats["evictions"] == 1
+    assert stats["hit_rate"] == 0.25
+
+
+def test_decode_records_mixes_json_and_binary_records():
+    sales_inputs = [
+        {"date": "2022-12-25", "store": 2, "promo": 1, "holiday": 0},
+        {"date": "2023-03-14", "store": 7, "promo": 0, "holiday": 1},
+        {"date": "2024-02-29", "store": 40, "promo": 1, "holiday": 0},
+    ]
+    binary = [
+        event_codec.encode_sales_event(
+            {"sales_input": sales_inputs[1], "sales_id": 2, "run_id": "run-b"}
+        ),
+        event_codec.encode_sales_event({"sales_input": sales_inputs[2], "sales_id": 3}),
+    ]
+    payloads = [
+        json.dumps({"sales_input": sales_inputs[0], "sales_id": 1}).encode("utf-8"),
+        binary[0],
+        binary[1][:10],
+        binary[1],
+    ]
+    records = [
+        {"kinesis": {"data": base64.b64encode(payload).decode("utf-8")}}
+        for payload in payloads
+    ]
+
+    model_service = model.ModelService(None)
+    decoded, errors = model_service.decode_records(records)
+
+    assert decoded == [
+        (1, model_service.prepare_features(sales_inputs[0]), None, 0),
+        (2, model_service.prepare_features(sales_inputs[1]), "run-b", 1),
+        (3, model_service.prepare_features(sales_inputs[2]), None, 3),
+    ]
+    assert [error["index"] for error in errors] == [2]
+    assert len(binary[1]) < len(payloads[0]) / 3
+
+
+def test_binary_prediction_round_trip():
+    event = prediction_event(512)
+    event["version"] = "Test123"
+
+    encoded = event_codec.encode_prediction(event)
+
+    assert event_codec.decode_prediction(encoded) == event
+    assert event_codec.decode_prediction(publishing.json_encode(event)) == event
+    assert len(encoded) < len(publishing.json_encode(event)) / 3
+
+
+def test_binary_prediction_keeps_a_missing_version():
+    event = prediction_event(512)
+    event["version"] = None
+
+    assert event_codec.decode_prediction(event_codec.encode_prediction(event)) == event
+
+
+def test_binary_prediction_falls_back_to_json_for_other_sales_ids():
+    kinesis = FakeKinesis()
+    kinesis.create_stream(StreamName="sales_predictions", ShardCount=1)
+    publisher = publishing.KinesisBatchPublisher(kinesis, "sales_predictions")
+    publisher.encode = event_codec.encode_prediction
+    events = []
+    for sales_id in ["5d0c1a8e-6e4b-4b43-9a37-3f4d6b0c2f11", 2**70, 512]:
+        event = prediction_event(sales_id)
+        event["version"] = "Test123"
+        events.append(event)
+        publisher(event)
+
+    publisher.flush()
+
+    records = [
+        record["Data"]
+        for records in kinesis.streams["sales_predictions"].values()
+        for record in records
+    ]
+    assert [event_codec.is_json(record) for record in records] == [True, True, False]
+    assert [event_codec.decode_prediction(record) for record in records] == events
+
+
+def test_json_records_may_start_with_whitespace_or_a_bom():
+    sales_event = {
+        "sales_input": {"date": "2022-12-25", "store": 2, "promo": 1, "holiday": 0},
+        "sales_id": 1,
+    }
+    payloads = [
+        b"\n  " + json.dumps(sales_event).encode("utf-8"),
+        b"\xef\xbb\xbf" + json.dumps(sales_event).encode("utf-8"),
+    ]
+    records = [
+        {"kinesis": {"data": base64.b64encode(payload).decode("utf-8")}}
+        for payload in payloads
+    ]
+
+    assert all(event_codec.is_json(payload) for payload in payloads)
+    assert not event_codec.is_json(event_codec.encode_sales_event(sales_event))
+    decoded, errors = model.ModelService(None).decode_records(records)
+    assert [sales_id for sales_id, _, _, _ in decoded] == [1, 1]
+    assert not errors
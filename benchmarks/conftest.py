@@ -0,0 +1,255 @@
+import os
+import sys
+import glob
+import json
+import types
+import pickle
+import random
+import datetime
+import importlib.util
+
+import joblib
+import pandas as pd
+import pytest
+
+# Loads every serving module the way it is deployed, but with models fitted
+# here on synthetic rows: nothing is read from S3, and the lin_reg.bin files
+# in the repo were pickled by older scikit-learn versions.
+#   web-services         4-model_deployment/web-services/app_predict.py
+#   web-services-mlflow  4-model_deployment/web-services-mlflow/app_predict.py
+#   streaming            4-model_deployment/streaming/lambda_function.py
+#   monitoring           5-model_monitoring/prediction_service/app.py
+#   best-practices       6-best_practices/code/model.py (ModelService)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FEATURES = ["store", "promo", "holiday", "year", "month", "dayofweek", "is_weekend"]
+
+os.environ.setdefault("MLFLOW_DISABLE_AGENT_HINT", "1")
+
+# the run saved with --benchmark-save=baseline
+BASELINE_NAME = "baseline"
+
+
+def pytest_addoption(parser):
+    parser.addini(
+        "benchmark_baseline_compare_fail",
+        "regression that fails the run against this machine's baseline",
+        default="min:30%",
+    )
+
+
+def same_machine(machine_info):
+    # pylint: disable=import-outside-toplevel
+    from pytest_benchmark.plugin import get_cpu_info
+
+    # the storage is per platform and Python version already
+    cpu, saved = get_cpu_info(), machine_info.get("cpu", {})
+    return all(cpu.get(key) == saved.get(key) for key in ("brand_raw", "count"))
+
+
+def find_baseline(storage):
+    """The run number of the latest baseline saved on this machine, or None."""
+    # pylint: disable=import-outside-toplevel
+    from pytest_benchmark.utils import get_machine_id
+
+    if not storage.startswith("file://"):
+        return None
+    pattern = f"*_{BASELINE_NAME}.json"
+    paths = sorted(glob.glob(os.path.join(storage[7:], get_machine_id(), pattern)))
+    if not paths:
+        return None
+    with open(paths[-1], "rt", encoding="utf-8") as f_in:
+        if not same_machine(json.load(f_in)["machine_info"]):
+            return None
+    return os.path.basename(paths[-1]).split("_", 1)[0]
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_configure(config):
+    # before pytest-benchmark reads the options: with a baseline of this
+    # machine, a plain run is compared with it and fails on regressions
+    option = config.option
+    if getattr(option, "benchmark_compare", None) is None:
+        return  # pytest-benchmark is not installed
+    if (
+        option.benchmark_disable
+        or option.benchmark_compare
+        or option.benchmark_compare_fail
+    ):
+        return
+    number = find_baseline(str(option.benchmark_storage))
+    if number is None:
+        return
+    # pylint: disable=import-outside-toplevel
+    from pytest_benchmark.utils import parse_compare_fail
+
+    option.benchmark_compare = number
+    option.benchmark_compare_fail = [
+        parse_compare_fail(config.getini("benchmark_baseline_compare_fail"))
+    ]
+
+
+def sales_input(rng):
+    date = datetime.date(2022, 1, 1) + datetime.timedelta(days=rng.randrange(730))
+    return {
+        "date": date.isoformat(),
+        "store": rng.randrange(1, 51),
+        "promo": rng.randrange(2),
+        "holiday": int(rng.random() < 0.05),
+    }
+
+
+def make_rows(n, seed=1):
+    rng = random.Random(seed)
+    return [sales_input(rng) for _ in range(n)]
+
+
+def features_of(row):
+    date = datetime.date.fromisoformat(row["date"])
+    return {
+        "store": row["store"],
+        "promo": row["promo"],
+        "holiday": row["holiday"],
+        "year": date.year,
+        "month": date.month,
+        "dayofweek": date.weekday(),
+        "is_weekend": int(date.weekday() >= 5),
+    }
+
+
+def load_module(name, path, cwd=None, env=None, patches=()):
+    """Imports `path` as module `name`, with its directory on sys.path and the
+    working directory, environment and attributes it reads at import time."""
+    with pytest.MonkeyPatch.context() as mp:
+        mp.syspath_prepend(os.path.dirname(path))
+        if cwd is not None:
+            mp.chdir(cwd)
+        for key, value in (env or {}).items():
+            mp.setenv(key, value)
+        for target, value in patches:
+            mp.setattr(target, value)
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope="session")
+def models(tmp_path_factory):
+    # pylint: disable=import-outside-toplevel
+    import mlflow.sklearn
+    from sklearn.pipeline import make_pipeline
+    from sklearn.linear_model import LinearRegression
+    from sklearn.feature_extraction import DictVectorizer
+
+    rng = random.Random(2)
+    rows = [features_of(row) for row in make_rows(5000, seed=2)]
+    target = [
+        200 + row["store"] + 30 * row["promo"] + 40 * row["holiday"] + rng.gauss(0, 10)
+        for row in rows
+    ]
+    pipeline = make_pipeline(DictVectorizer(), LinearRegression()).fit(rows, target)
+
+    model_dir = tmp_path_factory.mktemp("models")
+    # web-services: (dv, model) in ./lin_reg.bin
+    with open(model_dir / "lin_reg.bin", "wb") as f_out:
+        pickle.dump((pipeline[0], pipeline[1]), f_out)
+    # monitoring: a LinearRegression on the feature columns, in ./lin_reg.bin
+    monitoring_dir = model_dir / "monitoring"
+    monitoring_dir.mkdir()
+    frame = pd.DataFrame(rows, columns=FEATURES)
+    joblib.dump(LinearRegression().fit(frame, target), monitoring_dir / "lin_reg.bin")
+    # the others: the pipeline as an MLflow model, as the training notebooks log it
+    mlflow.sklearn.save_model(
+        pipeline, str(model_dir / "mlflow_model"), serialization_format="cloudpickle"
+    )
+    return model_dir
+
+
+@pytest.fixture(scope="session")
+def serving(models):
+    """Per module: prepare_features(row), predict(features), and
+    predict_rows(rows), the module's batch path from raw rows to
+    predictions, or None where it has none."""
+    # pylint: disable=import-outside-toplevel,redefined-outer-name
+    import mlflow.pyfunc
+
+    mlflow_model = str(models / "mlflow_model")
+    load_pyfunc = mlflow.pyfunc.load_model
+    deployment = os.path.join(ROOT, "4-model_deployment")
+    modules = {}
+
+    web = load_module(
+        "bench_web_services",
+        os.path.join(deployment, "web-services", "app_predict.py"),
+        cwd=models,
+    )
+    modules["web-services"] = types.SimpleNamespace(
+        prepare_features=web.prepare_features,
+        predict=web.predict,
+        predict_rows=lambda rows: web.predict_batch(
+            web.prepare_features_batch(*web.read_batch(rows))
+        ),
+    )
+
+    web_mlflow = load_module(
+        "bench_web_services_mlflow",
+        os.path.join(deployment, "web-services-mlflow", "app_predict.py"),
+        # the s3:// model location is built from env vars at import
+        patches=[("mlflow.pyfunc.load_model", lambda _: load_pyfunc(mlflow_model))],
+    )
+    modules["web-services-mlflow"] = types.SimpleNamespace(
+        prepare_features=web_mlflow.prepare_features,
+        predict=web_mlflow.predict,
+        predict_rows=lambda rows: web_mlflow.predict_batch(
+            web_mlflow.prepare_features_batch(*web_mlflow.read_batch(rows))
+        ),
+    )
+
+    streaming = load_module(
+        "bench_streaming",
+        os.path.join(deployment, "streaming", "lambda_function.py"),
+        env={"MODEL_LOCATION": mlflow_model, "TEST_RUN": "True"},
+    )
+    modules["streaming"] = types.SimpleNamespace(
+        prepare_features=streaming.prepare_features,
+        predict=streaming.predict,
+        predict_rows=lambda rows: streaming.predict_batch(
+            [streaming.prepare_features(row) for row in rows]
+        ),
+    )
+
+    monitoring = load_module(
+        "bench_monitoring",
+        os.path.join(ROOT, "5-model_monitoring", "prediction_service", "app.py"),
+        cwd=models / "monitoring",
+        # no PostgreSQL: prediction logs go to local segment files
+        env={
+            "PREDICTION_LOG_SINK": "segments",
+            "PREDICTION_LOG_DIR": str(models / "prediction_segments"),
+        },
+    )
+    # app.py sets up its model and log sink when it starts serving, not at import
+    with pytest.MonkeyPatch.context() as mp:
+        mp.chdir(models / "monitoring")
+        monitoring.create_app()
+    modules["monitoring"] = types.SimpleNamespace(
+        prepare_features=monitoring.prepare_features,
+        predict=lambda features: monitoring.predict(monitoring.model, features),
+        predict_rows=None,
+    )
+
+    best = load_module(
+        "bench_best_practices_model",
+        os.path.join(ROOT, "6-best_practices", "code", "model.py"),
+    )
+    model_service = best.ModelService(best.load_model_from(mlflow_model))
+    modules["best-practices"] = types.SimpleNamespace(
+        prepare_features=model_service.prepare_features,
+        predict=model_service.predict,
+        predict_rows=lambda rows: model_service.predict_batch(
+            [model_service.prepare_features(row) for row in rows]
+        ),
+    )
+    return modules
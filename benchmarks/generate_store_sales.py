@@ -0,0 +1,130 @@
+import os
+import math
+import argparse
+
+import numpy as np
+import pandas as pd
+
+# Synthetic data in the layout of input_data/store_sales.csv
+#   date,store,sales,promo,holiday
+# one row per store and day, store by store. Sales follow a per-store level,
+# a weekly pattern (Tue/Wed high, weekends low), a yearly wave, a small
+# trend, promo and holiday uplifts and noise, in the ranges of the real data
+# (~228 mean, +30 with promo, +40 on holidays).
+# Rows are generated and written a chunk of stores at a time, so memory stays
+# flat up to 100M+ rows.
+
+# weekday multipliers, Monday=0, from the real data
+WEEKLY = np.array([1.0, 1.07, 1.09, 1.04, 0.96, 0.92, 0.935])
+
+
+def store_levels(stores, seed):
+    rng = np.random.default_rng([seed, 0])
+    return rng.normal(218.0, 9.0, size=stores)
+
+
+def generate_chunk(first_store, last_store, levels, dates, args, rng):
+    n_days = len(dates)
+    n_stores = last_store - first_store
+    days = np.tile(np.arange(n_days), n_stores)
+    epoch_days = dates.astype("int64")[days]
+    dayofweek = (epoch_days + 3) % 7
+    day_of_year = (dates - dates.astype("datetime64[Y]")).astype("int64")[days]
+    n = len(days)
+
+    promo = (rng.random(n) < args.promo_rate).astype("int8")
+    holiday = (rng.random(n) < args.holiday_rate).astype("int8")
+    seasonal = (
+        1
+        + args.seasonality * (WEEKLY[dayofweek] - 1)
+        - args.seasonality * 0.035 * np.cos(2 * np.pi * day_of_year / 365.25)
+    )
+    trend = 1 + args.trend * days / 365.25
+    sales = (
+        np.repeat(levels[first_store:last_store], n_days) * seasonal * trend
+        + promo * args.promo_uplift
+        + holiday * args.holiday_uplift
+        + rng.normal(0, args.noise, size=n)
+    )
+    return pd.DataFrame(
+        {
+            # one string per distinct date (n_days of them), rows only hold their codes
+            "date": pd.Categorical.from_codes(days, np.datetime_as_string(dates)),
+            "store": np.repeat(np.arange(first_store, last_store) + 1, n_days),
+            "sales": np.round(np.maximum(sales, 0), 2),
+            "promo": promo,
+            "holiday": holiday,
+        }
+    )
+
+
+def write_frame(frame, path, header):
+    frame.to_csv(path, mode="w" if header else "a", header=header, index=False)
+
+
+def generate(args):
+    start = np.datetime64(args.start, "D")
+    end = start + np.timedelta64(round(args.years * 365.25), "D")
+    dates = np.arange(start, end, dtype="datetime64[D]")
+    stores = args.stores
+    if args.rows is not None:
+        # enough stores for the requested rows, the last one is cut short
+        stores = math.ceil(args.rows / len(dates))
+    total_rows = args.rows or stores * len(dates)
+
+    levels = store_levels(stores, args.seed)
+    stores_per_chunk = max(1, args.chunk_rows // len(dates))
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    split_paths = None
+    if args.split_dir is not None:
+        os.makedirs(args.split_dir, exist_ok=True)
+        split_paths = [os.path.join(args.split_dir, name) for name in ("train.csv", "test.csv")]
+
+    written = 0
+    for chunk_index, first_store in enumerate(range(0, stores, stores_per_chunk)):
+        last_store = min(stores, first_store + stores_per_chunk)
+        # seeded per chunk: the same arguments give the same file
+        rng = np.random.default_rng([args.seed, 1, chunk_index])
+        frame = generate_chunk(first_store, last_store, levels, dates, args, rng)
+        frame = frame.iloc[: total_rows - written]
+        header = written == 0
+        write_frame(frame, args.output, header)
+        if split_paths is not None:
+            is_test = rng.random(len(frame)) < args.test_share
+            write_frame(frame[~is_test], split_paths[0], header)
+            write_frame(frame[is_test], split_paths[1], header)
+        written += len(frame)
+        print(f"{written}/{total_rows} rows", flush=True)
+    return written
+
+
+def run():
+    parser = argparse.ArgumentParser(description="generate a synthetic store_sales.csv")
+    parser.add_argument("--output", default="./input_data/store_sales.csv")
+    parser.add_argument("--rows", type=int, default=None,
+                        help="number of rows, overrides --stores")
+    parser.add_argument("--stores", type=int, default=10)
+    parser.add_argument("--years", type=float, default=2)
+    parser.add_argument("--start", default="2022-01-01")
+    parser.add_argument("--promo-rate", type=float, default=0.2)
+    parser.add_argument("--holiday-rate", type=float, default=0.1)
+    parser.add_argument("--promo-uplift", type=float, default=30.0)
+    parser.add_argument("--holiday-uplift", type=float, default=40.0)
+    parser.add_argument("--seasonality", type=float, default=1.0,
+                        help="scale of the weekly and yearly patterns, 0 for none")
+    parser.add_argument("--trend", type=float, default=0.02, help="growth per year")
+    parser.add_argument("--noise", type=float, default=12.0)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--chunk-rows", type=int, default=1_000_000)
+    parser.add_argument("--split-dir", default=None,
+                        help="also write train.csv and test.csv there")
+    parser.add_argument("--test-share", type=float, default=0.2)
+    args = parser.parse_args()
+
+    generate(args)
+
+
+if __name__ == "__main__":
+    run()
+
+# python generate_store_sales.py --rows 10000000 --output /tmp/bench/input_data/store_sales.csv
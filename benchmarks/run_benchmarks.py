@@ -0,0 +1,253 @@
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import logging
+import argparse
+import datetime
+import platform
+import tempfile
+import subprocess
+import importlib.util
+
+# Times the pipeline stages on synthetic data of several sizes. Every stage
+# runs as its own process on a copy of the data in a work directory, so the
+# peak RSS (ru_maxrss of that process) is the stage's own. Stages whose
+# packages are not installed, or that need a service that is not running,
+# are reported as skipped.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+MONITORING = os.path.join(ROOT, "5-model_monitoring")
+START = "2022-01-01"
+YEARS = 2
+
+
+def generate_command(workdir, rows):
+    return [sys.executable, os.path.join(BENCHMARKS, "generate_store_sales.py"),
+            "--rows", str(rows), "--start", START, "--years", str(YEARS),
+            "--output", os.path.join(workdir, "input_data", "store_sales.csv"),
+            "--split-dir", os.path.join(workdir, "input_data")]
+
+
+def preprocess_command(workdir, rows):
+    return [sys.executable, os.path.join(ROOT, "2-experiment_tracking_and_model_registry", "preprocess.py"),
+            "--raw_data_path", os.path.join(workdir, "input_data"),
+            "--dest_path", os.path.join(workdir, "preprocessed_output")]
+
+
+def train_flow_command(workdir, rows):
+    # reads ./input_data/train.csv and test.csv, logs to ./mlruns
+    return [sys.executable, os.path.join(ROOT, "3-workflow_orchestration", "train_xgboost_using_prefect_mlflow.py")]
+
+
+def batch_score_command(workdir, rows):
+    # writes ./output/<name>.csv
+    os.makedirs(os.path.join(workdir, "output"), exist_ok=True)
+    return [sys.executable, os.path.join(ROOT, "4-model_deployment", "batch", "sales_prediction_batch_score.py"),
+            os.path.join(workdir, "input_data", "store_sales.csv"), "batch_output"]
+
+
+def monitoring_command(workdir, rows):
+    # reads ./input_data/store_sales.csv, reference.csv and ./models/lin_reg.bin
+    os.makedirs(os.path.join(workdir, "models"), exist_ok=True)
+    shutil.copy(os.path.join(MONITORING, "input_data", "reference.csv"), os.path.join(workdir, "input_data"))
+    shutil.copy(os.path.join(MONITORING, "models", "lin_reg.bin"), os.path.join(workdir, "models"))
+    end = datetime.date.fromisoformat(START) + datetime.timedelta(days=round(YEARS * 365.25))
+    return [sys.executable, os.path.join(MONITORING, "evidently_metrics_calculation_psql_Prefect.py"),
+            "--start", START, "--end", end.isoformat()]
+
+
+def postgres_running():
+    try:
+        with socket.create_connection(("localhost", 5432), timeout=1):
+            return None
+    except OSError:
+        return "PostgreSQL is not reachable on localhost:5432"
+
+
+# name: (command, python packages, other requirement or None)
+STAGES = {
+    "generate": (generate_command, ["numpy", "pandas"], None),
+    "preprocess": (preprocess_command, ["pandas", "sklearn"], None),
+    "train_flow": (train_flow_command, ["pandas", "sklearn", "xgboost", "prefect", "mlflow"], None),
+    "batch_score": (batch_score_command, ["pandas", "mlflow", "sklearn"], None),
+    "monitoring_backfill": (monitoring_command,
+                            ["pandas", "prefect", "evidently", "psycopg", "joblib", "scipy"],
+                            postgres_running),
+}
+# monitoring_backfill upserts into store_sales_db, so it only runs when asked for
+DEFAULT_STAGES = ["generate", "preprocess", "train_flow", "batch_score"]
+
+
+def missing_requirement(stage):
+    _, packages, requirement = STAGES[stage]
+    missing = [package for package in packages if importlib.util.find_spec(package) is None]
+    if missing:
+        return "missing " + ", ".join(missing)
+    if requirement is not None:
+        return requirement()
+    return None
+
+
+def build_model(workdir):
+    """A DictVectorizer + LinearRegression pipeline saved as an MLflow model,
+    fitted on the first rows, for batch scoring without S3."""
+    # pylint: disable=import-outside-toplevel
+    import pandas as pd
+    import mlflow.sklearn
+    from sklearn.pipeline import make_pipeline
+    from sklearn.linear_model import LinearRegression
+    from sklearn.feature_extraction import DictVectorizer
+
+    # mlflow sets its log level on import
+    logging.getLogger("mlflow").setLevel(logging.ERROR)
+    df = pd.read_csv(os.path.join(workdir, "input_data", "store_sales.csv"), nrows=50_000,
+                     parse_dates=["date"])
+    df["year"] = df["date"].dt.year
+    df["month"] = df["date"].dt.month
+    df["dayofweek"] = df["date"].dt.dayofweek
+    df["is_weekend"] = df["dayofweek"].isin([5, 6]).astype(int)
+    categorical = ["store", "promo", "holiday", "year", "month", "dayofweek", "is_weekend"]
+    pipeline = make_pipeline(DictVectorizer(), LinearRegression())
+    pipeline.fit(df[categorical].to_dict(orient="records"), df["sales"])
+    model_path = os.path.join(workdir, "model")
+    shutil.rmtree(model_path, ignore_errors=True)
+    mlflow.sklearn.save_model(pipeline, model_path, serialization_format="cloudpickle")
+    return model_path
+
+
+def run_stage(stage, workdir, rows, timeout, env):
+    command = STAGES[stage][0](workdir, rows)
+    log_path = os.path.join(workdir, f"{stage}.log")
+    with open(log_path, "wb") as log:
+        started = time.perf_counter()
+        with subprocess.Popen(command, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT) as process:
+            # reaped with wait4 for the resource usage of this process alone
+            _, status, usage = wait_with_timeout(process, timeout)
+            returncode = os.waitstatus_to_exitcode(status)
+            process.returncode = returncode
+        wall_seconds = time.perf_counter() - started
+    result = {
+        "stage": stage,
+        "rows": rows,
+        "status": "ok" if returncode == 0 else "failed",
+        "wall_seconds": round(wall_seconds, 3),
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mib": round(usage.ru_maxrss / 1024, 1),
+        "rows_per_sec": round(rows / wall_seconds, 1),
+    }
+    if returncode != 0:
+        with open(log_path, "rt", encoding="utf-8", errors="replace") as f_in:
+            result["error"] = "".join(f_in.readlines()[-5:]).strip()
+        result["returncode"] = returncode
+    return result
+
+
+def wait_with_timeout(process, timeout):
+    if timeout is None:
+        return os.wait4(process.pid, 0)
+    deadline = time.monotonic() + timeout
+    while True:
+        pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+        if pid:
+            return pid, status, usage
+        if time.monotonic() > deadline:
+            process.kill()
+            return os.wait4(process.pid, 0)
+        time.sleep(0.05)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report, previous):
+    """rows/s of every stage against a previous report."""
+    before = {(r["stage"], r["rows"]): r for r in previous["results"] if r["status"] == "ok"}
+    print(f"\ncompared with {previous.get('commit')} ({previous.get('created_at')}):")
+    for result in report["results"]:
+        old = before.get((result["stage"], result["rows"]))
+        if result["status"] != "ok" or old is None:
+            continue
+        change = result["rows_per_sec"] / old["rows_per_sec"] - 1
+        print(f"  {result['stage']:<20}{result['rows']:>12}  {change:+7.1%} rows/s, "
+              f"peak RSS {old['peak_rss_mib']:.0f} -> {result['peak_rss_mib']:.0f} MiB")
+
+
+def run():
+    parser = argparse.ArgumentParser(description="time the pipeline stages on synthetic data")
+    parser.add_argument("--scales", default="10000,100000,1000000", help="rows per run")
+    parser.add_argument("--stages", default=",".join(DEFAULT_STAGES),
+                        help=f"comma separated, from {', '.join(STAGES)}")
+    parser.add_argument("--workdir", default=None, help="default: a temporary directory")
+    parser.add_argument("--timeout", type=float, default=None, help="seconds per stage")
+    parser.add_argument("--output", default=None, help="default: benchmarks/results/<commit>-<time>.json")
+    parser.add_argument("--compare", default=None, help="a previous report to compare with")
+    args = parser.parse_args()
+
+    stages = args.stages.split(",")
+    unknown = [stage for stage in stages if stage not in STAGES]
+    if unknown:
+        parser.error(f"unknown stages {unknown}")
+    # the data is only generated by the generate stage
+    if "generate" not in stages:
+        stages.insert(0, "generate")
+    skipped = {stage: missing_requirement(stage) for stage in stages}
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="store_sales_bench_")
+    os.makedirs(workdir, exist_ok=True)
+    # also quiets build_model, which runs in this process
+    os.environ.update(MLFLOW_DISABLE_AGENT_HINT="1", PYTHONWARNINGS="ignore")
+    env = dict(os.environ)
+    results = []
+    for rows in map(int, args.scales.split(",")):
+        for stage in stages:
+            if skipped[stage] is not None:
+                results.append({"stage": stage, "rows": rows, "status": "skipped", "reason": skipped[stage]})
+                print(f"{stage:<20}{rows:>12}  skipped: {skipped[stage]}")
+                continue
+            if stage == "batch_score":
+                env["RUN_ID"] = "benchmark"
+                env["MODEL_LOCATION"] = build_model(workdir)
+            result = run_stage(stage, workdir, rows, args.timeout, env)
+            results.append(result)
+            print(f"{stage:<20}{rows:>12}  {result['status']:<7}{result['wall_seconds']:>9.2f}s"
+                  f"{result['peak_rss_mib']:>9.0f} MiB{result['rows_per_sec']:>12.0f} rows/s")
+            if stage == "generate" and result["status"] != "ok":
+                break
+
+    created_at = datetime.datetime.now().isoformat(timespec="seconds")
+    report = {
+        "commit": git_commit(),
+        "created_at": created_at,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "workdir": workdir,
+        "results": results,
+    }
+    output = args.output or os.path.join(
+        BENCHMARKS, "results", f"{report['commit'] or 'unknown'}-{created_at.replace(':', '')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "wt", encoding="utf-8") as f_out:
+        json.dump(report, f_out, indent=2)
+    print(f"report written to {output}")
+
+    if args.compare is not None:
+        with open(args.compare, "rt", encoding="utf-8") as f_in:
+            compare(report, json.load(f_in))
+    if args.workdir is None:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    run()
+
+# python run_benchmarks.py --scales 10000,1000000,10000000
+# python run_benchmarks.py --stages preprocess,monitoring_backfill --compare results/<previous>.json
@@ -0,0 +1,82 @@
+import pandas as pd
+import pytest
+from conftest import make_rows, features_of
+
+# pytest-benchmark micro-benchmarks of the online hot path of every serving
+# module: feature preparation and prediction of a single row, and the batch
+# path from raw rows to predictions. See README.md for the regression check.
+
+MODULES = [
+    "web-services",
+    "web-services-mlflow",
+    "streaming",
+    "monitoring",
+    "best-practices",
+]
+# monitoring only serves single rows
+BATCH_MODULES = [module for module in MODULES if module != "monitoring"]
+BATCH_SIZES = [1, 100, 1000]
+
+
+@pytest.mark.parametrize("module", MODULES)
+def test_prepare_features(benchmark, serving, module):
+    benchmark.group = "prepare_features"
+    row = make_rows(1)[0]
+
+    features = benchmark(serving[module].prepare_features, row)
+
+    assert features == features_of(row)
+
+
+@pytest.mark.parametrize("module", MODULES)
+def test_predict(benchmark, serving, module):
+    benchmark.group = "predict"
+    features = features_of(make_rows(1)[0])
+
+    prediction = benchmark(serving[module].predict, features)
+
+    assert 150 < prediction < 350
+
+
+@pytest.mark.parametrize("batch_size", BATCH_SIZES)
+@pytest.mark.parametrize("module", BATCH_MODULES)
+def test_predict_rows(benchmark, serving, module, batch_size):
+    benchmark.group = f"predict_rows-{batch_size}"
+    rows = make_rows(batch_size)
+
+    predictions = benchmark(serving[module].predict_rows, rows)
+
+    assert len(predictions) == batch_size
+
+
+def test_modules_agree(serving):
+    # same features and predictions everywhere, except that monitoring rounds
+    # to 2 decimals while the others return the unrounded float
+    rows = make_rows(20, seed=3)
+    expected = [serving["best-practices"].predict(features_of(row)) for row in rows]
+
+    for module in MODULES:
+        service = serving[module]
+        predictions = [service.predict(service.prepare_features(row)) for row in rows]
+        if module == "monitoring":
+            assert predictions == [round(value, 2) for value in expected]
+        else:
+            assert predictions == pytest.approx(expected, abs=1e-6)
+        if service.predict_rows is not None:
+            assert list(service.predict_rows(rows)) == pytest.approx(expected, abs=1e-6)
+
+
+@pytest.mark.parametrize("date", ["2022-1-5", "2022-1-28", "2022/12/25"])
+@pytest.mark.parametrize("module", MODULES)
+def test_modules_parse_dates_like_pandas(serving, module, date):
+    # the dates pd.to_datetime accepts, e.g. the ones load_test.py sends
+    row = {"date": date, "store": 2, "promo": 1, "holiday": 0}
+    timestamp = pd.to_datetime(date)
+
+    features = serving[module].prepare_features(row)
+
+    assert (features["year"], features["month"], features["dayofweek"]) == (
+        timestamp.year,
+        timestamp.month,
+        timestamp.dayofweek,
+    )